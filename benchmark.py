@@ -0,0 +1,533 @@
+import argparse
+import glob
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import protocol
+"""
+Author: Lucas Vanderheijden
+
+This program measures how much load controller.py can take without needing any
+raspberry pis. It starts the controller on this computer and pretends to be a
+number of temperature sensors, cameras and HVAC units, all talking to it with
+the same messages the real devices use (see protocol.py).
+
+The temperature sensors send a new temperature every sensor period, the cameras
+send jpeg frames at the given rate and wait for each one to be acknowledged like
+camera.py does, and the HVAC units poll for their commands. The frames are the
+jpegs found in --images, or made up frames with a moving block in them so the
+frame cache can't skip them all.
+
+Once the controller says its detection is loaded, and after a warm up, it
+measures for the given duration and reports: the frames sent and processed per
+second, the time from a frame being received by the controller to its people
+count being applied (p50 and p99, read from the controller's metrics), the time
+for a frame to be acknowledged, the time for an HVAC poll to be answered, and the
+CPU and memory used by the controller and its worker processes (read from /proc,
+so this only works on linux). It also reports how long the controller took to
+start listening and to have detection ready.
+
+The results are written to a json file, and --compare checks them against the
+results of an earlier run and exits with an error if anything got worse by more
+than --tolerance.
+
+Making up frames requires the opencv library, like the controller itself.
+"""
+
+clock_ticks = os.sysconf('SC_CLK_TCK')		# the unit of the CPU times in /proc/<pid>/stat
+higher_is_better = ['frames_sent_per_second', 'frames_processed_per_second', 'temperature_updates_per_second', 'hvac_polls_per_second']
+
+"""
+This returns the value below which fraction of the sorted list values fall, or None if it is empty
+"""
+def percentile(values, fraction):
+	if not values:
+		return None
+	return values[min(int(fraction*len(values)), len(values)-1)]
+
+"""
+This returns the value below which fraction of the observations of a histogram
+fall, buckets being a sorted list of (upper bound, cumulative count). Like
+Prometheus, the value is interpolated inside the bucket it falls in.
+"""
+def histogramPercentile(buckets, fraction):
+	total = buckets[-1][1] if buckets else 0
+	if total == 0:
+		return None
+	rank = fraction*total
+	lower_bound, lower_count = 0.0, 0
+	for bound, count in buckets:
+		if count >= rank:
+			if bound == float('inf'):		# above every bucket, the best we can say is the largest bound
+				return lower_bound
+			return lower_bound + (bound-lower_bound)*(rank-lower_count)/max(count-lower_count, 1)
+		lower_bound, lower_count = bound, count
+	return lower_bound
+
+"""
+This returns the metrics served at url as a dictionary of sample names (with their labels) and values
+"""
+def scrapeMetrics(url):
+	samples = {}
+	for line in urllib.request.urlopen(url, timeout = 5).read().decode('utf-8').splitlines():
+		if line and not line.startswith('#'):
+			name, value = line.rsplit(' ', 1)
+			samples[name] = float(value)
+	return samples
+
+"""
+This returns the sum of the samples in before and after whose name starts with prefix,
+as the change from before to after
+"""
+def metricDelta(before, after, prefix):
+	return sum(value - before.get(name, 0.0) for name, value in after.items() if name.startswith(prefix))
+
+"""
+This returns the (upper bound, cumulative count) buckets of the histogram name
+observed between the metrics before and after
+"""
+def histogramDelta(before, after, name):
+	buckets = []
+	for sample, value in after.items():
+		if sample.startswith(name + '_bucket{'):
+			bound = sample.split('le="')[1].split('"')[0]
+			buckets.append((float(bound), value - before.get(sample, 0.0)))		# float() understands +Inf
+	return sorted(buckets)
+
+"""
+This returns the ids of the process pid and all of its children, like the inference workers
+"""
+def processTree(pid):
+	parents = {}
+	for stat_file in glob.glob('/proc/[0-9]*/stat'):
+		try:
+			f = open(stat_file, 'r')
+			fields = f.read().rsplit(')', 1)[1].split()		# the process name may contain spaces, everything after it can be split
+			f.close()
+		except OSError:		# the process ended while we were looking
+			continue
+		parents.setdefault(int(fields[1]), []).append(int(stat_file.split('/')[2]))
+	tree = [pid]
+	for process in tree:
+		tree.extend(parents.get(process, []))
+	return tree
+
+"""
+This returns the CPU time (in seconds) used so far by the processes pids
+"""
+def cpuSeconds(pids):
+	total = 0
+	for pid in pids:
+		try:
+			f = open('/proc/' + str(pid) + '/stat', 'r')
+			fields = f.read().rsplit(')', 1)[1].split()
+			f.close()
+		except OSError:
+			continue
+		total += int(fields[11]) + int(fields[12])		# the user and system time
+	return total/clock_ticks
+
+"""
+This returns the (current, peak) resident memory in bytes of the processes pids added up
+"""
+def memoryBytes(pids):
+	current = 0
+	peak = 0
+	for pid in pids:
+		try:
+			f = open('/proc/' + str(pid) + '/status', 'r')
+			lines = f.read().splitlines()
+			f.close()
+		except OSError:
+			continue
+		for line in lines:
+			if line.startswith('VmRSS:'):
+				current += int(line.split()[1])*1024
+			elif line.startswith('VmHWM:'):
+				peak += int(line.split()[1])*1024
+	return current, peak
+
+"""
+This returns count made up jpeg frames of the given size, each with a bright block
+in a different place so every frame looks different to the controller
+"""
+def syntheticFrames(count, width, height):
+	import cv2
+	import numpy
+	background = numpy.random.default_rng(0).integers(0, 60, (height, width, 3), dtype = numpy.uint8)
+	frames = []
+	for i in range(count):
+		image = background.copy()
+		x = int((width - width//4)*i/max(count-1, 1))
+		cv2.rectangle(image, (x, height//3), (x + width//4, height//3 + height//2), (200, 180, 160), -1)
+		ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 80])
+		frames.append(jpeg.tobytes())
+	return frames
+
+"""
+This returns the bytes of every jpeg in directory
+"""
+def loadFrames(directory):
+	frames = []
+	for file_name in sorted(glob.glob(os.path.join(directory, '*.jpg')) + glob.glob(os.path.join(directory, '*.jpeg'))):
+		f = open(file_name, 'rb')
+		frames.append(f.read())
+		f.close()
+	if not frames:
+		raise ValueError("no jpeg files found in " + directory)
+	return frames
+
+"""
+This function registers the temperature sensor name with the temperature temp
+with the controller at addr, the way temperature.py does
+"""
+def registerSensor(addr, name, temp):
+	sock = socket.create_connection(addr, timeout = 30)
+	sock.sendall(b'temp_reg')
+	sock.recv(1024)
+	sock.sendall(name.encode('utf-8'))
+	if sock.recv(1024) != b'ack':
+		raise RuntimeError("the controller did not accept the sensor " + name)
+	sock.sendall(str(temp).encode('utf-8'))
+	sock.recv(1024)		# wait for the controller to close the connection, so the sensor is registered before a camera asks for it
+	sock.close()
+
+"""
+This function registers the camera name paired with the temperature sensor sensor
+with the controller at addr, the way camera.py does
+"""
+def registerCamera(addr, name, sensor):
+	sock = socket.create_connection(addr, timeout = 30)
+	sock.sendall(b'cam_reg')
+	sock.recv(1024)
+	sock.sendall(name.encode('utf-8'))
+	if sock.recv(1024) != b'ack':
+		raise RuntimeError("the controller did not accept the camera " + name)
+	sock.sendall(sensor.encode('utf-8'))
+	if sock.recv(1024) != b'ack':
+		raise RuntimeError("the controller did not pair the camera " + name + " with " + sensor)
+	sock.close()
+
+"""
+This function registers the HVAC unit name with the controller at addr, the way
+hvacController.py does
+"""
+def registerHvac(addr, name):
+	sock = socket.create_connection(addr, timeout = 30)
+	sock.sendall(b'hvac_reg')
+	sock.recv(1024)
+	sock.sendall(name.encode('utf-8'))
+	if sock.recv(1024) != b'ack':
+		raise RuntimeError("the controller did not accept the HVAC unit " + name)
+	sock.close()
+
+"""
+This class holds what the simulated devices measured, shared by all their threads
+"""
+class Measurements:
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counts = {}		# the dictionary of event names and how many times they happened
+		self.latencies = {}		# the dictionary of event names and the list of their latencies in seconds
+		self.errors = 0
+
+	def record(self, event, latency = None):
+		with self.lock:
+			self.counts[event] = self.counts.get(event, 0) + 1
+			if latency is not None:
+				self.latencies.setdefault(event, []).append(latency)
+
+	def error(self, error):
+		with self.lock:
+			self.errors += 1
+			if self.errors <= 10:		# a broken controller would flood the output otherwise
+				print("Simulated device error: ", error)
+
+	"""
+	This function forgets everything measured so far, used to leave out the warm up
+	"""
+	def reset(self):
+		with self.lock:
+			self.counts = {}
+			self.latencies = {}
+			self.errors = 0
+
+"""
+This function runs the simulated temperature sensor name, sending a temperature
+around target every period seconds until stop is set
+"""
+def sensorClient(addr, name, target, period, stop, measurements):
+	while not stop.is_set():
+		try:
+			sock = protocol.openSession(addr, name)
+			while not stop.is_set():
+				protocol.sendMessage(sock, protocol.TEMP_UPDATE, str(round(target + random.uniform(-3, 3), 1)).encode('utf-8'))
+				measurements.record('temperature_update')
+				stop.wait(period)
+			sock.close()
+		except (OSError, ValueError) as error:
+			measurements.error(error)
+			stop.wait(1)
+
+"""
+This function runs the simulated camera name, sending the jpegs in frames one after
+another at fps frames per second and waiting for each to be acknowledged, until stop is set
+"""
+def cameraClient(addr, name, frames, fps, stop, measurements):
+	index = random.randrange(len(frames))		# so the cameras are not all sending the same frame
+	while not stop.is_set():
+		try:
+			sock = protocol.openSession(addr, name)
+			next_send = time.perf_counter()
+			while not stop.is_set():
+				start = time.perf_counter()
+				protocol.sendMessage(sock, protocol.FRAME, frames[index % len(frames)])
+				kind, body = protocol.readMessage(sock)
+				if kind != protocol.ACK:
+					raise ValueError("expected an ack for the frame, got message kind " + str(kind))
+				measurements.record('frame', time.perf_counter() - start)
+				index += 1
+				next_send += 1/fps
+				stop.wait(max(next_send - time.perf_counter(), 0))
+			sock.close()
+		except (OSError, ValueError) as error:
+			measurements.error(error)
+			stop.wait(1)
+
+"""
+This function runs the simulated HVAC unit name, polling for its commands every
+period seconds until stop is set
+"""
+def hvacClient(addr, name, period, stop, measurements):
+	while not stop.is_set():
+		try:
+			sock = protocol.openSession(addr, name)
+			while not stop.is_set():
+				start = time.perf_counter()
+				protocol.sendMessage(sock, protocol.HVAC_POLL)
+				kind, body = protocol.readMessage(sock)
+				if kind != protocol.HVAC_STATUS:
+					raise ValueError("expected the HVAC commands, got message kind " + str(kind))
+				measurements.record('hvac_poll', time.perf_counter() - start)
+				stop.wait(period)
+			sock.close()
+		except (OSError, ValueError) as error:
+			measurements.error(error)
+			stop.wait(1)
+
+"""
+This returns a port on this computer nothing is listening on
+"""
+def freePort():
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+"""
+This function waits until something accepts connections at addr, giving up with
+an error after timeout seconds or if the process controller exits
+"""
+def waitForPort(addr, controller, timeout):
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		if controller.poll() is not None:
+			raise RuntimeError("the controller exited with code " + str(controller.returncode) + " while starting")
+		try:
+			socket.create_connection(addr, timeout = 1).close()
+			return
+		except OSError:
+			time.sleep(0.2)
+	raise RuntimeError("the controller did not start listening within " + str(timeout) + " seconds")
+
+"""
+This function waits until the controller serving metrics at metrics_url says its
+detection is loaded and warmed up, giving up with an error after timeout seconds
+"""
+def waitForReady(metrics_url, controller, timeout):
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		if controller.poll() is not None:
+			raise RuntimeError("the controller exited with code " + str(controller.returncode) + " while starting")
+		try:
+			if scrapeMetrics(metrics_url).get('controller_ready') == 1.0:
+				return
+		except OSError:		# the metrics endpoint is not up yet
+			pass
+		time.sleep(0.2)
+	raise RuntimeError("the controller did not finish loading detection within " + str(timeout) + " seconds")
+
+"""
+This returns the git commit the code is at, or None if it can't be found
+"""
+def gitCommit():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)), capture_output = True, text = True).stdout.strip() or None
+	except OSError:
+		return None
+
+"""
+This function starts the controller, runs the simulated devices against it and returns the results
+"""
+def runBenchmark(args):
+	frames = loadFrames(args.images) if args.images else syntheticFrames(30, args.width, args.height)
+	work_dir = tempfile.mkdtemp(prefix = 'benchmark-')		# the controller's setpoint file, history and log go here
+	f = open(os.path.join(work_dir, 'temp.txt'), 'w')
+	f.write(str(args.target) + '\n')
+	f.close()
+
+	port = freePort()
+	metrics_port = freePort()
+	command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controller.py'), str(port),
+		'--metrics-port', str(metrics_port), '--history', os.path.join(work_dir, 'history.npz')] + args.controller_arg
+	print("Starting the controller: ", ' '.join(command))
+	log_file = open(os.path.join(work_dir, 'controller.log'), 'w')
+	controller = subprocess.Popen(command, cwd = work_dir, stdout = log_file, stderr = subprocess.STDOUT)
+
+	addr = ('127.0.0.1', port)
+	metrics_url = 'http://127.0.0.1:' + str(metrics_port) + '/metrics'
+	stop = threading.Event()
+	measurements = Measurements()
+	threads = []
+	try:
+		waitForPort(addr, controller, args.startup_timeout)
+		waitForReady(metrics_url, controller, args.startup_timeout)
+		startup = scrapeMetrics(metrics_url)
+		for i in range(args.sensors):
+			registerSensor(addr, 'sensor' + str(i), args.target)
+		for i in range(args.cameras):
+			registerCamera(addr, 'camera' + str(i), 'sensor' + str(i))
+		for i in range(args.hvac):
+			registerHvac(addr, 'hvac' + str(i))
+
+		for i in range(args.sensors):
+			threads.append(threading.Thread(target = sensorClient, args = (addr, 'sensor' + str(i), args.target, args.sensor_period, stop, measurements), daemon = True))
+		for i in range(args.cameras):
+			threads.append(threading.Thread(target = cameraClient, args = (addr, 'camera' + str(i), frames, args.fps, stop, measurements), daemon = True))
+		for i in range(args.hvac):
+			threads.append(threading.Thread(target = hvacClient, args = (addr, 'hvac' + str(i), args.hvac_period, stop, measurements), daemon = True))
+		for thread in threads:
+			thread.start()
+
+		print("Warming up for ", args.warmup, " seconds")
+		time.sleep(args.warmup)
+		measurements.reset()
+		pids = processTree(controller.pid)
+		metrics_before = scrapeMetrics(metrics_url)
+		cpu_before = cpuSeconds(pids)
+		start = time.time()
+
+		print("Measuring for ", args.duration, " seconds")
+		time.sleep(args.duration)
+
+		elapsed = time.time() - start
+		pids = processTree(controller.pid)
+		cpu_after = cpuSeconds(pids)
+		metrics_after = scrapeMetrics(metrics_url)
+		rss, peak_rss = memoryBytes(pids)
+		with measurements.lock:
+			counts = dict(measurements.counts)
+			latencies = {event: sorted(values) for event, values in measurements.latencies.items()}
+			errors = measurements.errors
+	finally:
+		stop.set()
+		for thread in threads:
+			thread.join(timeout = 5)
+		controller.terminate()
+		try:
+			controller.wait(timeout = 10)
+		except subprocess.TimeoutExpired:
+			controller.kill()
+		log_file.close()
+		print("Controller log: ", os.path.join(work_dir, 'controller.log'))
+
+	occupancy = histogramDelta(metrics_before, metrics_after, 'controller_occupancy_latency_seconds')
+	milliseconds = lambda seconds: None if seconds is None else round(seconds*1000, 3)
+	results = {
+		'frames_sent_per_second': counts.get('frame', 0)/elapsed,
+		'frames_processed_per_second': metricDelta(metrics_before, metrics_after, 'controller_frames_processed_total')/elapsed,
+		'temperature_updates_per_second': counts.get('temperature_update', 0)/elapsed,
+		'hvac_polls_per_second': counts.get('hvac_poll', 0)/elapsed,
+		'occupancy_latency_p50_ms': milliseconds(histogramPercentile(occupancy, 0.5)),
+		'occupancy_latency_p99_ms': milliseconds(histogramPercentile(occupancy, 0.99)),
+		'frame_ack_p50_ms': milliseconds(percentile(latencies.get('frame', []), 0.5)),
+		'frame_ack_p99_ms': milliseconds(percentile(latencies.get('frame', []), 0.99)),
+		'hvac_latency_p50_ms': milliseconds(percentile(latencies.get('hvac_poll', []), 0.5)),
+		'hvac_latency_p99_ms': milliseconds(percentile(latencies.get('hvac_poll', []), 0.99)),
+		'cpu_percent': 100*(cpu_after - cpu_before)/elapsed,
+		'rss_mb': rss/2**20,
+		'peak_rss_mb': peak_rss/2**20,
+		'errors': errors,
+		'startup_listen_ms': milliseconds(startup.get('controller_startup_seconds{phase="listen"}')),
+		'startup_ready_ms': milliseconds(startup.get('controller_startup_seconds{phase="ready"}')),
+	}
+	return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': gitCommit(), 'config': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')}, 'results': results}
+
+"""
+This function prints the results of this run next to the baseline ones and returns
+the names of the results that got worse by more than tolerance (a fraction)
+"""
+def compareResults(baseline, results, tolerance):
+	regressions = []
+	print("{:32} {:>12} {:>12} {:>9}".format("result", "baseline", "now", "change"))
+	for name, value in results.items():
+		old = baseline.get(name)
+		if old is None or value is None or name == 'errors':
+			print("{:32} {:>12} {:>12}".format(name, str(old), str(value)))
+			continue
+		change = (value - old)/old if old else 0.0
+		worse = -change if name in higher_is_better else change
+		flag = "  WORSE" if worse > tolerance else ""
+		if flag:
+			regressions.append(name)
+		print("{:32} {:>12.3f} {:>12.3f} {:>+8.1f}%{}".format(name, old, value, 100*change, flag))
+	return regressions
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Load test the controller with simulated devices")
+	parser.add_argument('--sensors', type = int, default = 4, help = "the number of simulated temperature sensors")
+	parser.add_argument('--cameras', type = int, default = 4, help = "the number of simulated cameras, each paired with its own sensor")
+	parser.add_argument('--hvac', type = int, default = 1, help = "the number of simulated HVAC units")
+	parser.add_argument('--fps', type = float, default = 5.0, help = "the frames per second each camera tries to send")
+	parser.add_argument('--sensor-period', type = float, default = 1.0, help = "the seconds between temperatures from each sensor")
+	parser.add_argument('--hvac-period', type = float, default = 0.2, help = "the seconds between polls from each HVAC unit")
+	parser.add_argument('--images', help = "a directory of recorded jpeg frames to send instead of made up ones")
+	parser.add_argument('--width', type = int, default = 640, help = "the width of the made up frames")
+	parser.add_argument('--height', type = int, default = 480, help = "the height of the made up frames")
+	parser.add_argument('--target', type = float, default = 72.0, help = "the target temperature the controller is given")
+	parser.add_argument('--warmup', type = float, default = 10.0, help = "the seconds to run after detection is ready before measuring, so the first frames are left out")
+	parser.add_argument('--duration', type = float, default = 30.0, help = "the seconds to measure for")
+	parser.add_argument('--startup-timeout', type = float, default = 120.0, help = "the seconds to wait for the controller to start listening")
+	parser.add_argument('--controller-arg', action = 'append', default = [], metavar = 'ARG', help = "an argument passed on to controller.py, like --controller-arg=--workers=2, can be given more than once")
+	parser.add_argument('--output', default = 'benchmark-' + time.strftime('%Y%m%d-%H%M%S') + '.json', help = "the file the results are written to")
+	parser.add_argument('--compare', metavar = 'BASELINE', help = "the results file of an earlier run to compare against")
+	parser.add_argument('--tolerance', type = float, default = 0.1, help = "how much worse (as a fraction) a result may get before --compare fails")
+	args = parser.parse_args()
+	if args.cameras > args.sensors:
+		parser.error("every camera needs its own sensor, so --cameras can't be more than --sensors")
+
+	run = runBenchmark(args)
+	for name, value in run['results'].items():
+		print(name, ": ", value)
+	f = open(args.output, 'w')
+	json.dump(run, f, indent = 2)
+	f.close()
+	print("Results written to ", args.output)
+
+	if args.compare is not None:
+		f = open(args.compare, 'r')
+		baseline = json.load(f)
+		f.close()
+		regressions = compareResults(baseline['results'], run['results'], args.tolerance)
+		if regressions:
+			print("Got worse: ", ', '.join(regressions))
+			sys.exit(1)
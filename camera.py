@@ -1,8 +1,15 @@
+import argparse
 import time
 import sys
+import os
+import collections
+import json
+import threading
 import cv2
-import numpy
 import socket
+from motion import MotionDetector, loadNoiseProfile
+import protocol
+from protocol import openSession, packCrop, readMessage, sendMessage
 
 """
 Author: Lucas Vanderheijden
@@ -13,74 +20,164 @@ the information to the central controller.
 
 This program takes two command line arguments. The first
 is the IP address to connect to, the second is the port number.
+An optional third argument is the noise profile measured for this camera by
+measureBaseline.py (noise_profile.bin by default).
+
+With the optional --edge-model argument the camera counts the people itself with a
+small (ideally INT8 quantized) model and only sends the count to the controller,
+which saves the controller's CPU and the network. Every --audit-every'th triggered
+frame is still sent in full so the controller can check the camera's counts.
+The edge mode needs detector.py copied next to this file and its dependancies installed.
+
+Capturing frames and checking them for motion happens on the main thread while
+a background thread uploads them over one persistent session with the controller. Only the newest
+frames are kept waiting for upload, so a slow or unreachable controller never
+stalls the capture and old frames are dropped instead of piling up.
+
+Frames are shrunk to the detector's input size (--max-size, 640 pixels on the
+longest side) before they are sent, since the controller would shrink them anyway.
+With the optional --bandwidth argument the JPEG quality is turned down or up after
+every frame so the uploads stay within that many kilobytes per second. With --crops
+only the part of the frame where the motion was (plus a margin) is sent when the
+motion covers a small part of the frame, and a whole frame every --full-every'th
+upload so the controller has the rest of the room.
 
 This program requires the opencv library
 to run. Information can be found at:
 https://raspberrypi-guide.github.io/programming/install-opencv.html
 """
-sensitivity = 5000000	# the change in change_val from baseline value needed to determine there is movement
-baseline = 95646774	# the baseline value of change_val that we expect, this value was experimentially determined with the measureBaseline.py script
+motion_threshold = 0.01	# the fraction of the frame that must change to determine there is movement
 pause_period = 1	# the time to wait until taking a new frame from the camera
 sensor_name = ""	# the name of the sensor, to be taken from user later
-image_file_name = ""	# the name of the file where the images taken will be stored. Name will be sensor_name + '.jpg'
-data_transmission_block_size = 1024	# the size of the blocks to transmit when sending images
+noise_profile_file = 'noise_profile.bin'	# the noise profile written by measureBaseline.py, used if it exists
+upload_queues = {protocol.COUNT: collections.deque(maxlen = 1), protocol.FRAME: collections.deque(maxlen = 1), protocol.CROP: collections.deque(maxlen = 1)}	# the data waiting to be uploaded for each message kind, appending to a full queue drops the oldest
+upload_condition = threading.Condition()	# used to wake the uploader when data is added to upload_queues
+min_backoff = 0.5		# the time to wait before the first reconnect attempt after the controller could not be reached
+max_backoff = 30		# the longest time to wait between reconnect attempts
+jpeg_quality = 80		# the quality frames are encoded at, adjusted to the bandwidth budget if one is given
+min_quality = 20		# the lowest quality the bandwidth budget may push frames down to
+max_quality = 90		# the highest quality frames are encoded at
+quality_step = 5		# how much the quality changes after a frame that did not fit the budget
+crop_margin = 0.25		# the fraction of the changed region's size added on each side of a crop, so people partly outside the change are still seen whole
+max_crop_fraction = 0.5		# the largest fraction of the frame a crop may cover, bigger changes are sent as whole frames
 
 """
-This method takes an address and sends the image
-stored in the file with name image_file_name to the specified address (the controller)
+This method adds data to the upload queue of message kind and wakes the uploader
 """
-def sendImage(addr):
-	sock = socket.socket()
-	print("Attempting to transmit data")
-	sock.connect(address)		# connect to controller
-	sock.send(b"cam_update")	# inform controller of connection type
-	if(sock.recv(1024) != b'ack'):
-		print("Transmission failed, closing connection")
-		sock.close()
-		return
-	else:
-		sock.send(sensor_name.encode('utf-8'))		# inform controller which camera is connecting
-		if(sock.recv(1024) != b'ack'):
-			print("Failed to send name, closing connection")
-			sock.close()
-			return
-		else:
-			print("Successfully send name, now sending filename")
-			sock.send(image_file_name.encode('utf-8'))
-			if(sock.recv(1024) == b'ack'):
-				print("Successfully sent file name, now sending data")
-				f = open(image_file_name, 'rb')		# open file, specify rb (read binary) because we are reading an image file
-				
-				# we must transmit the file in blocks as it is too large to send at once
-				bytes_read = 1041			# read() is set to read 1024 bytes. But sys.getsizeof(msg) will return 1024 probably because of some overhead in the variable
-				while bytes_read == 1041:		# treat 1041 as a magic number that works with block_size 1024, there may be a better way to do this but I'm too tired to find it
-					msg = f.read(data_transmission_block_size)		# read the next set of data
-					bytes_read = sys.getsizeof(msg)
-					print("Bytes read: ", bytes_read)			# for debugging purposes
-					sock.send(msg)
-
-					if(sock.recv(1024) != b'ack'):			# make sure nothing goes wrong
-						print("Error while transmitting data, closing connection")
-						sock.close()
-						return
-				sock.send(b'EOF')		# tell controller when file has been transmitted
-
-				print("Successfully transmitted file")
-				f.close()	# close the file pointer
-				sock.close()		# close connection
-			else:
-				print("Failed to send name, closing connection")
-				sock.close()
-				return
+def queueUpload(kind, data):
+	with upload_condition:
+		upload_queues[kind].append(data)		# replaces the waiting data if the uploader has not got to it yet
+		if kind == protocol.FRAME:		# the whole frame is newer than any crop still waiting
+			upload_queues[protocol.CROP].clear()
+		upload_condition.notify()
+
+"""
+This method returns image shrunk so its longest side is at most max_size pixels, or image itself if it is small enough
+"""
+def downscale(image, max_size):
+	height, width = image.shape[:2]
+	if max_size <= 0 or max(width, height) <= max_size:
+		return image
+	scale = max_size/max(width, height)
+	return cv2.resize(image, (round(width*scale), round(height*scale)), interpolation = cv2.INTER_AREA)
+
+"""
+This method encodes image as a jpeg and returns its bytes, or None if it could not be
+encoded. If there is a bandwidth budget, the quality is then adjusted so the next frames
+fit it: frame_budget is the bytes a whole frame of frame_pixels pixels may take, and
+crops are held to the same bytes per pixel.
+"""
+def encodeJpeg(image, frame_budget, frame_pixels):
+	global jpeg_quality
+	ret, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])		# encode image as jpg in memory, no need to write it to the SD card
+	if not ret:
+		return None
+	if frame_budget > 0:
+		used = (len(encoded)/(image.shape[0]*image.shape[1]))/(frame_budget/frame_pixels)		# the fraction of the budget this frame took
+		if used > 1:
+			jpeg_quality = max(jpeg_quality - quality_step, min_quality)
+		elif used < 0.7:		# leave some room so the quality does not flip back and forth
+			jpeg_quality = min(jpeg_quality + quality_step, max_quality)
+	return encoded.tobytes()
+
+"""
+This method returns the (x, y, width, height) of region grown by crop_margin on every
+side and kept inside a frame of frame_width by frame_height pixels
+"""
+def padRegion(region, frame_width, frame_height):
+	x, y, width, height = region
+	margin_x, margin_y = int(width*crop_margin), int(height*crop_margin)
+	x1, y1 = max(x - margin_x, 0), max(y - margin_y, 0)
+	x2, y2 = min(x + width + margin_x, frame_width), min(y + height + margin_y, frame_height)
+	return x1, y1, x2 - x1, y2 - y1
+
+"""
+This method runs on the uploader thread. It waits for data in upload_queues and
+sends each one to the specified address (the controller) over a session that
+is kept open between uploads, sending heartbeats while there is nothing to upload.
+If the session fails it reconnects, waiting longer after each failed attempt,
+and sends the newest data once it is back.
+"""
+def uploadFrames(addr):
+	session = None
+	backoff = min_backoff
+	while True:
+		with upload_condition:
+			if not any(upload_queues.values()):
+				upload_condition.wait(protocol.heartbeat_period)
+			kind = next((kind for kind in upload_queues if upload_queues[kind]), protocol.HEARTBEAT)	# counts go first, they are tiny
+			data = upload_queues[kind].popleft() if kind != protocol.HEARTBEAT else b''
+
+		try:
+			if session is None:
+				session = openSession(addr, sensor_name)
+				print("Opened session with controller")
+				backoff = min_backoff
+			sendMessage(session, kind, data)		# send the kind and size of the data followed by the whole data in one go
+			reply, body = readMessage(session)		# the controller acknowledges once it has all of it, so only one upload is ever in flight
+			if reply != (protocol.HEARTBEAT if kind == protocol.HEARTBEAT else protocol.ACK):
+				raise ConnectionError("controller did not acknowledge the upload")
+			if kind != protocol.HEARTBEAT:
+				print("Successfully transmitted", len(data), "bytes")
+		except (OSError, ValueError) as error:
+			print("Error while transmitting data: ", error, ", retrying in ", backoff, " seconds")
+			if session is not None:
+				session.close()
+				session = None
+			if kind != protocol.HEARTBEAT:
+				with upload_condition:
+					if not upload_queues[kind]:		# try this again unless newer data came in meanwhile
+						upload_queues[kind].append(data)
+			time.sleep(backoff)
+			backoff = min(backoff*2, max_backoff)
 
 sock = socket.socket()
 
-if len(sys.argv) < 3:		# the IP addr and port number to connect to must be supplied. Exit if not found
-	print("Usage: <IPAddr> <Port #>")
-	dht_device.exit()
-	sys.exit(0)
+parser = argparse.ArgumentParser(description = "Camera for the smart thermostat")	# the IP addr and port number to connect to must be supplied
+parser.add_argument('ip', help = "the IP address of the controller")
+parser.add_argument('port', type = int, help = "the port number of the controller")
+parser.add_argument('noise_profile', nargs = '?', default = noise_profile_file, help = "the noise profile made by measureBaseline.py")
+parser.add_argument('--edge-model', help = "count people on this device with this model and send only the counts")
+parser.add_argument('--edge-backend', default = 'onnx', help = "the backend of the edge model (see detector.py)")
+parser.add_argument('--edge-boxes', action = 'store_true', help = "send the person boxes along with the counts")
+parser.add_argument('--audit-every', type = int, default = 20, help = "in edge mode, send every this many triggered frames in full for auditing")
+parser.add_argument('--max-size', type = int, default = 640, help = "shrink frames so their longest side is at most this many pixels, 0 sends them at full size")
+parser.add_argument('--bandwidth', type = float, default = 0, help = "adjust the JPEG quality to keep uploads within this many kilobytes per second, 0 keeps the quality fixed")
+parser.add_argument('--crops', action = 'store_true', help = "send only the part of the frame that changed when the motion is small")
+parser.add_argument('--full-every', type = int, default = 10, help = "with --crops, send every this many uploads as a whole frame")
+args = parser.parse_args()
+if args.audit_every < 1:
+	parser.error("--audit-every must be at least 1")
+frame_budget = args.bandwidth*1024*pause_period		# the bytes a whole frame may take, frames are taken every pause_period seconds
 
-address = (sys.argv[1], int(sys.argv[2]))	# store the IPAddr, Port # tuple the socket needs to connect
+address = (args.ip, args.port)	# store the IPAddr, Port # tuple the socket needs to connect
+noise_profile_file = args.noise_profile
+
+edge_detector = None		# the detector used to count people on this device in edge mode
+if args.edge_model is not None:
+	from detector import Detector		# only needed in edge mode
+	edge_detector = Detector(args.edge_backend, args.edge_model)
+	print("Counting people on this device with", args.edge_model)
 
 print("Registering device")
 sock.connect(address)	# connect to register device
@@ -100,7 +197,6 @@ while True:
 		print("Invalid: Name already in use")
 	elif response == b"ack":
 		print("Name accepted")
-		image_file_name = sensor_name + ".jpg"
 		break
 	else:
 		print("Unknown error occurred verifying device name")
@@ -124,15 +220,29 @@ while True:
 # we have successfully registered the device
 sock.close()
 
+threading.Thread(target = uploadFrames, args = (address, ), daemon = True).start()		# frames are uploaded in the background from now on
+
 cam = cv2.VideoCapture(0)	# the 0 specifies reading from the first camera
 
+triggered_frames = 0		# the number of frames that triggered an upload, used to pick the audit frames
+motion = MotionDetector()	# compares each frame to a background learned from the previous ones
+if os.path.exists(noise_profile_file):		# start from the measured noise of this camera instead of learning it from scratch
+	mean, std = loadNoiseProfile(noise_profile_file)
+	motion.seed(mean, std)
+	print("Loaded noise profile from", noise_profile_file)
+else:
+	print("No noise profile found, run measureBaseline.py to make one")
+
 while True:
-	ret, prevImage = cam.read()	# get the first image
+	ret, image = cam.read()	# get the first image
 	if not ret:
 		print("Failed to get image, trying again")
 	else:
+		motion.update(downscale(image, args.max_size))		# the first image becomes the background
 		break
 
+uploads_since_full = args.full_every		# the uploads since the last whole frame, so the first upload is a whole frame
+
 while True:
 	time.sleep(pause_period)	# wait until sensing again
 
@@ -140,15 +250,39 @@ while True:
 	if not ret:				# ensure we were successful in grabbing image
 		print("Failed to get image, trying again")
 		continue
+	image = downscale(image, args.max_size)		# the detector does not look at more than this, so neither does anything else
+	frame_height, frame_width = image.shape[:2]
+
+	changed_fraction, changed_region = motion.update(image)
+	print("Current changed fraction", changed_fraction)			 # for debugging (helps determine an ideal motion_threshold)
+	if changed_fraction > motion_threshold:	# only bother sending image when significant change detected indicating something happened
+		print("Change detected, queueing frame. Changed fraction: ", changed_fraction, " region: ", changed_region)
+		triggered_frames += 1
+		if edge_detector is not None:		# count the people here and send just the count
+			(people, boxes), = edge_detector.detect([image])
+			print("People detected: ", people)
+			count = {'people': people}
+			if args.edge_boxes:
+				count['boxes'] = boxes
+			queueUpload(protocol.COUNT, json.dumps(count).encode('utf-8'))
 
-	change_val = numpy.sum(numpy.absolute(image-prevImage))
-	print("Current change_val", change_val)			 # for debugging (helps determine an ideal sensitivity and baseline)
-	if change_val > baseline+sensitivity or change_val < baseline-sensitivity:	# only bother sending image when significant change detected indicating something happened
-		print("Change detected, sending file. Change value: ", change_val)
-		cv2.imwrite(image_file_name, image)		# save image as jpg that we will transfer over
-		sendImage(address)
+		if edge_detector is None and args.crops and uploads_since_full < args.full_every and changed_region is not None:
+			x, y, width, height = padRegion(changed_region, frame_width, frame_height)
+			if width*height <= max_crop_fraction*frame_width*frame_height:		# the motion is small, send just that part
+				encoded = encodeJpeg(image[y:y+height, x:x+width], frame_budget, frame_width*frame_height)
+				if encoded is not None:
+					queueUpload(protocol.CROP, packCrop(x, y, frame_width, frame_height, encoded))
+					uploads_since_full += 1
+					continue
+				print("Failed to encode crop")
 
-	prevImage = image;
+		if edge_detector is None or triggered_frames % args.audit_every == 0:		# in edge mode only the audit frames are sent in full
+			encoded = encodeJpeg(image, frame_budget, frame_width*frame_height)
+			if encoded is not None:
+				queueUpload(protocol.FRAME, encoded)
+				uploads_since_full = 0
+			else:
+				print("Failed to encode image")
 
 	"""					# uncomment this block to show images pulled from camera (left here for testing purposes)
 	cv2.imshow('Imagetest',image)
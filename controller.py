@@ -1,11 +1,28 @@
+import argparse
+import asyncio
+import html
+import itertools
+import json
+import os
+import signal
 import socket
+import sqlite3
 import sys
-import threading
-import cv2
-from ultralytics import YOLO
-from ultralytics.utils.plotting import Annotator
-from threading import Event
-from PIL import Image
+import time
+import urllib.parse
+import numpy
+from detector import Detector, backends, exportModel, mergeCrop, selfCheck
+from httpServer import sendResponse, startHttpServer
+import metrics
+from metrics import Counter, Gauge, Histogram, log
+from controllerState import ControllerState
+import protocol
+from protocol import packMessage, recvFrame, recvMessage
+from setpoint import SetpointWatcher, formatSetpoints
+from stateStore import StateStore
+from timeSeries import TimeSeriesStore, resolutions, saveSnapshot
+import traceFile
+from traceFile import TraceWriter
 """
 Author: Lucas Vanderheijden
 
@@ -15,238 +32,1094 @@ sockets. It then uses the data to give commands to the
 HVAC system to optimize the temperature for as many people
 as possible.
 
-This program takes 1 command line argument which is the port to use
+The registered devices and their readings are kept in a ControllerState (see
+controllerState.py), which updates the weighted temperature incrementally so an
+update costs the same no matter how many rooms there are. The target temperatures
+are kept in memory and only reloaded when the setpoint file changes (see setpoint.py).
+Each room can have its own target, and the HVAC aims for the targets weighted by
+the people in each room.
+
+Every temperature and people count received is also kept as history in a
+TimeSeriesStore (see timeSeries.py), which is written to a snapshot file every
+few minutes and loaded back on startup. The optional --history and --snapshot-period
+arguments set the snapshot file and how often it is written. The history is served as
+json at /history on the same port as the metrics, for example
+/history?kind=temp&name=kitchen&start=1700000000&end=1700086400&resolution=minute
+(start and end are seconds since the epoch and default to the last hour, resolution
+is raw, minute or hour). /history on its own lists the readings there is history of.
+
+The registered devices and their latest readings are kept in a SQLite database
+(see stateStore.py) and loaded back on startup, so after a restart the devices
+can keep sending their updates without registering again. The optional --state
+and --state-flush-period arguments set the database file and how often the
+changes are written to it.
+
+The controller counts what it does and times each stage of handling a frame
+(see metrics.py). The numbers are served in the Prometheus text format at
+/metrics on the port given with --metrics-port, on the address given with
+--metrics-host (only this computer by default). The optional --log-sample-rate
+argument replaces the prints made for every message with json log lines for
+that fraction of the messages.
+
+With the optional --record argument every frame, count, temperature, pairing,
+setpoint change and HVAC decision is appended to a trace file (see traceFile.py)
+that replay.py can play back through the detection and control code offline.
+
+All connections are served by a single asyncio event loop so that many
+devices can talk to the controller at once without a thread per connection.
+The YOLO inference is run in an executor so it never blocks the event loop.
+Frames from all the cameras are collected into batches so one forward pass of
+the model serves many cameras, and the batches can be spread over a pool of
+worker processes (see inferencePool.py).
+
+This program takes 1 command line argument which is the port to use.
+The optional --workers argument sets the number of inference worker processes.
+The optional --backend, --model and --int8 arguments choose how people are detected
+(see detector.py) and --self-check compares that choice against the PyTorch model.
+An INT8 ONNX export needs a directory of camera frames to calibrate on, given with --calibration.
+The optional --dedup-distance and --dedup-ttl arguments control when a frame is
+close enough to the last one of its camera to reuse its people count (see frameCache.py).
+The optional --detect-every and --camera-detect-every arguments make full detection
+run only every few frames, with the people followed by a tracker in between (see tracker.py).
+
+Cameras running in edge mode count the people themselves and send only the
+count with the cam_count message, plus a full frame now and then for auditing.
+
+Cameras can also send only the part of the frame that changed as a crop. The
+people found in the crop replace the ones last seen in that part of the frame
+and the people elsewhere are kept, so the count stays right for the whole room.
+
+Devices that have registered can open a session: one long lived connection
+tied to their name over which they send all their updates as messages (see
+protocol.py). A device whose session goes quiet for longer than the session
+timeout is treated as dead. The HVAC unit subscribes over its session and is
+sent its commands as soon as they change, and again every keepalive period.
+Sessions are refused for names that were not registered. HVAC units register
+their name with hvac_reg every time they connect, since they have no readings to keep.
+
+The controller runs without a screen. The latest frame of each camera, with the
+people found in it boxed, can be watched in a browser at /stream/<camera name> on
+the same port as the metrics, with a list of the cameras at /stream/. A frame is
+only drawn and encoded while someone is watching its camera.
+
+The controller starts listening before anything slow happens, so temperature
+sensors and HVAC units can connect right away. OpenCV, the model and the
+inference workers are loaded in the background, followed by a warm up inference,
+and frames that arrive in the meantime wait (the newest from each camera) until
+detection is ready. The time each startup phase took is printed and served as metrics.
 
 This program requires the YOLOv8 model and its dependancies to run. Information can be
 found here: https://docs.ultralytics.com/quickstart/
 """
 
-temp_sens_list = {}	# the dictionary of registered temperature sensor names and their associated temperatures
-temp_weight_list = {}	# the dictionary of registered temperature sensor names and the number of people detected in their room
-camera_list = {}		# the dictionary of registered cameras and their associated cameras
-current_temp = 0	# the weighted average temperature, aka the average temp of each room weighted by the # people dectected in the room
+state = ControllerState()	# the registered temperature sensors and cameras and their latest readings
 AC_status = 'OFF'		# what we want the AC to be doing
 heat_status = 'OFF'		# what we want the heater to be doing
-target_temp_file = 'temp.txt'		# file storing the target temperature
-newImage = Event()			# used to indicate when a new annotated image must be shown
-save_dir = ""		# the directory the annotated images are saved in
+target_temp_file = 'temp.txt'		# file storing the target temperatures, written with updateTemperature.py
+latest_frames = {}		# the dictionary of camera names and the latest (frame, person boxes) from that camera, kept in memory instead of on disk
+frame_versions = {}		# the dictionary of camera names and how many times their latest frame or boxes changed
+frame_watchers = {}		# the dictionary of camera names and the future the viewers of that camera wait on for its next frame
+annotated_frames = {}		# the dictionary of camera names and the (version, annotated jpeg) last encoded for viewers
+stream_boundary = 'frame'		# separates the jpegs of an MJPEG stream
+connection_tasks = set()	# the tasks handling open connections, kept so they are not garbage collected while running
+max_batch_size = 8		# the most frames that are run through the model together in one batched predict
+max_batch_wait = 0.02		# the longest time (in seconds) a frame waits for frames from other cameras to join its batch
+max_frame_bytes = 1920*1080*3		# the size of the largest decoded frame we plan for, used to size the shared memory blocks
+block_size = max_batch_size*max_frame_bytes	# the size of the shared memory block used to hand one batch to a worker
+pending_frames = {}		# the dictionary of camera handles and their newest (sequence number, decoded frame, frame hash, time received, crop offset) that is waiting for inference, the offset is None for whole frames
+frames_pending = asyncio.Event()	# set when pending_frames has at least one frame in it
+batch_full = asyncio.Event()		# set when pending_frames has enough frames to fill a batch
+frame_sequence = itertools.count()	# numbers the frames in the order they arrive
+applied_sequence = {}		# the dictionary of camera handles and the sequence number of the newest frame whose count was applied
+batch_tasks = set()		# the tasks running batches, kept so they are not garbage collected while running
+default_model_path = "yolov8n.pt"	# the YOLOv8n PyTorch model, exported for the other backends when needed
+inference_pool = None		# the InferencePool running detection, created once the event loop is running
+frame_cache = None		# the FrameCache used to skip inference on frames that barely changed, created from the command line arguments
+detect_every = 1		# how many frames make up one detection cycle for a camera, 1 runs full detection on every frame
+camera_detect_every = {}	# the dictionary of camera handles and their own detection cycle, overriding detect_every
+trackers = {}		# the dictionary of camera handles and the RoomTracker following the people they see
+edge_counts = {}		# the dictionary of camera handles and the last people count the camera sent itself, used to audit edge cameras
+device_sessions = {}		# the dictionary of device names and the socket of their open session
+dead_devices = set()		# the names of devices whose session timed out and that have not come back yet
+session_locks = {}		# the dictionary of session sockets and the lock that keeps messages sent on them from interleaving
+hvac_subscribers = set()	# the session sockets of the HVAC units that want their commands pushed to them
+hvac_units = set()		# the names of the registered HVAC units
+hvac_update_needed = asyncio.Event()	# set when a reading changed and the HVAC commands must be recomputed
+setpoints = None		# the SetpointWatcher keeping the target temperatures in memory, created once the event loop is running
+history = TimeSeriesStore()		# the history of every temperature and people count received
+history_file = 'history.npz'		# the file the history is snapshotted to
+temperature_times = {}		# the dictionary of temperature sensor handles and the time of their last temperature in the history
+snapshot_period = 300		# how often (in seconds) the history is snapshotted
+pending_since = {}		# the dictionary of camera handles and the event loop time their frame in pending_frames was queued
+running_frames = {}		# the dictionary of camera handles and the number of their whole frames in batches being run
+held_crops = {}		# the dictionary of camera handles and their newest crop, held until their whole frames being run are applied
+state_store = None		# the StateStore the registered devices and their readings are saved to, created at startup
+state_file = 'controller_state.db'		# the database the registered devices and their readings are saved to
+state_flush_period = 1.0		# how often (in seconds) the changed devices and readings are written to state_file
 
-# Load a YOLOv8n PyTorch model
-model = YOLO("yolov8n.pt")
+# the metrics served at /metrics, see metrics.py
+frames_received = Counter('controller_frames_received_total', "Frames received from cameras")
+frame_bytes_received = Counter('controller_frame_bytes_received_total', "Bytes of jpeg frames received from cameras")
+counts_received = Counter('controller_counts_received_total', "People counts received from cameras in edge mode")
+frames_processed = {path: Counter('controller_frames_processed_total', "Frames and counts whose people count was applied, by where the count came from", {'path': path})
+	for path in ['cache', 'tracker', 'detector', 'crop', 'edge']}
+stage_seconds = {stage: Histogram('controller_stage_seconds', "Time spent in each stage of handling a frame", {'stage': stage})
+	for stage in ['receive', 'decode', 'track', 'queue', 'inference']}
+batch_sizes = Histogram('controller_batch_size', "Frames in each batch run through the model", buckets = (1, 2, 3, 4, 6, 8, 12, 16))
+occupancy_latency = Histogram('controller_occupancy_latency_seconds', "Time from a frame being received to its people count being applied")
+session_lock_wait = Histogram('controller_session_lock_wait_seconds', "Time spent waiting for another message to finish sending on a session")
+inference_errors = Counter('controller_inference_errors_total', "Batches that failed to run")
+temperature_updates = Counter('controller_temperature_updates_total', "Temperatures received from temperature sensors")
+hvac_decisions = {status: Counter('controller_hvac_decisions_total', "Times the HVAC commands were worked out, by the commands chosen", {'ac': status[0], 'heat': status[1]})
+	for status in [('OFF', 'OFF'), ('ON', 'OFF'), ('OFF', 'ON')]}
+active_connections = Gauge('controller_active_connections', "Connections currently open, sessions included")
+Gauge('controller_pending_frames', "Frames waiting to be batched for inference", function = lambda: len(pending_frames))
+Gauge('controller_running_batches', "Batches currently running through the model", function = lambda: len(batch_tasks))
+Gauge('controller_sessions', "Devices with an open session", function = lambda: len(device_sessions))
+Gauge('controller_dead_devices', "Devices whose session timed out", function = lambda: len(dead_devices))
+Gauge('controller_frame_cache_hits', "Frames whose count was reused from the frame cache", function = lambda: frame_cache.hits if frame_cache is not None else 0)
+pipeline_ready = asyncio.Event()		# set once OpenCV, the model and the workers are loaded and warmed up
+waiting_frames = {}		# the dictionary of camera handles and their newest jpeg that arrived before the pipeline was ready
+startup_begin = time.perf_counter()		# when the controller started, for the startup phase timings
+dedup_distance = 4		# the most bits a frame's hash may differ from the last inferred frame of its camera to reuse its result
+dedup_ttl = 30.0		# the seconds a result may be reused for similar frames
+scheduler_task = None		# the task running inferenceScheduler, started once the pipeline is ready
+calibration_dir = None		# the directory of camera frames an INT8 ONNX export is calibrated on
+# cv2, FrameCache, frameHash, InferencePool and RoomTracker are imported in the background by importPipeline
+trace_writer = None		# the TraceWriter recording what the controller receives, None when not recording
+startup_seconds = {phase: Gauge('controller_startup_seconds', "Time each phase of starting the controller took", {'phase': phase})
+	for phase in ['state_load', 'listen', 'imports', 'model_export', 'model_warmup', 'ready']}
+Gauge('controller_ready', "1 once detection is ready to run", function = lambda: 1 if pipeline_ready.is_set() else 0)
+metrics_port = 9108		# the port the metrics are served on, 0 turns the endpoint off
+metrics_host = '127.0.0.1'		# the address the metrics are served on
 
 """
-This function returns the target_temp with the value
-stored in the target_temp_file
+This function is called by the setpoint watcher with the new default target
+temperature and the dictionary of zones and their own targets when the setpoint file changes
 """
-def update_target_temp():
-	f = open(target_temp_file, 'r')		# open the file
-	read_msg = f.read()
-	print("Read: ", read_msg)
-	target_temp = int(read_msg)			# read the value, the file should only have a number which is the target Temp
-	f.close()		# close file
-	return target_temp
+def onSetpointChange(default, zones):
+	state.setTargets(default, {zone.encode('utf-8'): target for zone, target in zones.items()})		# zones are named like the temperature sensors
+	recordTrace(traceFile.SETPOINT, b'', formatSetpoints(default, zones).encode('utf-8'))
+	requestHvacUpdate()
 
 """
-This method handles incoming connections. It is spun off as a new thread
-each time a new connection is made.
+This function appends a record of kind from the device name with the bytes payload
+to the trace, if the controller is recording one
+"""
+def recordTrace(kind, name, payload):
+	if trace_writer is not None:
+		trace_writer.append(kind, name, payload)
+
+"""
+This function records every registered sensor, camera pairing and people count in the
+trace, so a trace started after the state was restored replays from the same state
+"""
+def recordState():
+	for name, temp in state.temp_sens_list.items():		# the sensors first, replay.py can only pair cameras with known sensors
+		recordTrace(traceFile.TEMP, name, str(temp).encode('utf-8'))
+	for name, temp_sensor in state.camera_list.items():
+		recordTrace(traceFile.PAIR, name, temp_sensor)
+		recordTrace(traceFile.COUNT, name, json.dumps({'people': state.temp_weight_list[temp_sensor]}).encode('utf-8'))
+
+"""
+This function decodes the jpeg bytes in image_data sent by the camera
+camera_name into a BGR numpy array. Nothing touches the disk.
+"""
+def decodeFrame(camera_name, image_data):
+	image = cv2.imdecode(numpy.frombuffer(image_data, dtype = numpy.uint8), cv2.IMREAD_COLOR)	# decode the jpeg straight into a BGR numpy array
+	if image is None:
+		raise ValueError("could not decode frame from " + camera_name)
+	return image
+
 """
-def onConnection(connected_socket):
-	connection_msg = connected_socket.recv(1024)	# first message sent will be update type
+This function decodes the jpeg bytes in image_data sent by the camera camera_name
+and returns the BGR image along with its hash for the frame cache
+"""
+def prepareFrame(camera_name, image_data):
+	image = decodeFrame(camera_name, image_data)
+	return image, frameHash(image)
+
+"""
+This function draws the person boxes on image and returns it
+"""
+def drawBoxes(image, boxes):
+	for x1, y1, x2, y2 in boxes:
+		cv2.rectangle(image, (int(x1), int(y1)), (int(x2), int(y2)), (0, 255, 0), 2)
+		cv2.putText(image, "person", (int(x1), max(int(y1)-5, 0)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+	return image
+
+"""
+This function stores the people count and boxes found in the frame numbered
+sequence from camera_handle. Results older than a count already applied for the
+camera (possible when batches run in parallel) are dropped. image may be None
+for counts sent by an edge camera, the boxes are then shown on its last frame.
+"""
+def applyDetection(camera_handle, sequence, image, people, boxes):
+	if sequence < applied_sequence.get(camera_handle, -1):
+		return
+	applied_sequence[camera_handle] = sequence
+	camera_name = camera_handle.decode('utf-8')
+	if image is None and camera_name in latest_frames:
+		image = latest_frames[camera_name][0]
+	if image is not None:
+		latest_frames[camera_name] = (image, boxes)		# keep the frame and its boxes for anyone watching the camera
+		frame_versions[camera_name] = frame_versions.get(camera_name, 0) + 1
+		watchers = frame_watchers.pop(camera_name, None)
+		if watchers is not None and not watchers.done():		# wake the viewers of this camera, nothing is drawn if there are none
+			watchers.set_result(None)
+	log('people_detected', "People detected by {camera}: {people}", camera = camera_name, people = people)
+	history.record('people', camera_name, time.time(), people)
+	if state.setPeople(camera_handle, people):		# update the count of the room
+		requestHvacUpdate()
+
+"""
+This coroutine runs detection on the dictionary batch of camera handles and
+(sequence number, image, frame hash, time received, crop offset) tuples, applies the people
+count of each frame and remembers it in the frame cache. The people found in crops are merged
+with the ones last found in the rest of their camera's frame (see mergeCrop in detector.py).
+Crops that came in while a camera's whole frame was being run are queued once it is applied.
+"""
+async def runBatch(batch):
+	whole_frames = [camera_handle for camera_handle, frame in batch.items() if frame[4] is None]
+	for camera_handle in whole_frames:
+		running_frames[camera_handle] = running_frames.get(camera_handle, 0) + 1
+	try:
+		await applyBatch(batch)
+	finally:
+		for camera_handle in whole_frames:
+			running_frames[camera_handle] -= 1
+			if running_frames[camera_handle] == 0:
+				del running_frames[camera_handle]
+				crop = held_crops.pop(camera_handle, None)
+				if crop is not None and camera_handle not in pending_frames:		# a whole frame waiting for inference is newer than the crop
+					queueInference(camera_handle, crop)
+
+"""
+This coroutine does the work of runBatch
+"""
+async def applyBatch(batch):
+	loop = asyncio.get_running_loop()
+	batch_sizes.observe(len(batch))
+	try:
+		with stage_seconds['inference'].time():
+			detections = await inference_pool.detect([image for sequence, image, frame_hash, received, offset in batch.values()])
+	except Exception as error:		# a bad batch should not stop inference for every camera
+		inference_errors.inc()
+		print("Error while running inference: ", error)
+		return
+
+	for (camera_handle, (sequence, image, frame_hash, received, offset)), (people, boxes) in zip(batch.items(), detections):
+		if offset is not None:
+			last = latest_frames.get(camera_handle.decode('utf-8'))
+			merged = None if last is None else mergeCrop(last[0], last[1], offset, image, boxes)
+			if merged is None:
+				print("Crop from ", camera_handle, " does not fit its last frame, skipping it")
+				continue
+			frames_processed['crop'].inc()
+			image, boxes = merged
+			if camera_handle in edge_counts and edge_counts[camera_handle] != len(boxes):		# audit an edge camera's count like with whole frames
+				print("Audit of ", camera_handle, ": camera counted ", edge_counts[camera_handle], " but the controller counted ", len(boxes))
+			applyDetection(camera_handle, sequence, image, len(boxes), boxes)
+			occupancy_latency.observe(loop.time() - received)
+			# the cache and the tracker must start from the merged result, or the next whole frame brings back the count from before the crop
+			frame_cache.store(camera_handle, await loop.run_in_executor(None, frameHash, image), len(boxes), boxes, loop.time())
+			if camera_handle in trackers:
+				await loop.run_in_executor(None, trackers[camera_handle].update, image, boxes)
+			continue
+		frames_processed['detector'].inc()
+		frame_cache.store(camera_handle, frame_hash, people, boxes, loop.time())
+		if camera_handle in edge_counts and edge_counts[camera_handle] != people:		# an audit frame from an edge camera disagrees with it
+			print("Audit of ", camera_handle, ": camera counted ", edge_counts[camera_handle], " but the controller counted ", people)
+		applyDetection(camera_handle, sequence, image, people, boxes)
+		occupancy_latency.observe(loop.time() - received)
+		if camera_handle in trackers:		# start following the people that were just found
+			await loop.run_in_executor(None, trackers[camera_handle].update, image, boxes)
+
+"""
+This coroutine collects frames from all cameras into batches and hands them
+to the inference pool. A batch is started as soon as it has max_batch_size
+frames, or once max_batch_wait seconds have passed since the first frame showed up,
+and only when a worker is free to run it, so frames keep joining the next batch
+while every worker is busy. If a camera sends a new frame before its last one
+was run, only the newest is kept.
+"""
+async def inferenceScheduler():
+	loop = asyncio.get_running_loop()
+	inference_slots = asyncio.Semaphore(inference_pool.concurrency())
+	while True:
+		await inference_slots.acquire()		# wait for a worker to be free
+		await frames_pending.wait()		# wait for the first frame of the batch
+		if len(pending_frames) < max_batch_size:		# give other cameras a moment to fill the batch
+			try:
+				await asyncio.wait_for(batch_full.wait(), max_batch_wait)
+			except asyncio.TimeoutError:
+				pass
+
+		batch = {}
+		batch_bytes = 0
+		for camera_handle in list(pending_frames):	# take the frames that have been waiting the longest
+			frame_bytes = pending_frames[camera_handle][1].nbytes
+			if batch and (len(batch) == max_batch_size or batch_bytes+frame_bytes > block_size):
+				break
+			batch[camera_handle] = pending_frames.pop(camera_handle)
+			stage_seconds['queue'].observe(loop.time() - pending_since.pop(camera_handle))
+			batch_bytes += frame_bytes
+		if len(pending_frames) < max_batch_size:
+			batch_full.clear()
+		if not pending_frames:
+			frames_pending.clear()
+
+		task = loop.create_task(runBatch(batch))
+		batch_tasks.add(task)
+		task.add_done_callback(batch_tasks.discard)
+		task.add_done_callback(lambda task: inference_slots.release())		# the worker is free again once the batch is done
+
+"""
+This function computes the weighted temperature from the latest readings and
+people counts and returns the (AC_status, heat_status) commands for the HVAC unit
+"""
+def computeHvacStatus():
+	global AC_status, heat_status
+	status = state.hvacStatus()		# the weighted temperatures are kept up to date as readings come in, so this is cheap
+	if status != (AC_status, heat_status):
+		recordTrace(traceFile.HVAC, b'', (status[0] + ' ' + status[1]).encode('utf-8'))
+	AC_status, heat_status = status
+	hvac_decisions[(AC_status, heat_status)].inc()
+	log('hvac_decision', "People: {people}, weighted temperature: {temp}, target: {target}, AC: {ac}, heat: {heat}",
+		people = state.total_people, temp = state.weightedTemperature(), target = state.weightedTarget(), ac = AC_status, heat = heat_status)
+	return AC_status, heat_status
+
+"""
+This function stores the new temperature temp sent by the temperature sensor temperature_handle
+"""
+def applyTemperature(temperature_handle, temp):
+	state.setTemperature(temperature_handle, temp)		# update temp of that temp sensor
+	temperature_updates.inc()
+	now = time.time()
+	history.record('temp', temperature_handle.decode('utf-8'), now, temp)
+	temperature_times[temperature_handle] = now
+	recordTrace(traceFile.TEMP, temperature_handle, str(temp).encode('utf-8'))
+	requestHvacUpdate()
+
+"""
+This function stores the temperatures sent together by the temperature sensor
+temperature_handle, samples being a list of (age in seconds, temperature) oldest first.
+Every one of them goes into the history and the newest becomes the sensor's temperature.
+"""
+def applyTemperatureBatch(temperature_handle, samples):
+	if not samples:
+		return
+	now = time.time()
+	last_time = temperature_times.get(temperature_handle, 0.0)
+	times = []
+	for age, temp in samples:
+		last_time = max(now - age, last_time)		# keep the history in time order even if the ages were off by a little
+		times.append(last_time)
+	temp = samples[-1][1]
+	state.setTemperature(temperature_handle, temp)
+	temperature_updates.inc(len(samples))
+	history.recordMany('temp', temperature_handle.decode('utf-8'), times, [temp for age, temp in samples])
+	temperature_times[temperature_handle] = last_time
+	recordTrace(traceFile.TEMP, temperature_handle, str(temp).encode('utf-8'))
+	requestHvacUpdate()
+
+"""
+This coroutine writes a snapshot of the history to history_file every snapshot_period seconds.
+Only copying the buffers happens on the event loop, compressing and writing them runs in an executor.
+"""
+async def snapshotWriter():
+	loop = asyncio.get_running_loop()
+	while True:
+		await asyncio.sleep(snapshot_period)
+		try:
+			await loop.run_in_executor(None, saveSnapshot, history_file, history.snapshot())
+		except OSError as error:
+			print("Error while writing the history snapshot: ", error)
+
+"""
+This coroutine writes the devices and readings that changed to state_store every
+state_flush_period seconds. The writes run in an executor so they never block the event loop.
+The trace being recorded is flushed too, so it can be read while it is recorded.
+"""
+async def stateFlusher():
+	loop = asyncio.get_running_loop()
+	while True:
+		await asyncio.sleep(state_flush_period)
+		if trace_writer is not None:		# on the event loop, where the records are appended, so the data always goes out before its index entries
+			try:
+				trace_writer.flush()
+			except OSError as error:
+				print("Error while writing the trace: ", error)
+		try:
+			await loop.run_in_executor(None, state_store.flush)
+		except sqlite3.Error as error:
+			print("Error while saving the controller state: ", error)
+
+"""
+This coroutine gives the cameras restored from state_store one session timeout to come
+back. A camera that has neither opened a session nor had a people count applied by then
+is treated as dead, so a count from before the restart does not drive the HVAC forever.
+"""
+async def expireRestored(cameras):
+	await asyncio.sleep(protocol.session_timeout)
+	for name in cameras:
+		if name not in device_sessions and name not in applied_sequence:
+			markDeviceDead(name)
+
+"""
+This function asks for the HVAC commands to be recomputed because a reading changed
+"""
+def requestHvacUpdate():
+	hvac_update_needed.set()
+
+"""
+This coroutine sends a session message of type kind with body payload to the
+session on sock. Messages to the same session are sent one at a time.
+"""
+async def sendSessionMessage(sock, kind, payload = b''):
+	loop = asyncio.get_running_loop()
+	lock = session_locks[sock]
+	if lock.locked():		# only time the wait when there is one, so the common case stays cheap
+		start = loop.time()
+		await lock.acquire()
+		session_lock_wait.observe(loop.time() - start)
+	else:
+		await lock.acquire()
+	try:
+		await loop.sock_sendall(sock, packMessage(kind, payload))
+	finally:
+		lock.release()
+
+"""
+This coroutine pushes the HVAC commands to every subscribed HVAC unit whenever
+they change after a reading changed, and every keepalive period regardless, so a
+unit that missed a command (or the controller going away) is noticed.
+"""
+async def hvacNotifier():
+	last_status = None
+	while True:
+		try:
+			await asyncio.wait_for(hvac_update_needed.wait(), protocol.hvac_keepalive_period)
+			keepalive = False
+		except asyncio.TimeoutError:
+			keepalive = True
+		hvac_update_needed.clear()
+
+		status = computeHvacStatus()
+		if status == last_status and not keepalive:		# nothing the HVAC unit needs to hear about
+			continue
+		last_status = status
+		log('hvac_push', "Pushing HVAC commands to {subscribers} subscribers. AC: {ac} heat: {heat}", subscribers = len(hvac_subscribers), ac = status[0], heat = status[1])
+		for sock in list(hvac_subscribers):
+			try:
+				await sendSessionMessage(sock, protocol.HVAC_STATUS, (status[0] + ' ' + status[1]).encode('utf-8'))
+			except (OSError, KeyError):		# the session ended, runSession cleans it up
+				hvac_subscribers.discard(sock)
+
+"""
+This function applies the json people count in count_data sent by the edge camera camera_handle
+"""
+def applyCount(camera_handle, count_data):
+	recordTrace(traceFile.COUNT, camera_handle, count_data)
+	count = json.loads(count_data)
+	edge_counts[camera_handle] = int(count['people'])
+	counts_received.inc()
+	frames_processed['edge'].inc()
+	applyDetection(camera_handle, next(frame_sequence), None, edge_counts[camera_handle], count.get('boxes', []))
+
+"""
+This function returns True if any device (a sensor, a camera or an HVAC unit) is
+registered as name. Sessions are looked up by name alone, so names must be unique across them.
+"""
+def isRegistered(name):
+	return state.hasSensor(name) or state.hasCamera(name) or name in hvac_units
+
+"""
+This function marks the device device_name as dead after its session timed out.
+A dead camera's room no longer counts any people, since its count can't be trusted anymore.
+"""
+def markDeviceDead(device_name):
+	dead_devices.add(device_name)
+	if state.setPeople(device_name, 0):
+		requestHvacUpdate()
+	print("Device ", device_name, " is not responding, treating it as dead")
+
+"""
+This coroutine serves the session of the device device_name on connected_socket.
+It handles each message the device sends until the device closes the session or
+goes quiet for longer than the session timeout.
+"""
+async def runSession(connected_socket, device_name):
+	loop = asyncio.get_running_loop()
+	old_session = device_sessions.get(device_name)
+	if old_session is not None:		# the device reconnected, its old session is dead
+		try:
+			old_session.shutdown(socket.SHUT_RDWR)		# wakes its task, which then closes it. Closing it here could let a new socket reuse the fd the event loop still watches
+		except OSError:		# already gone
+			pass
+	device_sessions[device_name] = connected_socket
+	session_locks[connected_socket] = asyncio.Lock()
+	dead_devices.discard(device_name)
+
+	try:
+		while True:
+			try:
+				message = await asyncio.wait_for(recvMessage(loop, connected_socket, stage_seconds['receive']), protocol.session_timeout)
+			except asyncio.TimeoutError:
+				if device_sessions.get(device_name) is connected_socket:		# a session the device replaced says nothing about the device
+					markDeviceDead(device_name)
+				return
+			if message is None:		# the device closed the session, or it was replaced by a newer one
+				if device_sessions.get(device_name) is connected_socket:
+					print("Session of ", device_name, " closed")
+				return
+			kind, payload = message
+
+			if kind == protocol.HEARTBEAT:
+				await sendSessionMessage(connected_socket, protocol.HEARTBEAT)
+			elif kind == protocol.TEMP_UPDATE:
+				applyTemperature(device_name, float(payload))
+				log('temperature', "Recieved updated temperature from {sensor}: {temp}", sensor = device_name.decode('utf-8'), temp = state.temp_sens_list[device_name])
+			elif kind == protocol.TEMP_BATCH:
+				samples = protocol.unpackTempBatch(payload)
+				await sendSessionMessage(connected_socket, protocol.ACK)		# the sensor can forget them now
+				applyTemperatureBatch(device_name, samples)
+				log('temperature', "Recieved {count} temperatures from {sensor}, the newest {temp}", count = len(samples), sensor = device_name.decode('utf-8'), temp = state.temp_sens_list.get(device_name))
+			elif kind == protocol.FRAME:
+				await sendSessionMessage(connected_socket, protocol.ACK)		# confirm the whole frame was received
+				frames_received.inc()
+				frame_bytes_received.inc(len(payload))
+				try:
+					await handleFrame(device_name, payload)
+				except ValueError as error:		# a corrupt frame should not end the session
+					print("Error while handling frame: ", error)
+			elif kind == protocol.CROP:
+				await sendSessionMessage(connected_socket, protocol.ACK)
+				frames_received.inc()
+				frame_bytes_received.inc(len(payload))
+				try:
+					await handleCrop(device_name, payload)
+				except ValueError as error:
+					print("Error while handling crop: ", error)
+			elif kind == protocol.COUNT:
+				await sendSessionMessage(connected_socket, protocol.ACK)
+				applyCount(device_name, payload)
+			elif kind == protocol.HVAC_POLL:
+				AC_status, heat_status = computeHvacStatus()
+				await sendSessionMessage(connected_socket, protocol.HVAC_STATUS, (AC_status + ' ' + heat_status).encode('utf-8'))
+			elif kind == protocol.HVAC_SUBSCRIBE:		# from now on the commands are pushed to this unit
+				hvac_subscribers.add(connected_socket)
+				AC_status, heat_status = computeHvacStatus()
+				await sendSessionMessage(connected_socket, protocol.HVAC_STATUS, (AC_status + ' ' + heat_status).encode('utf-8'))		# start it off with the current commands
+			else:
+				print("Unknown message kind ", kind, " from ", device_name)
+	finally:
+		hvac_subscribers.discard(connected_socket)
+		del session_locks[connected_socket]
+		if device_sessions.get(device_name) is connected_socket:
+			del device_sessions[device_name]
+
+"""
+This coroutine handles one jpeg frame, image_data, sent by the camera camera_handle.
+It reuses the cached or tracked people count when it can and hands the frame to the
+inference scheduler otherwise.
+"""
+async def handleFrame(camera_handle, image_data):
+	if not pipeline_ready.is_set():		# detection is still loading, keep the newest frame of each camera for when it is ready
+		waiting_frames[camera_handle] = image_data
+		return
+	loop = asyncio.get_running_loop()
+	received = loop.time()
+	recordTrace(traceFile.FRAME, camera_handle, image_data)
+	with stage_seconds['decode'].time():
+		image, frame_hash = await loop.run_in_executor(None, prepareFrame, camera_handle.decode('utf-8'), image_data)		# decode off the event loop
+
+	cached = frame_cache.lookup(camera_handle, frame_hash, loop.time())
+	if cached is not None:		# the frame barely changed since the last inference, reuse its result
+		log('cache_hit', "Frame matches the last one inferred, skipping inference. Cache hits: {hits} misses: {misses}", hits = frame_cache.hits, misses = frame_cache.misses)
+		frames_processed['cache'].inc()
+		people, boxes = cached
+		applyDetection(camera_handle, next(frame_sequence), image, people, boxes)
+		occupancy_latency.observe(loop.time() - received)
+		return
+
+	cadence = camera_detect_every.get(camera_handle, detect_every)
+	if cadence > 1:		# follow the people with the tracker and only run a full detection every few frames
+		tracker = trackers.get(camera_handle)
+		if tracker is None:
+			tracker = trackers[camera_handle] = RoomTracker(cadence)
+		with stage_seconds['track'].time():
+			tracked = await loop.run_in_executor(None, tracker.step, image)
+		if tracked is not None:
+			log('tracked', "Tracked people without detection")
+			frames_processed['tracker'].inc()
+			people, boxes = tracked
+			applyDetection(camera_handle, next(frame_sequence), image, people, boxes)
+			occupancy_latency.observe(loop.time() - received)
+			return
+		tracker.detection_pending = True		# keep sending this camera's frames to detection until the result is in
+
+	queueInference(camera_handle, (next(frame_sequence), image, frame_hash, received, None))
+
+"""
+This function hands the (sequence number, image, frame hash, time received, crop offset)
+of a frame from the camera camera_handle to the inference scheduler, replacing any older
+frame from this camera
+"""
+def queueInference(camera_handle, frame):
+	pending_frames[camera_handle] = frame
+	pending_since[camera_handle] = asyncio.get_running_loop().time()
+	frames_pending.set()
+	if len(pending_frames) >= max_batch_size:
+		batch_full.set()
+
+"""
+This coroutine handles a crop of a frame sent by the camera camera_handle, payload being
+the body of its CROP message. The crop is detected on its own and its people merged with
+the ones last seen in the rest of the frame, so it skips the frame cache and the tracker,
+which are then given the merged result.
+A crop is dropped if there is no whole frame of the camera yet to merge it into, or
+if a whole frame is still waiting for inference, since the crop would replace it. A crop
+that comes while a whole frame of its camera is being run is held until that frame is
+applied, so the crop is merged into it instead of the frame's result being thrown away
+as older than the crop.
+"""
+async def handleCrop(camera_handle, payload):
+	camera_name = camera_handle.decode('utf-8')
+	x, y, frame_width, frame_height, jpeg = protocol.unpackCrop(payload)
+	if not pipeline_ready.is_set():
+		log('crop_skipped', "Crop from {camera} came while detection is loading, skipping it", camera = camera_name)
+		return
+	recordTrace(traceFile.CROP, camera_handle, payload)
+	last = latest_frames.get(camera_name)
+	if camera_handle not in running_frames and (last is None or last[0].shape[:2] != (frame_height, frame_width)):
+		log('crop_skipped', "Crop from {camera} has no whole frame to merge into, skipping it", camera = camera_name)
+		return
+	if camera_handle in pending_frames and pending_frames[camera_handle][4] is None:
+		log('crop_skipped', "Crop from {camera} came while a whole frame waits for inference, skipping it", camera = camera_name)
+		return
+	loop = asyncio.get_running_loop()
+	received = loop.time()
+	with stage_seconds['decode'].time():
+		crop = await loop.run_in_executor(None, decodeFrame, camera_name, jpeg)		# decode off the event loop
+	frame = (next(frame_sequence), crop, None, received, (x, y))
+	if camera_handle in running_frames:		# wait for the whole frame being run, replacing any older crop held
+		held_crops[camera_handle] = frame
+	else:
+		queueInference(camera_handle, frame)
+
+"""
+This coroutine handles incoming connections. One is scheduled on the event
+loop for each new connection, so slow devices never hold up the others.
+"""
+async def onConnection(connected_socket):
+	loop = asyncio.get_running_loop()
+	connection_msg = await loop.sock_recv(connected_socket, 1024)	# first message sent will be update type
 
 	if connection_msg == b"temp_reg":	# if connected device is temp sensor registering itself
 		print("Temp sensor trying to register itself")
-		connected_socket.send(b'ack')	# tell device to proceed
+		await loop.sock_sendall(connected_socket, b'ack')	# tell device to proceed
 
 		while True:
-			temperature_handle = connected_socket.recv(1024)	# connected device will then send its preferred name
+			temperature_handle = await loop.sock_recv(connected_socket, 1024)	# connected device will then send its preferred name
 			print("Trying to register as: ", temperature_handle)
 
-			if temperature_handle not in temp_sens_list:		# if name not in use, accept it
+			if not isRegistered(temperature_handle):		# if name not in use, accept it
 				print("Name not in use, requesting temperature")
 
-				connected_socket.send(b'ack')		# add name to list with initial value and send confirmation
-				temp_sens_list[temperature_handle] = float(connected_socket.recv(1024))
-				temp_weight_list[temperature_handle] = 0
+				await loop.sock_sendall(connected_socket, b'ack')		# add name to list with initial value and send confirmation
+				temp = float(await loop.sock_recv(connected_socket, 1024))
+				if not state.registerSensor(temperature_handle, temp):		# another sensor took the name while we waited for the temperature
+					state.setTemperature(temperature_handle, temp)
+				history.record('temp', temperature_handle.decode('utf-8'), time.time(), temp)
+				recordTrace(traceFile.TEMP, temperature_handle, str(temp).encode('utf-8'))
+				requestHvacUpdate()
 
-				print("Registration successful, initial temperature: ", temp_sens_list[temperature_handle])
+				print("Registration successful, initial temperature: ", temp)
 				break;
 			else:
-				connected_socket.send(b'name in use')		# if name in use, notify other device and wait for new one
+				await loop.sock_sendall(connected_socket, b'name in use')		# if name in use, notify other device and wait for new one
 				print("Name already in use, requesting new one")
 
 	elif connection_msg == b"temp_update":		# if connected device is temp sensor with new data
-		print("Temp sensor trying to give update")
-		connected_socket.send(b'ack')		# tell device to proceed
+		log('temp_update', "Temp sensor trying to give update")
+		await loop.sock_sendall(connected_socket, b'ack')		# tell device to proceed
 
-		temperature_handle = connected_socket.recv(1024)	# get device name
-		print("Name of sensor trying to update: ", temperature_handle)
+		temperature_handle = await loop.sock_recv(connected_socket, 1024)	# get device name
+		log('temp_update_name', "Name of sensor trying to update: {sensor}", sensor = temperature_handle.decode('utf-8', 'replace'))
+
+		await loop.sock_sendall(connected_socket, b'ack')		# send confirmation
+		applyTemperature(temperature_handle, float(await loop.sock_recv(connected_socket, 1024)))
+		log('temperature', "Recieved updated temperature from {sensor}: {temp}", sensor = temperature_handle.decode('utf-8'), temp = state.temp_sens_list[temperature_handle])
 
-		connected_socket.send(b'ack')		# send confirmation
-		temp_sens_list[temperature_handle] = float(connected_socket.recv(1024))		# update temp of that temp sensor
-		print("Recieved updated temperature: ", temp_sens_list[temperature_handle])
-	
 	elif connection_msg == b"cam_reg":	# if connected device is temp sensor registering itself
 		print("Camera trying to register itself")
-		connected_socket.send(b'ack')	# tell device to proceed
+		await loop.sock_sendall(connected_socket, b'ack')	# tell device to proceed
 
 		while True:
-			camera_handle = connected_socket.recv(1024)	# connected device will then send its preferred name
+			camera_handle = await loop.sock_recv(connected_socket, 1024)	# connected device will then send its preferred name
 			print("Trying to register as: ", camera_handle)
 
-			if camera_handle not in camera_list:		# if name not in use, accept it
+			if not isRegistered(camera_handle):		# if name not in use, accept it
 				print("Name not in use, requesting associated temp sensor")
 
-				connected_socket.send(b'ack')		# add name to list with initial value and send confirmation
+				await loop.sock_sendall(connected_socket, b'ack')		# add name to list with initial value and send confirmation
 				while True:
-					temp_sensor = connected_socket.recv(1024)	# connected device will then send its temp sensor
-					if temp_sensor not in temp_sens_list:
-						print("Invalid temperature sensor selected. Requesting new one.")
-						connected_socket.send(b'sensor not found')
-					elif temp_sensor in camera_list.values():
-						print("Temperature sensor already in use. Requesting new one.")
-						connected_socket.send(b'sensor in use')
+					temp_sensor = await loop.sock_recv(connected_socket, 1024)	# connected device will then send its temp sensor
+					error = state.registerCamera(camera_handle, temp_sensor)		# checks the sensor exists and has no camera yet
+					if error is not None:
+						print("Could not use that temperature sensor (", error, "). Requesting new one.")
+						await loop.sock_sendall(connected_socket, error.encode('utf-8'))
 					else:
 						print("Successfully associated with a temp sensor")
-						camera_list[camera_handle] = temp_sensor
-						connected_socket.send(b'ack')
+						recordTrace(traceFile.PAIR, camera_handle, temp_sensor)
+						requestHvacUpdate()
+						await loop.sock_sendall(connected_socket, b'ack')
 						break
 
 				print("Registration of camera successful. Name: ", camera_handle)
-				threading.Thread(target = displayImages, args = (camera_handle.decode('utf-8')+'annotated.jpg', )).start()		# spin off another thread to display the input from this camera
 				break
 			else:
-				connected_socket.send(b'name in use')		# if name in use, notify other device and wait for new one
+				await loop.sock_sendall(connected_socket, b'name in use')		# if name in use, notify other device and wait for new one
 				print("Name already in use, requesting new one")
 
 	elif connection_msg == b"cam_update":
-		print("Camera is sending a new frame")
-		connected_socket.send(b'ack')
+		log('cam_update', "Camera is connecting to send frames")
+		await loop.sock_sendall(connected_socket, b'ack')
 
-		camera_handle = connected_socket.recv(1024)			# get the handle of the device that is sent
-		print("Camera sending frame identified as: ", camera_handle)
-		connected_socket.send(b'ack')
+		camera_handle = await loop.sock_recv(connected_socket, 1024)			# get the handle of the device that is sent
+		log('cam_update_name', "Camera sending frame identified as: {camera}", camera = camera_handle.decode('utf-8', 'replace'))
+		await loop.sock_sendall(connected_socket, b'ack')
 
-		image_file_name = connected_socket.recv(1024).decode(encoding='utf-8')		# get the file name from the device
-		print("File name of frame identified as: ", image_file_name)
-		connected_socket.send(b'ack')
+		while True:		# the camera keeps the connection open and sends one frame after another
+			image_data = await recvFrame(loop, connected_socket, stage_seconds['receive'])		# each frame arrives as a size header followed by the jpeg bytes
+			if image_data is None:		# the camera closed the connection
+				break
+			await loop.sock_sendall(connected_socket, b'ack')		# confirm the whole frame was received
+			frames_received.inc()
+			frame_bytes_received.inc(len(image_data))
+			log('frame_received', "Frame recieved from {camera}, size: {size}", camera = camera_handle.decode('utf-8'), size = len(image_data))
+			try:
+				await handleFrame(camera_handle, image_data)
+			except ValueError as error:		# a corrupt frame should not end the connection
+				print("Error while handling frame: ", error)
 
-		f = open(image_file_name, 'wb')
-		while True:		# read data from pipe in blocks of 1024 bytes, stop when we reach empty block
-			msg = connected_socket.recv(1024)
-			if msg == b'EOF':		# check if we have read all data
+	elif connection_msg == b"cam_count":		# a camera in edge mode sending the people it counted itself
+		log('cam_count', "Camera is connecting to send people counts")
+		await loop.sock_sendall(connected_socket, b'ack')
+
+		camera_handle = await loop.sock_recv(connected_socket, 1024)			# get the handle of the device that is sent
+		log('cam_count_name', "Camera sending counts identified as: {camera}", camera = camera_handle.decode('utf-8', 'replace'))
+		await loop.sock_sendall(connected_socket, b'ack')
+
+		while True:		# the camera keeps the connection open and sends one count after another
+			count_data = await recvFrame(loop, connected_socket)		# each count is a small json object, framed like the images
+			if count_data is None:		# the camera closed the connection
 				break
-			f.write(msg)
-			connected_socket.send(b'ack')
-		print("File recieved and stored")
-		f.close()
-
-		results = model.predict(image_file_name, classes = 0)	# run inference on image and only detect people, class 0 is person
-		
-		im_array = results[0].plot()  # plot a BGR numpy array of predictions
-		im = Image.fromarray(im_array[..., ::-1])  # RGB PIL image
-		im.save(image_file_name[:len(image_file_name)-4]+"annotated.jpg")  # save image
-		newImage.set()			# tell display thread it must update the image
-
-		# haphazard way display image with bounding boxes (for debugging only, this will keep making new windows and never delete them)
-		# results[len(results)-1].show(image_file_name)
-		
-		# get the 'person' class id
-		names = model.names
-		person_id = list(names)[list(names.values()).index('person')]
-
-		# count the boxes it drew for "person", this is how many people it found in the image
-		people_detected = results[0].boxes.cls.tolist().count(person_id)
-		print("People detected: ", people_detected)
-
-		# update the list
-		temp_sensor = camera_list[camera_handle]
-		temp_weight_list[temp_sensor] = people_detected
+			await loop.sock_sendall(connected_socket, b'ack')
+			applyCount(camera_handle, count_data)
 
-	elif connection_msg == b'hvac_poll':		# if the connection is hvac control unit asking for an update
+	elif connection_msg == b'hvac_reg':		# an HVAC unit registering itself
+		await loop.sock_sendall(connected_socket, b'ack')
+		hvac_name = await loop.sock_recv(connected_socket, 1024)
+		if state.hasSensor(hvac_name) or state.hasCamera(hvac_name):
+			print("HVAC unit name already in use: ", hvac_name)
+			await loop.sock_sendall(connected_socket, b'name in use')
+		else:
+			hvac_units.add(hvac_name)		# registering again is fine, the unit does it every time it connects
+			await loop.sock_sendall(connected_socket, b'ack')
 
-		# now that something may have changed, we must compute the current weighted temperature
-		total_people = 0;		# the total people detected in all rooms
-		for i in temp_weight_list:
-			print(temp_weight_list[i])
-			total_people += temp_weight_list[i]
-		print("The total number of people found is: ", total_people)
-
-		target = update_target_temp()		# make sure our target temperature is updated
-		print("Current target temp is: ", target)
-		if total_people == 0:		# if there are no people, turn off the heater and AC
-			AC_status = 'OFF'
-			heat_status = 'OFF'
+	elif connection_msg == b'session':		# a device opening a long lived session
+		await loop.sock_sendall(connected_socket, b'ack')
+		device_name = await loop.sock_recv(connected_socket, 1024)		# the session belongs to the device with this name
+		if not isRegistered(device_name):
+			print("Refusing a session for a device that is not registered: ", device_name)
+			await loop.sock_sendall(connected_socket, b'not registered')
 		else:
-			current_temp = 0
-			for i in camera_list.values():
-				current_temp += temp_sens_list[i]*(temp_weight_list[i]/total_people)
-			print("The current weighted temperature is: ", current_temp)
-
-			if current_temp < target:	# update AC and heat commands based on if we need to cool down or heat up
-				AC_status = "OFF"
-				heat_status = 'ON'
-			elif current_temp > target:
-				AC_status = "ON"
-				heat_status = "OFF"
-			else:
-				AC_status = 'OFF'
-				heat_status = 'OFF'
+			print("Device opening a session: ", device_name)
+			await loop.sock_sendall(connected_socket, b'ack')
+			await runSession(connected_socket, device_name)
+
+	elif connection_msg == b'hvac_poll':		# if the connection is hvac control unit asking for an update
 
-		print("Sending AC update: ", AC_status)
-		connected_socket.send(AC_status.encode('utf-8'))
+		AC_status, heat_status = computeHvacStatus()
+		log('hvac_poll_ac', "Sending AC update: {status}", status = AC_status)
+		await loop.sock_sendall(connected_socket, AC_status.encode('utf-8'))
 
-		if(connected_socket.recv(1024) != b'ack'):
+		if(await loop.sock_recv(connected_socket, 1024) != b'ack'):
 			print("Error in sending AC update, closing connection")
 			connected_socket.close()
 			return
 
-		print("Sending heater update: ", heat_status)
-		connected_socket.send(heat_status.encode('utf-8'))
+		log('hvac_poll_heat', "Sending heater update: {status}", status = heat_status)
+		await loop.sock_sendall(connected_socket, heat_status.encode('utf-8'))
 
 	connected_socket.close()	# close connection
 
-control_socket = socket.socket()	# create socket to listen for information
+"""
+This coroutine wraps onConnection so that a device dropping its connection
+or sending garbage only ends its own connection instead of the whole server.
+"""
+async def handleConnection(connected_socket):
+	active_connections.inc()
+	try:
+		await onConnection(connected_socket)
+	except (OSError, ValueError, KeyError) as error:
+		print("Error while handling connection: ", error)
+	finally:
+		connected_socket.close()
+		active_connections.dec()
+
+"""
+This function returns the history of the readings of kind from name with start <= time < end
+at resolution as json bytes: their times and values along with their summary from aggregate
+"""
+def historyJson(kind, name, start, end, resolution):
+	times, values = history.query(kind, name, start, end, resolution)
+	return json.dumps({'kind': kind, 'name': name, 'start': start, 'end': end, 'resolution': resolution,
+		'times': times.tolist(), 'values': values.tolist(), 'summary': history.aggregate(kind, name, start, end, resolution)}).encode('utf-8')
+
+"""
+This coroutine answers a request for /history with the history of one reading, chosen
+by the kind, name, start, end and resolution query parameters, or with the list of
+readings there is history of if no kind and name are given
+"""
+async def sendHistory(writer, path):
+	query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+	kind = query.get('kind', [None])[0]
+	name = query.get('name', [None])[0]
+	if kind is None or name is None:
+		readings = [{'kind': series_kind, 'name': series_name} for series_kind, series_name in sorted(history.names())]
+		await sendResponse(writer, 200, 'application/json', json.dumps(readings).encode('utf-8'))
+		return
+	resolution = query.get('resolution', ['raw'])[0]
+	try:
+		end = float(query.get('end', [time.time()])[0])
+		start = float(query.get('start', [end - 3600])[0])
+	except ValueError:
+		await sendResponse(writer, 400, 'text/plain', b'start and end must be seconds since the epoch\n')
+		return
+	if resolution != 'raw' and resolution not in resolutions:
+		await sendResponse(writer, 400, 'text/plain', b'resolution must be raw, minute or hour\n')
+		return
+	body = await asyncio.get_running_loop().run_in_executor(None, historyJson, kind, name, start, end, resolution)		# a long range takes a while to copy and encode
+	await sendResponse(writer, 200, 'application/json', body)
+
+"""
+This coroutine answers a request for the metrics with all of them in the Prometheus text format
+"""
+async def sendMetrics(writer, path):
+	await sendResponse(writer, 200, 'text/plain; version=0.0.4', metrics.render().encode('utf-8'))
+
+"""
+This function returns the jpeg bytes of the BGR image with the person boxes drawn on it
+"""
+def encodeAnnotated(image, boxes):
+	ok, jpeg = cv2.imencode('.jpg', drawBoxes(image.copy(), boxes))
+	return jpeg.tobytes()
+
+"""
+This coroutine returns the latest frame of the camera camera_name with its boxes
+drawn as a jpeg. The jpeg is encoded once per frame however many viewers there are.
+"""
+async def annotatedJpeg(camera_name):
+	version = frame_versions[camera_name]
+	cached = annotated_frames.get(camera_name)
+	if cached is not None and cached[0] == version:
+		return cached[1]
+	image, boxes = latest_frames[camera_name]
+	jpeg = await asyncio.get_running_loop().run_in_executor(None, encodeAnnotated, image, boxes)		# drawing and encoding stay off the event loop
+	annotated_frames[camera_name] = (version, jpeg)
+	return jpeg
+
+"""
+This coroutine answers a request for /stream/<camera name> with an MJPEG stream of
+the camera's annotated frames, sending each new frame until the viewer goes away.
+A request for /stream/ gets the list of cameras instead.
+"""
+async def sendStream(writer, path):
+	camera_name = urllib.parse.unquote(path.split('?')[0][len('/stream/'):])
+	if not camera_name:
+		links = ''.join('<li><a href="/stream/' + urllib.parse.quote(name) + '">' + html.escape(name) + '</a></li>' for name in sorted(latest_frames))
+		await sendResponse(writer, 200, 'text/html', ('<html><body><h1>Cameras</h1><ul>' + links + '</ul></body></html>').encode('utf-8'))
+		return
+	if camera_name not in latest_frames:
+		await sendResponse(writer, 404, 'text/plain', b'no frames from that camera yet\n')
+		return
+
+	loop = asyncio.get_running_loop()
+	writer.write(('HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=' + stream_boundary + '\r\n'
+		+ 'Cache-Control: no-cache\r\nConnection: close\r\n\r\n').encode('latin-1'))
+	while True:
+		jpeg = await annotatedJpeg(camera_name)
+		writer.write(('--' + stream_boundary + '\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(jpeg)) + '\r\n\r\n').encode('latin-1') + jpeg + b'\r\n')
+		await writer.drain()		# raises once the viewer goes away, which ends the stream
+		watchers = frame_watchers.get(camera_name)
+		if watchers is None:
+			watchers = frame_watchers[camera_name] = loop.create_future()
+		await asyncio.shield(watchers)		# wait for the camera's next frame, shielded so one viewer leaving does not cancel it for the others
+
+"""
+This function imports the libraries that are only needed to handle frames. They
+take seconds to import on a raspberry pi, so it is run in the background at startup.
+"""
+def importPipeline():
+	global cv2, FrameCache, frameHash, InferencePool, RoomTracker
+	import cv2
+	from frameCache import FrameCache, frameHash
+	from inferencePool import InferencePool
+	from tracker import RoomTracker
 
-if len(sys.argv) < 2:		# if no port specified, use default
-	print("Usage: <Port number>")
-	sys.exit(0)
-else:				# else use specified port
-	print("Using specified port: " + sys.argv[1])
-	port = int(sys.argv[1])
+"""
+This function records that the startup phase phase finished after seconds seconds
+"""
+def startupPhase(phase, seconds):
+	startup_seconds[phase].set(seconds)
+	print("Startup phase ", phase, " took ", round(seconds*1000), " ms")
 
-control_socket.bind(('', port))		# bind socket
-control_socket.listen(5)
+"""
+This coroutine loads everything needed to detect people in the background while the
+controller already serves the other devices: the libraries, the model (exported for
+backend first if needed) in every one of the workers and a warm up inference. It then
+starts the inference scheduler and handles the frames that arrived in the meantime.
+"""
+async def startPipeline(workers, backend, model, int8):
+	global inference_pool, frame_cache, scheduler_task
+	loop = asyncio.get_running_loop()
+	try:
+		start = time.perf_counter()
+		await loop.run_in_executor(None, importPipeline)
+		startupPhase('imports', time.perf_counter() - start)
 
-hostname = socket.gethostname()	# get and print hostname
-print(hostname)
+		start = time.perf_counter()
+		model_path = await loop.run_in_executor(None, exportModel, backend, model, int8, calibration_dir)		# export once here so the workers do not all try to do it
+		startupPhase('model_export', time.perf_counter() - start)
 
-IPAddr = socket.gethostbyname(hostname)		# get and print IP address
-print(IPAddr)
+		start = time.perf_counter()
+		frame_cache = FrameCache(dedup_distance, dedup_ttl)
+		inference_pool = InferencePool(workers, backend, model_path, block_size)
+		await inference_pool.warmUp(numpy.zeros((480, 640, 3), dtype = numpy.uint8))		# loads the model in every worker and pays for the first, slow inference
+		startupPhase('model_warmup', time.perf_counter() - start)
+	except Exception as error:		# the other devices are still served, only frames can't be handled
+		print("Error while loading detection, frames will not be handled: ", error)
+		return
+
+	scheduler_task = loop.create_task(inferenceScheduler())		# runs for as long as the server does
+	pipeline_ready.set()
+	startupPhase('ready', time.perf_counter() - startup_begin)
+	print("Detection ready, handling ", len(waiting_frames), " frames that arrived while loading")
+	for camera_handle in list(waiting_frames):
+		try:
+			await handleFrame(camera_handle, waiting_frames.pop(camera_handle))
+		except ValueError as error:		# a corrupt frame should not keep the others from being handled
+			print("Error while handling frame: ", error)
 
 """
-This method displays the image given by file_name with
-the bounding boxes drawn. It is meant to be called in a separate
-thread with one thread per camera. It uses the newImage variable to determine
-when the image must be updated.
+This coroutine starts loading the detection pipeline with the given number of
+workers, each running model on backend, in the background, then accepts connections
+on control_socket forever and schedules a handler task on the event loop for each of them.
 """
-def displayImages(file_name):
-	print("Showing image")
+async def serve(control_socket, workers, backend, model, int8):
+	global setpoints
+	loop = asyncio.get_running_loop()
+	pipeline_task = loop.create_task(startPipeline(workers, backend, model, int8))
+	setpoints = SetpointWatcher(target_temp_file, onSetpointChange)
+	setpoint_task = loop.create_task(setpoints.watch())
+	snapshot_task = loop.create_task(snapshotWriter())
+	state_task = loop.create_task(stateFlusher())
+	restored_task = loop.create_task(expireRestored(list(state.camera_list)))		# no device has connected yet, so these are the restored cameras
+	notifier_task = loop.create_task(hvacNotifier())
+	if metrics_port:
+		http_server = await startHttpServer(metrics_host, metrics_port, {'/metrics': sendMetrics, '/stream/': sendStream, '/history': sendHistory})
+		print("Serving metrics on http://" + metrics_host + ":" + str(metrics_port) + "/metrics, camera streams on /stream/ and the history on /history")
+	startupPhase('listen', time.perf_counter() - startup_begin)
 	while True:
-		if(newImage.is_set()):		# if the image has changed, we need to update it
-			newImage.clear()
-			annotated_frame = cv2.imread(file_name)		# get the annotated image
-			cv2.imshow("Camera", annotated_frame)		# display image
+		client_socket, addr = await loop.sock_accept(control_socket)	# wait for an update
+
+		log('connection', "Connection accepted from: {address}", address = addr)
+		task = loop.create_task(handleConnection(client_socket))		# handle the connection on the event loop since more may come in meanwhile
+		connection_tasks.add(task)
+		task.add_done_callback(connection_tasks.discard)
+
+# only start the server when run as a script, the inference workers import this file's dependencies but must not start another server
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Control hub for the smart thermostat")
+	parser.add_argument('port', type = int, help = "the port to listen on")
+	parser.add_argument('--workers', type = int, default = 0, help = "the number of inference worker processes, 0 runs inference in the controller process")
+	parser.add_argument('--backend', choices = backends, default = 'torch', help = "the inference backend used to detect people")
+	parser.add_argument('--model', default = default_model_path, help = "the model to load, a .pt model is exported for the onnx and openvino backends")
+	parser.add_argument('--int8', action = 'store_true', help = "use an INT8 quantized export of the model (onnx and openvino backends)")
+	parser.add_argument('--calibration', metavar = 'IMAGE_DIR', help = "the camera frames an INT8 ONNX export is calibrated on")
+	parser.add_argument('--dedup-distance', type = int, default = 4, help = "the most bits a frame's hash may differ from the last inferred frame of its camera to reuse its result")
+	parser.add_argument('--dedup-ttl', type = float, default = 30.0, help = "the seconds a result may be reused for similar frames, 0 turns the frame cache off")
+	parser.add_argument('--detect-every', type = int, default = 1, help = "run full detection on one frame in this many per camera and track people in between, 1 detects on every frame")
+	parser.add_argument('--camera-detect-every', action = 'append', default = [], metavar = 'CAMERA=N', help = "set the detection cycle of one camera, can be given more than once")
+	parser.add_argument('--history', default = history_file, help = "the file the temperature and occupancy history is snapshotted to and loaded from")
+	parser.add_argument('--snapshot-period', type = float, default = snapshot_period, help = "how often (in seconds) the history is snapshotted")
+	parser.add_argument('--state', default = state_file, help = "the database the registered devices and their latest readings are saved to and loaded from")
+	parser.add_argument('--state-flush-period', type = float, default = state_flush_period, help = "how often (in seconds) changed devices and readings are written to the database")
+	parser.add_argument('--metrics-port', type = int, default = metrics_port, help = "the port the metrics and camera streams are served on, 0 turns them off")
+	parser.add_argument('--metrics-host', default = metrics_host, help = "the address the metrics and camera streams are served on, 0.0.0.0 to allow other computers")
+	parser.add_argument('--log-sample-rate', type = float, help = "log this fraction (0 to 1) of the per message events as json lines instead of printing every one")
+	parser.add_argument('--record', metavar = 'TRACE', help = "append everything received and every HVAC decision to the trace file TRACE, for replay.py")
+	parser.add_argument('--self-check', metavar = 'IMAGE_DIR', help = "compare the people counted by the backend against the PyTorch model on the images in IMAGE_DIR, then exit")
+	args = parser.parse_args()
+	calibration_dir = args.calibration
+
+	if args.self_check is not None:
+		reference_path = args.model if args.model.endswith('.pt') else default_model_path
+		mismatches = selfCheck(Detector(args.backend, exportModel(args.backend, args.model, args.int8, calibration_dir)), reference_path, args.self_check)
+		sys.exit(1 if mismatches else 0)
+	print("Using specified port: " + str(args.port))
+	control_socket = socket.socket()	# create socket to listen for information
+	control_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)	# allow restarting the controller without waiting for old connections to time out
+	control_socket.bind(('', args.port))		# bind socket
+	control_socket.listen(socket.SOMAXCONN)		# use the largest backlog the OS allows so bursts of devices are not refused, connections wait here until the event loop accepts them
+	control_socket.setblocking(False)		# the event loop requires a non-blocking socket
 
-		# Break the loop if 'q' is pressed
-		if cv2.waitKey(1) == ord("q"):
-			break
+	dedup_distance = args.dedup_distance
+	dedup_ttl = args.dedup_ttl
+	detect_every = args.detect_every
+	for setting in args.camera_detect_every:
+		camera_name, _, cadence = setting.rpartition('=')
+		if not camera_name or not cadence.isdigit():
+			parser.error("--camera-detect-every expects CAMERA=N, got " + setting)
+		camera_detect_every[camera_name.encode('utf-8')] = int(cadence)
+	history_file = args.history
+	metrics_port = args.metrics_port
+	metrics_host = args.metrics_host
+	if args.log_sample_rate is not None:
+		metrics.configureLogging(args.log_sample_rate)
+	if args.record is not None:
+		trace_writer = TraceWriter(args.record)
+		print("Recording a trace to ", args.record)
+	snapshot_period = args.snapshot_period
+	if os.path.exists(history_file):		# carry on the history from the last run
+		history.load(history_file)
+		print("Loaded history of ", len(history.names()), " readings from ", history_file)
+	state_flush_period = args.state_flush_period
+	load_start = time.perf_counter()
+	state_store = StateStore(args.state)
+	sensor_count, camera_count = state_store.load(state)		# before the listener is set, so loading writes nothing back
+	state.listener = state_store
+	startupPhase('state_load', time.perf_counter() - load_start)
+	print("Restored ", sensor_count, " temperature sensors and ", camera_count, " cameras from ", args.state)
+	recordState()		# the trace was opened before the state was restored
 
-while True:
-	client_socket, addr = control_socket.accept()	# wait for an update
+	hostname = socket.gethostname()	# get and print hostname
+	print(hostname)
 
-	print("Connection accepted from: ", addr)
-	threading.Thread(target = onConnection, args = (client_socket,)).start()	# spin off a thread to handle connection since more may come in meanwhile
-																					# add comma in argument to make it a tuple
+	IPAddr = socket.gethostbyname(hostname)		# get and print IP address
+	print(IPAddr)
 
-socket.close()
-cv2.destroyAllWindows()		# destroy the windows
\ No newline at end of file
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))		# stop like on ctrl-c, so the cleanup below runs when a service manager or benchmark.py stops the controller
+	try:
+		asyncio.run(serve(control_socket, args.workers, args.backend, args.model, args.int8))
+	finally:
+		control_socket.close()
+		saveSnapshot(history_file, history.snapshot())		# keep the history gathered since the last snapshot
+		state_store.close()		# write the changes since the last flush
+		if trace_writer is not None:
+			trace_writer.close()
+		if inference_pool is not None:
+			inference_pool.close()
@@ -0,0 +1,189 @@
+import threading
+"""
+Author: Lucas Vanderheijden
+
+This file holds the state the controller keeps about the rooms: the temperature
+of each temperature sensor, the camera paired with it and the number of people
+the camera sees.
+
+The weighted temperature (the average temp of each room weighted by the # people
+detected in the room) is kept up to date incrementally. A running total of people
+and a running sum of temperature times people are adjusted on every update, so
+working out the weighted temperature and the HVAC commands takes the same time no
+matter how many rooms are registered. A reverse index from temperature sensor to
+camera makes checking whether a sensor already has a camera just as cheap.
+
+A listener (like the StateStore in stateStore.py) can be given to be told about
+every sensor and camera that changes, so it can save them.
+
+Each room can have its own target temperature. The target the HVAC aims for is
+the average target of the rooms weighted by their people the same way, kept up
+to date with its own running sum.
+"""
+
+"""
+This function returns the (AC_status, heat_status) commands that bring the
+weighted temperature current_temp to target. current_temp is None when nobody
+is in any room and target is None when no target was set, in either case the
+heater and AC are turned off.
+"""
+def decide(current_temp, target):
+	if current_temp is None or target is None:		# if there are no people, turn off the heater and AC
+		return 'OFF', 'OFF'
+	if current_temp < target:	# update AC and heat commands based on if we need to cool down or heat up
+		return 'OFF', 'ON'
+	elif current_temp > target:
+		return 'ON', 'OFF'
+	return 'OFF', 'OFF'
+
+"""
+This class holds the registered devices and their latest readings
+"""
+class ControllerState:
+
+	"""
+	listener, if given, has its sensorChanged(name, temp) called whenever a sensor's
+	temperature changes and its cameraChanged(name, sensor, people) whenever a camera is
+	paired or the people it sees change
+	"""
+	def __init__(self, listener = None):
+		self.listener = listener
+		self.lock = threading.Lock()		# updates can come from the event loop and from executor threads
+		self.temp_sens_list = {}	# the dictionary of registered temperature sensor names and their associated temperatures
+		self.temp_weight_list = {}	# the dictionary of registered temperature sensor names and the number of people detected in their room
+		self.camera_list = {}		# the dictionary of registered cameras and their associated temperature sensors
+		self.sensor_cameras = {}	# the reverse of camera_list, temperature sensor names and the camera paired with them
+		self.total_people = 0		# the total people detected in all rooms
+		self.weighted_sum = 0.0		# the sum over all rooms of temperature times the people detected in the room
+		self.default_target = None		# the target temperature of rooms without their own
+		self.zone_targets = {}		# the dictionary of temperature sensor names and the target temperature of their room
+		self.targeted_people = 0		# the people detected in rooms that have a target temperature
+		self.target_sum = 0.0		# the sum over all rooms with a target of target temperature times the people detected in the room
+
+	"""
+	This function registers the temperature sensor name with its first reading temp.
+	It returns False if the name is already in use.
+	"""
+	def registerSensor(self, name, temp):
+		with self.lock:
+			if name in self.temp_sens_list:
+				return False
+			self.temp_sens_list[name] = temp
+			self.temp_weight_list[name] = 0
+			if self.listener is not None:
+				self.listener.sensorChanged(name, temp)
+			return True
+
+	"""
+	This function returns True if the temperature sensor name is registered
+	"""
+	def hasSensor(self, name):
+		return name in self.temp_sens_list
+
+	"""
+	This function stores the new reading temp of the temperature sensor name
+	"""
+	def setTemperature(self, name, temp):
+		with self.lock:
+			people = self.temp_weight_list.setdefault(name, 0)
+			old_temp = self.temp_sens_list.get(name, 0.0)
+			self.temp_sens_list[name] = temp
+			self.weighted_sum += (temp - old_temp)*people
+			if self.listener is not None:
+				self.listener.sensorChanged(name, temp)
+
+	"""
+	This function returns True if the camera name is registered
+	"""
+	def hasCamera(self, name):
+		return name in self.camera_list
+
+	"""
+	This function pairs the camera name with the temperature sensor temp_sensor. It returns
+	None on success, or the reason it failed: 'sensor not found' or 'sensor in use'.
+	"""
+	def registerCamera(self, name, temp_sensor):
+		with self.lock:
+			if temp_sensor not in self.temp_sens_list:
+				return 'sensor not found'
+			if temp_sensor in self.sensor_cameras:
+				return 'sensor in use'
+			self.camera_list[name] = temp_sensor
+			self.sensor_cameras[temp_sensor] = name
+			if self.listener is not None:
+				self.listener.cameraChanged(name, temp_sensor, self.temp_weight_list[temp_sensor])
+			return None
+
+	"""
+	This function stores that the camera name sees people people in its room.
+	It returns False if the camera is not registered.
+	"""
+	def setPeople(self, name, people):
+		with self.lock:
+			temp_sensor = self.camera_list.get(name)
+			if temp_sensor is None:
+				return False
+			change = people - self.temp_weight_list[temp_sensor]
+			self.temp_weight_list[temp_sensor] = people
+			self.total_people += change
+			if self.total_people == 0:
+				self.weighted_sum = 0.0		# nobody left, so start the sum again from exactly zero instead of carrying rounding errors
+			else:
+				self.weighted_sum += self.temp_sens_list[temp_sensor]*change
+			target = self.targetOf(temp_sensor)
+			if target is not None:
+				self.targeted_people += change
+				if self.targeted_people == 0:
+					self.target_sum = 0.0
+				else:
+					self.target_sum += target*change
+			if self.listener is not None and change:
+				self.listener.cameraChanged(name, temp_sensor, people)
+			return True
+
+	"""
+	This returns the target temperature of the room of the temperature sensor name, or None if it has none
+	"""
+	def targetOf(self, name):
+		return self.zone_targets.get(name, self.default_target)
+
+	"""
+	This function sets the target temperatures to default for every room and to the
+	dictionary zones of temperature sensor names and targets for the rooms that have their own
+	"""
+	def setTargets(self, default, zones):
+		with self.lock:
+			self.default_target = default
+			self.zone_targets = dict(zones)
+			self.targeted_people = 0		# targets change rarely, so the sum is simply rebuilt
+			self.target_sum = 0.0
+			for name, people in self.temp_weight_list.items():
+				target = self.targetOf(name)
+				if target is not None and people:
+					self.targeted_people += people
+					self.target_sum += target*people
+
+	"""
+	This function returns the target temperature weighted by the people in each room,
+	the default target if nobody is in any room, or None if there is no target at all
+	"""
+	def weightedTarget(self):
+		with self.lock:
+			if self.targeted_people == 0:
+				return self.default_target
+			return self.target_sum/self.targeted_people
+
+	"""
+	This function returns the weighted temperature, or None if nobody is in any room
+	"""
+	def weightedTemperature(self):
+		with self.lock:
+			if self.total_people == 0:
+				return None
+			return self.weighted_sum/self.total_people
+
+	"""
+	This function returns the (AC_status, heat_status) commands for the weighted target temperature
+	"""
+	def hvacStatus(self):
+		return decide(self.weightedTemperature(), self.weightedTarget())
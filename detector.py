@@ -0,0 +1,221 @@
+import os
+import time
+"""
+Author: Lucas Vanderheijden
+
+This file holds the person detector used by the controller. The detector can
+run on one of several backends while keeping the same interface: a list of BGR
+frames goes in and the number of people and person boxes of each frame come out.
+
+The backends are:
+	torch		the PyTorch YOLOv8 model (a .pt file), the original behaviour
+	onnx		an ONNX export of the model run with ONNX Runtime
+	openvino	an OpenVINO export of the model
+
+The onnx and openvino backends are usually much faster on a CPU only controller
+and can use an INT8 quantized model to cut latency and memory further. If they are
+given a .pt file it is exported (and quantized if asked) once and the export is
+reused on the next start.
+
+INT8 models are quantized statically: the scale of every activation is worked out
+ahead of time from calibration images, so the convolutions run fully in INT8. (Dynamic
+quantization only helps models like RNNs and transformers, on a CNN like YOLO it is
+usually no faster.) OpenVINO calibrates on a sample dataset ultralytics downloads,
+while ONNX is calibrated on a directory of frames from the cameras, which should be
+a few dozen images showing the rooms as they usually look.
+
+This file requires the YOLOv8 model and its dependancies to run. Information can be
+found here: https://docs.ultralytics.com/quickstart/
+The onnx backend also needs onnxruntime and the openvino backend needs openvino.
+"""
+
+backends = ['torch', 'onnx', 'openvino']		# the backends the detector can run on
+image_size = 640		# the input size of the model, yolov8n is trained at 640 pixels
+max_calibration_images = 100		# the most images used to calibrate an INT8 ONNX model, more only makes quantizing slower
+
+"""
+This function returns the BGR image as the model's input: resized to fit image_size
+keeping its shape, padded to a square with gray like ultralytics does, and turned into
+a 1x3xHxW RGB float array scaled to 0-1
+"""
+def modelInput(image):
+	import cv2
+	import numpy
+	height, width = image.shape[:2]
+	scale = image_size/max(height, width)
+	resized = cv2.resize(image, (round(width*scale), round(height*scale)), interpolation = cv2.INTER_LINEAR)
+	padded = numpy.full((image_size, image_size, 3), 114, dtype = numpy.uint8)
+	top, left = (image_size - resized.shape[0])//2, (image_size - resized.shape[1])//2
+	padded[top:top+resized.shape[0], left:left+resized.shape[1]] = resized
+	return numpy.ascontiguousarray(padded[:, :, ::-1].transpose(2, 0, 1)[None], dtype = numpy.float32)/255
+
+"""
+This class feeds the images in a directory to ONNX Runtime's static quantization, one at a time
+"""
+class CalibrationReader:
+
+	def __init__(self, onnx_path, image_dir):
+		import onnxruntime
+		self.input_name = onnxruntime.InferenceSession(onnx_path, providers = ['CPUExecutionProvider']).get_inputs()[0].name
+		self.files = [os.path.join(image_dir, file_name) for file_name in sorted(os.listdir(image_dir))][:max_calibration_images]
+
+	"""
+	This returns the next image as the model's input, or None once they have all been read
+	"""
+	def get_next(self):
+		import cv2
+		while self.files:
+			image = cv2.imread(self.files.pop(0))
+			if image is not None:		# skip anything that is not an image
+				return {self.input_name: modelInput(image)}
+		return None
+
+"""
+This function returns the path of the model to load for backend. If model_path
+is a PyTorch model and backend is not torch, the model is exported to the backend's
+format (quantized to INT8 if int8 is True) unless that export already exists.
+An INT8 ONNX model is calibrated on the images in calibration_dir.
+"""
+def exportModel(backend, model_path, int8 = False, calibration_dir = None):
+	if backend not in backends:
+		raise ValueError("unknown backend " + backend)
+	if backend == 'torch' or not model_path.endswith('.pt'):
+		return model_path		# nothing to export, the model is already in the right format
+
+	base = model_path[:len(model_path)-3]
+	from ultralytics import YOLO
+
+	if backend == 'openvino':
+		export_path = base + ('_int8' if int8 else '') + '_openvino_model'
+		if not os.path.exists(export_path):
+			print("Exporting", model_path, "to OpenVINO, this only happens once")
+			exported = YOLO(model_path).export(format = 'openvino', imgsz = image_size, dynamic = True, int8 = int8)
+			if exported != export_path:
+				os.replace(exported, export_path)
+		return export_path
+
+	onnx_path = base + '.onnx'
+	if not os.path.exists(onnx_path):
+		print("Exporting", model_path, "to ONNX, this only happens once")
+		exported = YOLO(model_path).export(format = 'onnx', imgsz = image_size, dynamic = True)	# dynamic so a whole batch of frames can be run at once
+		if exported != onnx_path:
+			os.replace(exported, onnx_path)
+	if not int8:
+		return onnx_path
+
+	int8_path = base + '_int8_static.onnx'
+	if not os.path.exists(int8_path):
+		if calibration_dir is None:
+			raise ValueError("quantizing to INT8 for ONNX needs a directory of calibration images")
+		print("Quantizing", onnx_path, "to INT8 with the images in", calibration_dir, ", this only happens once")
+		from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+		quantize_static(onnx_path, int8_path, CalibrationReader(onnx_path, calibration_dir), quant_format = QuantFormat.QDQ,
+			activation_type = QuantType.QUInt8, weight_type = QuantType.QInt8, per_channel = True)		# QDQ lets ONNX Runtime fuse the convolutions into INT8 kernels
+	return int8_path
+
+"""
+This class detects people in frames using one of the backends
+"""
+class Detector:
+
+	"""
+	backend is one of backends and model_path is a model in that backend's format
+	(the path returned by exportModel). threads, if given, is the number of threads
+	PyTorch may use.
+	"""
+	def __init__(self, backend, model_path, threads = None):
+		if backend not in backends:
+			raise ValueError("unknown backend " + backend)
+		from ultralytics import YOLO		# imported here so processes that never detect anything do not need to load it
+		if threads is not None:
+			import torch
+			torch.set_num_threads(threads)
+		self.backend = backend
+		self.model = YOLO(model_path, task = 'detect')	# ultralytics picks ONNX Runtime or OpenVINO from the model format
+
+		# get the 'person' class id
+		names = self.model.names
+		self.person_id = list(names)[list(names.values()).index('person')]
+
+	"""
+	This function runs one batched inference over the list of BGR images and returns
+	a list with a (people detected, person boxes) tuple for each image. The boxes
+	are [x1, y1, x2, y2] lists in pixel coordinates of the image.
+	"""
+	def detect(self, images):
+		results = self.model.predict(images, classes = 0, imgsz = image_size, verbose = False)	# only detect people, class 0 is person
+
+		detections = []
+		for result in results:
+			classes = result.boxes.cls.tolist()
+			boxes = [box for box, cls in zip(result.boxes.xyxy.tolist(), classes) if cls == self.person_id]
+			detections.append((len(boxes), boxes))		# count the boxes it drew for "person", this is how many people it found in the image
+		return detections
+
+"""
+This function compares detector against the PyTorch model at reference_path on
+every image in image_dir. It prints the people counted by each for any image where
+they disagree, followed by how often they agree and the average time per frame of
+each. It returns the number of images where the counts differ.
+"""
+def selfCheck(detector, reference_path, image_dir):
+	import cv2
+	reference = Detector('torch', reference_path)
+
+	mismatches = 0
+	checked = 0
+	detector_time = 0
+	reference_time = 0
+	for file_name in sorted(os.listdir(image_dir)):
+		image = cv2.imread(os.path.join(image_dir, file_name))
+		if image is None:		# skip anything that is not an image
+			continue
+
+		start = time.perf_counter()
+		(count, boxes), = detector.detect([image])
+		detector_time += time.perf_counter()-start
+
+		start = time.perf_counter()
+		(reference_count, reference_boxes), = reference.detect([image])
+		reference_time += time.perf_counter()-start
+
+		checked += 1
+		if count != reference_count:
+			mismatches += 1
+			print(file_name, ": ", detector.backend, "counted", count, "but torch counted", reference_count)
+
+	if checked == 0:
+		print("No images found in", image_dir)
+		return 0
+	print("Counts agree on", checked-mismatches, "of", checked, "images")
+	print("Average time per frame: ", detector.backend, "{:.1f} ms,".format(1000*detector_time/checked), "torch {:.1f} ms".format(1000*reference_time/checked))
+	return mismatches
+
+"""
+This returns the intersection over union of the boxes a and b, each [x1, y1, x2, y2]
+"""
+def boxOverlap(a, b):
+	width = min(a[2], b[2]) - max(a[0], b[0])
+	height = min(a[3], b[3]) - max(a[1], b[1])
+	if width <= 0 or height <= 0:
+		return 0.0
+	intersection = width*height
+	return intersection/((a[2]-a[0])*(a[3]-a[1]) + (b[2]-b[0])*(b[3]-b[1]) - intersection)
+
+"""
+This function merges the person boxes crop_boxes found in crop, the part of a frame whose
+top left corner is at offset, with the boxes last_boxes last found in the whole frame
+last_image. People whose box centre is inside the crop were looked at again and are
+replaced by what the crop shows, the others are kept. It returns last_image with the
+crop pasted in and the merged boxes, or None if the crop does not fit last_image.
+"""
+def mergeCrop(last_image, last_boxes, offset, crop, crop_boxes):
+	x, y = offset
+	height, width = crop.shape[:2]
+	if y+height > last_image.shape[0] or x+width > last_image.shape[1]:		# the camera changed its frame size since
+		return None
+	image = last_image.copy()		# the viewers may still be drawing the last frame
+	image[y:y+height, x:x+width] = crop
+	kept = [box for box in last_boxes if not (x <= (box[0]+box[2])/2 < x+width and y <= (box[1]+box[3])/2 < y+height)]
+	found = [[x1+x, y1+y, x2+x, y2+y] for x1, y1, x2, y2 in crop_boxes]		# into the coordinates of the whole frame
+	return image, kept + [box for box in found if all(boxOverlap(box, other) < 0.5 for other in kept)]		# a person cut by the edge of the crop was already kept
@@ -0,0 +1,65 @@
+import cv2
+import numpy
+"""
+Author: Lucas Vanderheijden
+
+This file holds the cache the controller uses to skip inference on frames that
+are nearly identical to the last frame it ran inference on for the same camera.
+The cameras resend whenever their motion check triggers, so lighting flicker and
+small movements still send frames that show the same people as before.
+
+Frames are compared with a 64 bit difference hash: the frame is shrunk to a 9x8
+grayscale thumbnail and each bit says whether a pixel is brighter than its right
+neighbour. Two frames are close when their hashes differ in only a few bits.
+"""
+
+"""
+This function returns the 64 bit difference hash of the BGR image
+"""
+def frameHash(image):
+	gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+	thumbnail = cv2.resize(gray, (9, 8), interpolation = cv2.INTER_AREA)	# averaging while shrinking hides sensor noise
+	bits = thumbnail[:, 1:] > thumbnail[:, :-1]
+	return int.from_bytes(numpy.packbits(bits).tobytes(), 'big')
+
+"""
+This class keeps, for every camera, the hash of the last frame inference was run
+on together with the people and boxes found in it.
+"""
+class FrameCache:
+
+	"""
+	max_distance is the most bits two hashes may differ by for the frames to count
+	as the same, and ttl is how many seconds a result may be reused before inference
+	must be run again. A ttl of 0 turns the cache off.
+	"""
+	def __init__(self, max_distance, ttl):
+		self.max_distance = max_distance
+		self.ttl = ttl
+		self.entries = {}		# the dictionary of camera handles and their (hash, people, boxes, time of inference)
+		self.hits = 0		# the number of frames whose inference was skipped
+		self.misses = 0		# the number of frames that had to be run through the model
+
+	"""
+	This returns the cached (people, boxes) for camera_handle if frame_hash is close
+	enough to the hash of the last frame inference was run on and that result is
+	younger than the ttl. Otherwise it returns None.
+	"""
+	def lookup(self, camera_handle, frame_hash, now):
+		entry = self.entries.get(camera_handle)
+		if entry is not None and now-entry[3] > self.ttl:		# too old, the room may have changed in ways the hash misses
+			del self.entries[camera_handle]
+			entry = None
+
+		if entry is None or (entry[0] ^ frame_hash).bit_count() > self.max_distance:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return entry[1], entry[2]
+
+	"""
+	This stores the result of running inference on the frame with hash frame_hash from camera_handle
+	"""
+	def store(self, camera_handle, frame_hash, people, boxes, now):
+		if self.ttl > 0:
+			self.entries[camera_handle] = (frame_hash, people, boxes, now)
@@ -0,0 +1,62 @@
+import asyncio
+"""
+Author: Lucas Vanderheijden
+
+This file holds the small HTTP server the controller uses to show what it is
+doing, like its metrics. It runs on the controller's event loop, only understands
+GET requests and is meant to be reached from the local network, not the internet.
+
+Each route is a path and the coroutine that answers requests for it. A route
+ending in '/' also answers every path below it.
+"""
+
+status_texts = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+"""
+This coroutine writes a whole response with the status code status and the bytes body to writer
+"""
+async def sendResponse(writer, status, content_type, body):
+	writer.write(('HTTP/1.1 ' + str(status) + ' ' + status_texts.get(status, '') + '\r\n'
+		+ 'Content-Type: ' + content_type + '\r\n'
+		+ 'Content-Length: ' + str(len(body)) + '\r\n'
+		+ 'Connection: close\r\n\r\n').encode('latin-1') + body)
+	await writer.drain()
+
+"""
+This coroutine reads one request from reader and hands it to the handler of the
+matching route in routes, a dictionary of paths and coroutines taking (writer, path)
+"""
+async def handleRequest(routes, reader, writer):
+	try:
+		request_line = (await reader.readline()).decode('latin-1').split()
+		while (await reader.readline()) not in (b'\r\n', b'\n', b''):		# the headers are not needed
+			pass
+		if len(request_line) < 2:
+			await sendResponse(writer, 400, 'text/plain', b'bad request\n')
+			return
+		method, path = request_line[0], request_line[1]
+		if method != 'GET':
+			await sendResponse(writer, 405, 'text/plain', b'only GET is supported\n')
+			return
+
+		handler = routes.get(path.split('?')[0])
+		if handler is None:
+			for route in routes:
+				if route.endswith('/') and path.startswith(route):
+					handler = routes[route]
+					break
+		if handler is None:
+			await sendResponse(writer, 404, 'text/plain', b'not found\n')
+			return
+		await handler(writer, path)
+	except (OSError, asyncio.IncompleteReadError) as error:
+		print("Error while answering HTTP request: ", error)
+	finally:
+		writer.close()
+
+"""
+This coroutine starts the HTTP server on host and port answering the dictionary
+routes of paths and handlers, and returns the asyncio server
+"""
+async def startHttpServer(host, port, routes):
+	return await asyncio.start_server(lambda reader, writer: handleRequest(routes, reader, writer), host, port)
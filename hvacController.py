@@ -1,7 +1,10 @@
+import select
 import socket
 import sys
 import time
 import gpiod
+import protocol
+from protocol import openSession, readMessage, sendMessage
 """
 Author: Lucas Vanderheijden
 
@@ -9,21 +12,30 @@ This script is for controlling the heater and AC. It sits periodically polls the
 its status. Turning on and off the AC and Heater is simulated by using
 GPIO pins connected to transistors that controll current flow to the LEDs.
 It takes two command line arguments which are the ipaddress of controller and port number to use
+An optional third argument is the name of this unit ('hvac' by default), which must
+be different for every HVAC unit. The unit registers its name every time it connects.
+It keeps one session open with the controller and subscribes to its commands, which
+the controller pushes as soon as they change and again every keepalive period. If the
+controller goes quiet for too long, the AC and heater are turned off to be safe.
 """
 
 AC_status = b'OFF'		# the status of the AC, in byte string because that is what we get from the socket connections
 heat_status = b'OFF'		# the status of the heater, in byte string because that is what we get from the socket connections
 AC_PIN = 14		# the gpiod pin of the AC led
 HEAT_PIN = 15		# the gpiod pin of the heater led
-pause_period = 1.0	# how long to wait in between polling the controller
+pause_period = 1.0	# how long to wait before reconnecting after losing the controller
+command_timeout = 3*protocol.hvac_keepalive_period	# how long to go without commands before treating the controller as gone
+device_name = 'hvac'	# the name this unit registers and uses for its session with the controller, can be given on the command line
 
 AC_line = None	# these variables will store the objects needed to control the GPIO pins later
 heat_line = None
 
 if(len(sys.argv) < 3):		# make sure a port number was entered
-	print("Usage: <Controller IP addr> <Controller Port Number>")
+	print("Usage: <Controller IP addr> <Controller Port Number> [unit name]")
 	sys.exit(0)
 address = (sys.argv[1], int(sys.argv[2]))
+if len(sys.argv) > 3:
+	device_name = sys.argv[3]
 
 chip = gpiod.Chip('gpiochip4')		# tells raspberry pi where to find the GPIO pin
 AC_line = chip.get_line(AC_PIN)
@@ -35,33 +47,10 @@ heat_line.request(consumer="LED", type=gpiod.LINE_REQ_DIR_OUT)	# set LED (the tr
 AC_line.set_value(0)	# turn off current flow	to AC led
 heat_line.set_value(0)	# turn off current flow to heat led
 
-while True:
-	time.sleep(pause_period)	# wait to poll
-
-	sock = socket.socket()
-	sock.connect(address)	# connect
-	sock.send(b'hvac_poll')		# send request type
-
-	AC_status = sock.recv(1024)		# controller will first send AC status
-	if(AC_status == b'ON' or AC_status == b'OFF'):		# check the status was received correctly
-		print("Recieved AC status: ", AC_status)
-		sock.send(b'ack')
-	else:
-		print("Did not recieve proper AC status, closing connection")
-		sock.send(b'Could not make sense of transmission')
-		sock.close()
-		continue
-	heat_status = sock.recv(1024)		# controller will then send the heater update
-	if(heat_status == b'ON' or heat_status == b'OFF'):		# check it makes sense
-		print("Recieved heat status: ", heat_status)
-		sock.send(b'ack')
-	else:
-		print("Did not recieve proper heat status, closing connection")
-		sock.close()
-		continue
-	sock.close()	# close connection
-
-	# update the heat and AC based on the new commands
+"""
+This method updates the heat and AC lines based on the commands in AC_status and heat_status
+"""
+def applyCommands(AC_status, heat_status):
 	if(AC_status == b'OFF'):
 		AC_line.set_value(0)	# turn off current flow	to AC led
 	else:
@@ -70,4 +59,66 @@ while True:
 	if(heat_status == b'OFF'):
 		heat_line.set_value(0)	# turn off current flow to heat led
 	else:
-		heat_line.set_value(1)	# turn on current flow to heat led
\ No newline at end of file
+		heat_line.set_value(1)	# turn on current flow to heat led
+
+"""
+This method registers this unit's name with the controller, so it will accept the unit's session
+"""
+def register():
+	sock = socket.create_connection(address, timeout = protocol.session_timeout)
+	try:
+		sock.sendall(b'hvac_reg')		# inform controller device wants to register itself
+		if sock.recv(1024) != b'ack':
+			raise ConnectionError("controller did not accept the registration")
+		sock.sendall(device_name.encode('utf-8'))
+		response = sock.recv(1024)
+	finally:
+		sock.close()
+	if response == b'name in use':		# a sensor or camera has this name, trying again will not help
+		print("The name ", device_name, " is used by another device, pick another one")
+		applyCommands(b'OFF', b'OFF')
+		sys.exit(1)
+	if response != b'ack':
+		raise ConnectionError("controller did not accept the name: " + response.decode('utf-8', 'replace'))
+
+session = None		# the session with the controller, opened when first needed
+last_command = time.monotonic()		# when the controller last sent commands
+last_sent = time.monotonic()		# when something was last sent to the controller
+
+while True:
+	try:
+		if session is None:
+			register()		# the controller may have restarted and forgotten this unit
+			session = openSession(address, device_name)
+			sendMessage(session, protocol.HVAC_SUBSCRIBE)		# ask for the commands to be pushed from now on
+			print("Subscribed to controller")
+			last_command = last_sent = time.monotonic()
+
+		readable, writable, failed = select.select([session], [], [], protocol.heartbeat_period)		# wait for a command, but not so long that a heartbeat is missed
+		if readable:
+			kind, status = readMessage(session)
+			if kind == protocol.HVAC_STATUS:
+				last_command = time.monotonic()
+				statuses = bytes(status).split()
+				if len(statuses) == 2 and all(s == b'ON' or s == b'OFF' for s in statuses):		# check the status was received correctly
+					AC_status, heat_status = statuses
+					print("Recieved AC status: ", AC_status, " heat status: ", heat_status)
+					applyCommands(AC_status, heat_status)
+				else:
+					print("Did not recieve proper status: ", status)
+
+		if time.monotonic() - last_sent >= protocol.heartbeat_period:		# let the controller know we are alive
+			sendMessage(session, protocol.HEARTBEAT)
+			last_sent = time.monotonic()
+		if time.monotonic() - last_command > command_timeout:
+			raise ConnectionError("no commands from the controller in " + str(command_timeout) + " seconds")
+
+	except (OSError, ValueError) as error:
+		print("Lost the controller: ", error, ". Turning off the AC and heater until it is back")
+		if session is not None:
+			session.close()
+			session = None
+		AC_status = b'OFF'
+		heat_status = b'OFF'
+		applyCommands(AC_status, heat_status)
+		time.sleep(pause_period)
@@ -0,0 +1,157 @@
+import asyncio
+import multiprocessing
+import os
+import numpy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from detector import Detector
+"""
+Author: Lucas Vanderheijden
+
+This file holds the pool that runs person detection for the controller.
+
+With zero workers the model is loaded once in the controller process and run
+on a single thread, like before. With one or more workers each worker is a
+separate process that loads the model once when it starts, so detection can
+use every core of the controller. Frames are handed to the workers through
+shared memory blocks instead of being pickled and copied through a pipe; only
+the position and shape of each frame in the block is sent to the worker.
+The workers send back the number of people and the person boxes of each frame.
+The detection itself is done by a Detector (see detector.py) on whichever
+backend the controller was started with.
+
+Each worker gets its own share of the cores: it is pinned to them and told to run
+that many inference threads. Otherwise every worker would start a thread per core
+and the workers would fight over the same cores instead of adding to each other.
+"""
+
+detector = None		# the Detector loaded in this process, set by loadModel
+attached_blocks = {}	# the dictionary of shared memory block names and the blocks this worker has attached to
+
+"""
+This function loads the model stored at model_path on backend. It is run once in
+every worker process when it starts (and once in the controller when
+running without workers). A worker takes the cores it may use from the queue
+cpu_sets and runs that many inference threads.
+"""
+def loadModel(backend, model_path, cpu_sets = None):
+	global detector
+	threads = None
+	if cpu_sets is not None:
+		cpus = cpu_sets.get()
+		threads = len(cpus)
+		if hasattr(os, 'sched_setaffinity'):		# keeps the threads of every backend on this worker's cores, linux only
+			os.sched_setaffinity(0, cpus)
+		os.environ['OMP_NUM_THREADS'] = str(threads)		# read when the backend's libraries load, which happens in Detector
+	detector = Detector(backend, model_path, threads)
+
+"""
+This returns a list with the set of cores each of workers worker processes should use,
+sharing out the cores this process may run on
+"""
+def splitCores(workers):
+	if hasattr(os, 'sched_getaffinity'):
+		cores = sorted(os.sched_getaffinity(0))
+	else:
+		cores = list(range(os.cpu_count() or 1))
+	per_worker = max(1, len(cores)//workers)
+	return [{cores[(i*per_worker + j) % len(cores)] for j in range(per_worker)} for i in range(workers)]		# with more workers than cores, workers share cores one each
+
+"""
+This function runs one batched inference over the list of BGR images with the
+detector loaded in this process and returns a list with a (people detected,
+person boxes) tuple for each image.
+"""
+def detect(images):
+	return detector.detect(images)
+
+"""
+This function is run in a worker process. It finds the images described by
+layouts, a list of (offset, shape) tuples, inside the shared memory block
+called block_name and runs detect on them without copying them.
+"""
+def detectShared(block_name, layouts):
+	block = attached_blocks.get(block_name)
+	if block is None:		# attach to each block once, the controller reuses the same few blocks for every batch
+		block = shared_memory.SharedMemory(name = block_name)
+		attached_blocks[block_name] = block
+
+	images = [numpy.ndarray(shape, dtype = numpy.uint8, buffer = block.buf, offset = offset) for offset, shape in layouts]
+	return detect(images)
+
+"""
+This class runs detection on batches of frames, either on a thread in this
+process or on a pool of worker processes fed through shared memory.
+"""
+class InferencePool:
+
+	"""
+	workers is the number of worker processes to start (0 runs detection in this
+	process), backend and model_path are the detector backend and model every worker
+	loads and block_size is the size in bytes of the shared memory block used to
+	pass one batch to a worker.
+	"""
+	def __init__(self, workers, backend, model_path, block_size):
+		self.workers = workers
+		self.blocks = None		# the queue of shared memory blocks that are not being used by a batch
+		if workers == 0:
+			# the model is not thread safe, so a single worker thread runs every inference one after the other
+			self.executor = ThreadPoolExecutor(max_workers = 1, initializer = loadModel, initargs = (backend, model_path))
+		else:
+			# spawn the workers rather than forking, the controller already has threads running that fork would not copy safely
+			context = multiprocessing.get_context('spawn')
+			cpu_sets = context.Queue()		# each worker takes one set of cores when it starts
+			for cpus in splitCores(workers):
+				cpu_sets.put(cpus)
+			self.executor = ProcessPoolExecutor(max_workers = workers, mp_context = context,
+				initializer = loadModel, initargs = (backend, model_path, cpu_sets))
+			self.blocks = asyncio.Queue()
+			for i in range(workers):		# one block per worker is enough since each worker runs one batch at a time
+				self.blocks.put_nowait(shared_memory.SharedMemory(create = True, size = block_size))
+
+	"""
+	This returns how many batches can be running at the same time
+	"""
+	def concurrency(self):
+		return max(self.workers, 1)
+
+	"""
+	This coroutine runs detection on the list of BGR images and returns a list with a
+	(people detected, person boxes) tuple for each image.
+	"""
+	async def detect(self, images):
+		loop = asyncio.get_running_loop()
+		if self.blocks is None:
+			return await loop.run_in_executor(self.executor, detect, images)
+
+		block = await self.blocks.get()
+		try:
+			layouts = []
+			offset = 0
+			for image in images:		# copy the frames one after the other into the block
+				if offset + image.nbytes > block.size:
+					raise ValueError("batch of frames does not fit in a shared memory block of " + str(block.size) + " bytes")
+				numpy.ndarray(image.shape, dtype = numpy.uint8, buffer = block.buf, offset = offset)[...] = image
+				layouts.append((offset, image.shape))
+				offset += image.nbytes
+			return await loop.run_in_executor(self.executor, detectShared, block.name, layouts)
+		finally:
+			self.blocks.put_nowait(block)
+
+	"""
+	This coroutine runs one inference on image on every worker, so the model is loaded
+	and the slow first inference is done before any real frame arrives
+	"""
+	async def warmUp(self, image):
+		await asyncio.gather(*[self.detect([image]) for i in range(self.concurrency())])
+
+	"""
+	This stops the workers and frees the shared memory blocks
+	"""
+	def close(self):
+		self.executor.shutdown(wait = True, cancel_futures = True)
+		if self.blocks is not None:
+			while not self.blocks.empty():
+				block = self.blocks.get_nowait()
+				block.close()
+				block.unlink()
@@ -1,48 +1,65 @@
 import sys
 import cv2
 import numpy
+from motion import MotionDetector, saveNoiseProfile
 """
 Author: Lucas Vanderheijden
 
-This program is used to measure the baseline value in the camera.py script.
-It is only for testing purposes as the output of this script is already hard
-coded in camera.py. However, it may need to be rerun if a different camera
-of a different quality is used.
+This program measures the noise profile of a camera for the motion detector in
+camera.py. It should be run once for each camera, with the room empty, and
+rerun if the camera or its position changes.
 
 This script takes one command line argument, the number of frames to compute
-for the test.
+for the test, and optionally a second one, the file to write the noise profile to
+(noise_profile.bin by default, which is where camera.py looks for it).
 
-The printed output of the script is the average change_val for the number of
-frames given as the argument. The idea is to calculate this value when the room is
-empty so we get a baseline to check against when trying to detect movement.
+The frames are shrunk to the motion detector's size and the mean and variance of
+every pixel are streamed over all frames with Welford's algorithm, which stays
+accurate over any number of frames. The result is written as a compact binary
+file that camera.py memory maps at startup, so nobody has to hand tune thresholds.
 
 This program requires the opencv library
 to run. Information can be found at:
 https://raspberrypi-guide.github.io/programming/install-opencv.html
 """
 
-if len(sys.argv) != 2:
-	print("Usage: <Number of iterations to test>")
+if len(sys.argv) < 2 or len(sys.argv) > 3:
+	print("Usage: <Number of iterations to test> [Noise profile file]")
 	sys.exit(0)
 
-cam = cv2.VideoCapture(0)	# the 0 specifies reading from the first camera
+frames_to_measure = int(sys.argv[1])
+profile_file_name = sys.argv[2] if len(sys.argv) == 3 else 'noise_profile.bin'
 
-while True:		# get first image
-	ret, prev_image = cam.read()		# get image from camera
-	if not ret:				# ensure we were successful in grabbing image
-		print("Failed to get image, trying again")
-		continue
-	break
+cam = cv2.VideoCapture(0)	# the 0 specifies reading from the first camera
+motion = MotionDetector()	# only used to shrink the frames exactly the way camera.py will
 
-average_val = 0
-for i in range(int(sys.argv[1])):
+count = 0
+mean = None		# the running mean of every pixel
+m2 = None		# the running sum of squared differences from the mean of every pixel
+for i in range(frames_to_measure):
 	ret, image = cam.read()		# get image from camera
 	if not ret:				# ensure we were successful in grabbing image
 		print("Failed to get image, skipping iteration")
 		continue
-	change_val = int(numpy.sum(numpy.absolute(image-prev_image)))		# compute change_val
-	average_val = (average_val*(i) + change_val)/(i+1)	# this formula computes a running average of all the change_val values calculated
-	prev_image = image
 
-print("The experimentially determined average value is: ", average_val)		# print the result
-cam.release()		# release camera
\ No newline at end of file
+	gray = motion.prepare(image).astype(numpy.float64)
+	if mean is None:
+		mean = numpy.zeros(gray.shape)
+		m2 = numpy.zeros(gray.shape)
+
+	# Welford's update, done for every pixel at once
+	count += 1
+	delta = gray - mean
+	mean += delta/count
+	m2 += delta*(gray - mean)
+
+cam.release()		# release camera
+
+if count < 2:
+	print("Need at least two frames to measure the noise")
+	sys.exit(1)
+
+std = numpy.sqrt(m2/(count-1))
+saveNoiseProfile(profile_file_name, mean, std, count)
+print("Measured", count, "frames. Median pixel noise: {:.2f}, worst pixel noise: {:.2f} gray levels".format(numpy.median(std), std.max()))
+print("Noise profile written to", profile_file_name)
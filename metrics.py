@@ -0,0 +1,163 @@
+import bisect
+import json
+import random
+import time
+"""
+Author: Lucas Vanderheijden
+
+This file holds the counters, gauges and timing histograms the controller keeps
+about itself, and renders them in the Prometheus text format so they can be read
+from the metrics endpoint (see httpServer.py) by a person or a Prometheus server.
+
+The metrics are kept as plain numbers and updated from the event loop, so
+updating one costs about as much as adding two numbers. A histogram only finds
+the bucket a value falls in and adds one to it.
+
+It also holds the log function used on the hot path in place of print. By default
+it prints like before. When a sample rate is set, only that fraction of the
+messages is written, each one as a single line of json that is easy to search.
+"""
+
+registry = []		# every metric created, in the order they were created
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)		# in seconds
+log_sample_rate = None		# the fraction of log messages written as json, None prints every message as plain text
+
+"""
+This returns the labels dictionary in the Prometheus {name="value"} form
+"""
+def formatLabels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in labels.items()) + '}'
+
+"""
+This class counts something that only goes up, like frames received
+"""
+class Counter:
+	kind = 'counter'
+
+	def __init__(self, name, help, labels = None):
+		self.name = name
+		self.help = help
+		self.labels = labels or {}
+		self.value = 0
+		registry.append(self)
+
+	def inc(self, amount = 1):
+		self.value += amount
+
+	def samples(self):
+		return [(self.name, self.labels, self.value)]
+
+"""
+This class holds a value that goes up and down, like the number of open connections.
+If function is given, it is called to get the value whenever the metrics are read.
+"""
+class Gauge:
+	kind = 'gauge'
+
+	def __init__(self, name, help, labels = None, function = None):
+		self.name = name
+		self.help = help
+		self.labels = labels or {}
+		self.function = function
+		self.value = 0
+		registry.append(self)
+
+	def set(self, value):
+		self.value = value
+
+	def inc(self, amount = 1):
+		self.value += amount
+
+	def dec(self, amount = 1):
+		self.value -= amount
+
+	def samples(self):
+		return [(self.name, self.labels, self.function() if self.function is not None else self.value)]
+
+"""
+This class is used with the with statement to time a block of code into a histogram
+"""
+class Timer:
+
+	def __init__(self, histogram):
+		self.histogram = histogram
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exception):
+		self.histogram.observe(time.perf_counter() - self.start)
+
+"""
+This class counts how many values fell in each of a fixed set of buckets, like the
+time each stage of handling a frame took
+"""
+class Histogram:
+	kind = 'histogram'
+
+	def __init__(self, name, help, labels = None, buckets = default_buckets):
+		self.name = name
+		self.help = help
+		self.labels = labels or {}
+		self.buckets = list(buckets)
+		self.counts = [0]*(len(self.buckets)+1)		# the last one counts values above every bucket
+		self.sum = 0.0
+		self.count = 0
+		registry.append(self)
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	"""
+	This returns a Timer, so 'with histogram.time():' adds the time the block took
+	"""
+	def time(self):
+		return Timer(self)
+
+	def samples(self):
+		samples = []
+		cumulative = 0
+		for bound, count in zip(self.buckets + ['+Inf'], self.counts):		# Prometheus buckets count every value up to their bound
+			cumulative += count
+			samples.append((self.name + '_bucket', dict(self.labels, le = bound), cumulative))
+		samples.append((self.name + '_sum', self.labels, self.sum))
+		samples.append((self.name + '_count', self.labels, self.count))
+		return samples
+
+"""
+This returns every metric in the Prometheus text format
+"""
+def render():
+	lines = []
+	described = set()
+	for metric in sorted(registry, key = lambda metric: metric.name):		# metrics sharing a name must be listed together
+		if metric.name not in described:
+			described.add(metric.name)
+			lines.append('# HELP ' + metric.name + ' ' + metric.help)
+			lines.append('# TYPE ' + metric.name + ' ' + metric.kind)
+		for name, labels, value in metric.samples():
+			lines.append(name + formatLabels(labels) + ' ' + repr(float(value)))
+	return '\n'.join(lines) + '\n'
+
+"""
+This function sets the fraction of log messages that are written as json, or
+None to print every message as plain text
+"""
+def configureLogging(sample_rate):
+	global log_sample_rate
+	log_sample_rate = sample_rate
+
+"""
+This function logs the event named event. message is the plain text form, with
+{field} replaced by the value of the matching keyword argument in fields.
+"""
+def log(event, message, **fields):
+	if log_sample_rate is None:
+		print(message.format(**fields))
+	elif random.random() < log_sample_rate:
+		print(json.dumps(dict(time = round(time.time(), 3), event = event, **fields), default = str))
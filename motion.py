@@ -0,0 +1,127 @@
+import struct
+import cv2
+import numpy
+"""
+Author: Lucas Vanderheijden
+
+This file holds the motion detector camera.py uses to decide when a frame is
+worth sending to the controller.
+
+Frames are shrunk to a small grayscale image before anything else, which cuts
+the work per frame by a couple of orders of magnitude on the raspberry pi. The
+detector keeps a running average of the background and an estimate of how much
+each pixel normally flickers. A pixel counts as changed when it is further from
+the background than a few times its own noise, and the detector reports what
+fraction of the frame changed and the box around the changed region. A change in
+lighting that brightens or darkens the whole frame is removed before comparing,
+and slow changes are learned into the background, so they do not trigger a send.
+
+The detector can be started from a noise profile measured by measureBaseline.py,
+so each camera gets thresholds that fit its own sensor from the first frame.
+A noise profile file is a small header followed by the per-pixel mean and
+standard deviation of the shrunk grayscale frames as float32 arrays.
+
+This file requires the opencv library
+to run. Information can be found at:
+https://raspberrypi-guide.github.io/programming/install-opencv.html
+"""
+
+profile_header = struct.Struct('<4sHHHI')	# magic, version, width, height, number of frames measured
+profile_magic = b'NOIS'
+profile_version = 1
+
+"""
+This function writes the noise profile made of the mean and std arrays, measured
+over frames frames, to the file file_name
+"""
+def saveNoiseProfile(file_name, mean, std, frames):
+	height, width = mean.shape
+	f = open(file_name, 'wb')
+	f.write(profile_header.pack(profile_magic, profile_version, width, height, frames))
+	f.write(numpy.ascontiguousarray(mean, dtype = numpy.float32).tobytes())
+	f.write(numpy.ascontiguousarray(std, dtype = numpy.float32).tobytes())
+	f.close()
+
+"""
+This function memory maps the noise profile in the file file_name and returns
+its (mean, std) arrays
+"""
+def loadNoiseProfile(file_name):
+	f = open(file_name, 'rb')
+	magic, version, width, height, frames = profile_header.unpack(f.read(profile_header.size))
+	f.close()
+	if magic != profile_magic or version != profile_version:
+		raise ValueError(file_name + " is not a noise profile")
+	arrays = numpy.memmap(file_name, dtype = numpy.float32, mode = 'r', offset = profile_header.size, shape = (2, height, width))
+	return arrays[0], arrays[1]
+
+"""
+This class detects motion between frames from one camera
+"""
+class MotionDetector:
+
+	"""
+	width and height are the size frames are shrunk to, learning_rate is how quickly
+	the background and noise estimates follow the frames, noise_factor is how many
+	standard deviations of noise a pixel must change by to count as changed and
+	min_noise is the smallest standard deviation (in gray levels) any pixel is given.
+	"""
+	def __init__(self, width = 160, height = 120, learning_rate = 0.05, noise_factor = 4.0, min_noise = 4.0):
+		self.width = width
+		self.height = height
+		self.learning_rate = learning_rate
+		self.noise_factor = noise_factor
+		self.min_noise = min_noise
+		self.background = None		# the running average of the shrunk grayscale frames
+		self.variance = None		# the running average of each pixel's squared difference from the background
+		self.kernel = numpy.ones((3, 3), dtype = numpy.uint8)		# used to remove single changed pixels, which are almost always noise
+
+	"""
+	This returns the BGR image shrunk to the detector's size and converted to grayscale floats
+	"""
+	def prepare(self, image):
+		small = cv2.resize(image, (self.width, self.height), interpolation = cv2.INTER_AREA)	# shrink first so the color conversion only touches a few pixels
+		return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(numpy.float32)
+
+	"""
+	This function starts the background from a noise profile, mean and std being
+	arrays of the detector's size (see loadNoiseProfile)
+	"""
+	def seed(self, mean, std):
+		if mean.shape != (self.height, self.width):
+			raise ValueError("noise profile is " + str(mean.shape[1]) + "x" + str(mean.shape[0]) + " but the detector uses " + str(self.width) + "x" + str(self.height))
+		self.background = numpy.array(mean, dtype = numpy.float32)		# copy out of the memory map, the background keeps changing
+		self.variance = numpy.maximum(numpy.array(std, dtype = numpy.float32), self.min_noise)**2
+
+	"""
+	This function compares the BGR image to the background and then learns it.
+	It returns the fraction of the frame that changed and the (x, y, width, height)
+	box around the changed region in the coordinates of image, or None if nothing changed.
+	"""
+	def update(self, image):
+		gray = self.prepare(image)
+		if self.background is None:		# the first frame becomes the background
+			self.background = gray
+			self.variance = numpy.full(gray.shape, self.min_noise**2, dtype = numpy.float32)
+			return 0.0, None
+
+		raw_diff = gray - self.background		# floats, so darker pixels give negative values instead of wrapping around
+		diff = raw_diff - numpy.median(raw_diff)		# remove a change in lighting that moves the whole frame up or down
+		changed = (diff*diff > (self.noise_factor**2)*self.variance).astype(numpy.uint8)
+		changed = cv2.morphologyEx(changed, cv2.MORPH_OPEN, self.kernel)
+
+		# learn the frame into the background, slowly where something changed so people standing still fade in over time
+		rate = numpy.where(changed, self.learning_rate/10, self.learning_rate).astype(numpy.float32)
+		self.background += rate*raw_diff
+		self.variance += rate*(numpy.minimum(diff*diff, 4*self.variance) - self.variance)	# clamp so one big change does not blow up the noise estimate
+		numpy.maximum(self.variance, self.min_noise**2, out = self.variance)
+
+		changed_pixels = cv2.countNonZero(changed)
+		if changed_pixels == 0:
+			return 0.0, None
+
+		x, y, w, h = cv2.boundingRect(changed)
+		scale_x = image.shape[1]/self.width
+		scale_y = image.shape[0]/self.height
+		region = (int(x*scale_x), int(y*scale_y), int(numpy.ceil(w*scale_x)), int(numpy.ceil(h*scale_y)))
+		return changed_pixels/changed.size, region
@@ -0,0 +1,207 @@
+import socket
+import struct
+"""
+Author: Lucas Vanderheijden
+
+This file holds the framing used when large pieces of data (like camera frames)
+are sent over the sockets. Each frame is a 4 byte big endian size header followed
+by the body, so the receiver knows exactly how much to read and the sender can
+stream the whole body with a single sendall instead of waiting for an ack
+after every block.
+
+It also holds the messages used by device sessions. A device opens a session
+once, with the 'session' connection type followed by its registered name, and
+then keeps the connection open and sends every update over it as a message: a
+1 byte message kind and a 4 byte size header followed by the body. A device that
+has nothing to send sends a heartbeat instead, and the controller treats a
+device it has not heard from in session_timeout seconds as dead.
+
+Temperature sensors can send several readings in one TEMP_BATCH message. Each
+reading is sent with its age (how many seconds before the message it was taken)
+instead of a time, so the sensor's clock does not have to agree with the controller's.
+
+Cameras can send just the part of a frame that changed in a CROP message, with
+where that part sits in the frame, so the controller only has to look at the crop.
+
+It is shared by the devices (which use plain blocking sockets) and the
+controller (which reads with its asyncio event loop).
+"""
+
+frame_header = struct.Struct('!I')	# the size header sent before every frame, an unsigned 32 bit int in network byte order
+max_frame_size = 16*1024*1024		# the largest frame the controller will accept, anything bigger is treated as a corrupt header
+message_header = struct.Struct('!BI')	# the kind and size header sent before every session message
+temp_sample = struct.Struct('!ff')		# the (age in seconds, temperature) of each reading in a TEMP_BATCH message
+crop_header = struct.Struct('!HHHH')		# the (x, y) of a crop in its frame and the (width, height) of the whole frame, sent before the jpeg of a CROP message
+
+# the kinds of session messages
+HEARTBEAT = 0		# sent by a device with nothing else to send, the controller answers with a heartbeat
+TEMP_UPDATE = 1		# a new temperature from a temperature sensor, as text
+FRAME = 2		# a jpeg frame from a camera, answered with ACK
+COUNT = 3		# a json people count from a camera in edge mode, answered with ACK
+ACK = 4			# the controller received a frame or count
+HVAC_POLL = 5		# the HVAC unit asking for its commands, answered with HVAC_STATUS
+HVAC_STATUS = 6		# the AC and heater commands, as text like b'ON OFF'
+HVAC_SUBSCRIBE = 7	# the HVAC unit asking to be sent its commands whenever they change, answered with HVAC_STATUS
+TEMP_BATCH = 8		# several temperatures from a temperature sensor, packed with packTempBatch, answered with ACK
+CROP = 9		# a jpeg of the changed part of a camera's frame, packed with packCrop, answered with ACK
+
+heartbeat_period = 5		# the longest time (in seconds) a device goes without sending anything
+session_timeout = 3*heartbeat_period		# the time after which a silent device is treated as dead
+hvac_keepalive_period = 10		# how often the controller resends the HVAC commands to subscribers even if they did not change
+
+"""
+This function sends payload over the blocking socket sock as one frame
+"""
+def sendFrame(sock, payload):
+	sock.sendall(frame_header.pack(len(payload)))	# tell the receiver how many bytes are coming
+	sock.sendall(payload)		# then stream the whole body, the kernel takes care of splitting it into packets
+
+"""
+This function reads exactly n bytes from the blocking socket sock. It raises
+ConnectionError if the connection closes early.
+"""
+def readExactly(sock, n):
+	buffer = bytearray(n)
+	view = memoryview(buffer)
+	received = 0
+	while received < n:
+		count = sock.recv_into(view[received:])
+		if count == 0:
+			raise ConnectionError("connection closed in the middle of a message")
+		received += count
+	return buffer
+
+"""
+This function returns the bytes of a session message of type kind with body payload
+"""
+def packMessage(kind, payload = b''):
+	return message_header.pack(kind, len(payload)) + payload
+
+"""
+This function returns the body of a TEMP_BATCH message holding samples, a list of
+(age in seconds, temperature) oldest first
+"""
+def packTempBatch(samples):
+	return b''.join(temp_sample.pack(age, temp) for age, temp in samples)
+
+"""
+This function returns the list of (age in seconds, temperature) in the body of a
+TEMP_BATCH message. It raises ValueError if the body is not whole samples.
+"""
+def unpackTempBatch(body):
+	if len(body) % temp_sample.size != 0:
+		raise ValueError("temperature batch of " + str(len(body)) + " bytes is not whole samples")
+	return list(temp_sample.iter_unpack(body))
+
+"""
+This function returns the body of a CROP message holding the jpeg bytes of the part of
+a frame of frame_width by frame_height pixels whose top left corner is at (x, y)
+"""
+def packCrop(x, y, frame_width, frame_height, jpeg):
+	return crop_header.pack(x, y, frame_width, frame_height) + jpeg
+
+"""
+This function returns the (x, y, frame width, frame height, jpeg bytes) in the body of a CROP message
+"""
+def unpackCrop(body):
+	if len(body) <= crop_header.size:
+		raise ValueError("crop of " + str(len(body)) + " bytes has no image")
+	x, y, frame_width, frame_height = crop_header.unpack_from(body)
+	return x, y, frame_width, frame_height, body[crop_header.size:]
+
+"""
+This function sends a session message of type kind with body payload over the blocking socket sock
+"""
+def sendMessage(sock, kind, payload = b''):
+	if len(payload) < 4096:		# small messages go out in one packet
+		sock.sendall(packMessage(kind, payload))
+	else:
+		sock.sendall(message_header.pack(kind, len(payload)))
+		sock.sendall(payload)		# stream big bodies like frames without copying them
+
+"""
+This function reads one session message from the blocking socket sock and
+returns its (kind, body)
+"""
+def readMessage(sock):
+	kind, size = message_header.unpack(readExactly(sock, message_header.size))
+	if size > max_frame_size:
+		raise ValueError("message of " + str(size) + " bytes is larger than the maximum allowed")
+	return kind, bytes(readExactly(sock, size))
+
+"""
+This function opens a session with the controller at addr for the device
+registered as device_name and returns the connected blocking socket. Blocking
+calls on it give up after timeout seconds.
+"""
+def openSession(addr, device_name, timeout = session_timeout):
+	sock = socket.create_connection(addr, timeout = timeout)
+	sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)	# messages are small and latency matters more than packing them
+	try:
+		sock.sendall(b'session')	# inform controller of connection type
+		if sock.recv(1024) != b'ack':
+			raise ConnectionError("controller did not accept the session")
+		sock.sendall(device_name.encode('utf-8'))		# tell the controller which device this session belongs to
+		response = sock.recv(1024)
+		if response != b'ack':
+			raise ConnectionError("controller did not accept the device name: " + response.decode('utf-8', 'replace'))
+	except OSError:
+		sock.close()
+		raise
+	return sock
+
+"""
+This coroutine reads exactly len(buffer) bytes from sock into buffer using
+the event loop. It raises ConnectionError if the connection closes early.
+"""
+async def recvInto(loop, sock, buffer):
+	view = memoryview(buffer)
+	received = 0
+	while received < len(view):
+		n = await loop.sock_recv_into(sock, view[received:])	# read straight into the buffer, no intermediate copies
+		if n == 0:
+			raise ConnectionError("connection closed in the middle of a frame")
+		received += n
+	return buffer
+
+"""
+This coroutine reads one frame from sock using the event loop and returns
+its body as a bytearray. The body is read into a buffer preallocated from the
+size header. It returns None if the connection was closed between frames.
+If timer is given, the time from the header to the last byte of the body is
+observed by it (see metrics.py), which leaves out the wait for the frame to start.
+"""
+async def recvFrame(loop, sock, timer = None):
+	header = bytearray(frame_header.size)
+	n = await loop.sock_recv_into(sock, header)
+	if n == 0:		# the other side is done sending frames
+		return None
+	start = loop.time()
+	await recvInto(loop, sock, memoryview(header)[n:])
+	(size, ) = frame_header.unpack(header)
+	if size > max_frame_size:
+		raise ValueError("frame of " + str(size) + " bytes is larger than the maximum allowed")
+	body = await recvInto(loop, sock, bytearray(size))
+	if timer is not None:
+		timer.observe(loop.time() - start)
+	return body
+
+"""
+This coroutine reads one session message from sock using the event loop and
+returns its (kind, body). It returns None if the connection was closed between messages.
+If timer is given, it observes the time taken to read the body of messages that have one.
+"""
+async def recvMessage(loop, sock, timer = None):
+	header = bytearray(message_header.size)
+	n = await loop.sock_recv_into(sock, header)
+	if n == 0:		# the device closed the session
+		return None
+	start = loop.time()
+	await recvInto(loop, sock, memoryview(header)[n:])
+	kind, size = message_header.unpack(header)
+	if size > max_frame_size:
+		raise ValueError("message of " + str(size) + " bytes is larger than the maximum allowed")
+	body = await recvInto(loop, sock, bytearray(size))
+	if timer is not None and size > 0:
+		timer.observe(loop.time() - start)
+	return kind, body
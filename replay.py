@@ -0,0 +1,230 @@
+import argparse
+import json
+import time
+import cv2
+import numpy
+from controllerState import ControllerState
+from detector import Detector, backends, exportModel, mergeCrop
+import protocol
+from setpoint import parseSetpoints
+import traceFile
+from traceFile import TraceReader
+"""
+Author: Lucas Vanderheijden
+
+This program plays a trace recorded by controller.py (with --record) back through
+the same person detection and HVAC decision code the controller uses, without any
+devices or sockets. The same trace can be replayed with different models and
+backends to compare how fast they are and whether they count the same people.
+
+This program takes 1 command line argument which is the trace file.
+The optional --speed argument plays the trace back at that many times real time
+(1 is real time) and 0, the default, plays it as fast as possible. The optional
+--backend, --model, --int8 and --calibration arguments choose how people are detected,
+like for the controller, and --batch sets how many frames are detected together when
+playing as fast as possible.
+
+At the end it reports the frames detected per second, the detection time of each
+frame (p50 and p99), how far behind the trace the playback fell, and how often the
+HVAC commands decided during playback agree with the ones recorded. The optional
+--output argument writes these results and the people counted in every frame to a
+json file, and --compare compares the counts against such a file from another run.
+
+This program requires the YOLOv8 model and its dependancies to run, like the controller.
+"""
+
+"""
+This returns the value below which fraction of the sorted list values fall, or None if it is empty
+"""
+def percentile(values, fraction):
+	if not values:
+		return None
+	return values[min(int(fraction*len(values)), len(values)-1)]
+
+"""
+This class plays a trace back through a Detector and a ControllerState
+"""
+class Replayer:
+
+	def __init__(self, detector, batch_size):
+		self.detector = detector
+		self.batch_size = batch_size
+		self.state = ControllerState()
+		self.batch = []		# the (time, camera, image) of frames waiting to be detected together
+		self.last_frames = {}		# the dictionary of camera names and their last (image, person boxes), for merging crops into
+		self.counts = []		# the [time, camera, people] counted in each frame, in trace order
+		self.detect_times = []		# the time detection took for each frame, in seconds
+		self.status = None		# the HVAC commands decided so far
+		self.decisions = 0		# the times the decided HVAC commands changed
+		self.recorded_decisions = 0		# the HVAC decisions found in the trace
+		self.agreements = 0		# the recorded HVAC decisions the playback agreed with
+
+	"""
+	This function detects the people in the frames waiting in the batch and applies their counts
+	"""
+	def flush(self):
+		if not self.batch:
+			return
+		start = time.perf_counter()
+		detections = self.detector.detect([image for timestamp, camera, image in self.batch])
+		per_frame = (time.perf_counter() - start)/len(self.batch)
+		for (timestamp, camera, image), (people, boxes) in zip(self.batch, detections):
+			self.detect_times.append(per_frame)
+			self.counts.append([timestamp, camera.decode('utf-8'), people])
+			self.state.setPeople(camera, people)
+			self.last_frames[camera] = (image, boxes)
+		self.batch = []
+		self.decide()
+
+	"""
+	This function detects the people in a crop recorded from camera, body being that of
+	the CROP message, and merges them with the camera's last frame like the controller does
+	"""
+	def crop(self, timestamp, camera, body):
+		x, y, frame_width, frame_height, jpeg = protocol.unpackCrop(body)
+		last = self.last_frames.get(camera)
+		if last is None or last[0].shape[:2] != (frame_height, frame_width):		# the controller skipped it too
+			return
+		crop = cv2.imdecode(numpy.frombuffer(jpeg, dtype = numpy.uint8), cv2.IMREAD_COLOR)
+		if crop is None:
+			print("Skipping a crop from ", camera, " that could not be decoded")
+			return
+		start = time.perf_counter()
+		(people, boxes), = self.detector.detect([crop])
+		self.detect_times.append(time.perf_counter() - start)
+		merged = mergeCrop(last[0], last[1], (x, y), crop, boxes)
+		if merged is None:
+			return
+		self.last_frames[camera] = merged
+		self.counts.append([timestamp, camera.decode('utf-8'), len(merged[1])])
+		self.state.setPeople(camera, len(merged[1]))
+		self.decide()
+
+	"""
+	This function works out the HVAC commands from the state so far
+	"""
+	def decide(self):
+		status = self.state.hvacStatus()
+		if status != self.status:
+			self.status = status
+			self.decisions += 1
+
+	"""
+	This function handles one record of the trace
+	"""
+	def handle(self, timestamp, kind, name, body):
+		if kind != traceFile.FRAME:		# everything else depends on the counts of the frames before it
+			self.flush()
+
+		if kind == traceFile.FRAME:
+			image = cv2.imdecode(numpy.frombuffer(body, dtype = numpy.uint8), cv2.IMREAD_COLOR)
+			if image is None:
+				print("Skipping a frame from ", name, " that could not be decoded")
+				return
+			self.batch.append((timestamp, name, image))
+			if len(self.batch) >= self.batch_size:
+				self.flush()
+		elif kind == traceFile.CROP:
+			self.crop(timestamp, name, bytes(body))
+		elif kind == traceFile.COUNT:
+			self.state.setPeople(name, int(json.loads(bytes(body))['people']))
+			self.decide()
+		elif kind == traceFile.TEMP:
+			self.state.setTemperature(name, float(bytes(body)))
+			self.decide()
+		elif kind == traceFile.PAIR:
+			self.state.registerCamera(name, bytes(body))
+		elif kind == traceFile.SETPOINT:
+			default, zones = parseSetpoints(bytes(body).decode('utf-8'))
+			self.state.setTargets(default, {zone.encode('utf-8'): target for zone, target in zones.items()})
+			self.decide()
+		elif kind == traceFile.HVAC:
+			self.recorded_decisions += 1
+			if self.status is not None and ' '.join(self.status) == bytes(body).decode('utf-8'):
+				self.agreements += 1
+
+"""
+This function plays the records of reader back through replayer at speed times real
+time (0 for as fast as possible) and returns the results
+"""
+def replay(reader, replayer, speed):
+	records = reader.select()
+	if len(records) == 0:
+		raise ValueError("the trace has no records")
+	first_time = reader.index['time'][records[0]]
+	max_lag = 0.0
+	wall_start = time.perf_counter()
+	for i in records:
+		timestamp, kind, name, body = reader.record(i)
+		if speed > 0:		# wait until the record is due
+			due = wall_start + (timestamp - first_time)/speed
+			now = time.perf_counter()
+			if due > now:
+				time.sleep(due - now)
+			else:
+				max_lag = max(max_lag, now - due)
+		replayer.handle(timestamp, kind, name, body)
+	replayer.flush()
+	wall_time = time.perf_counter() - wall_start
+
+	detect_times = sorted(replayer.detect_times)
+	frames = len(replayer.counts)
+	return {
+		'frames': frames,
+		'trace_seconds': float(reader.index['time'][records[-1]] - first_time),
+		'wall_seconds': wall_time,
+		'frames_per_second': frames/wall_time if wall_time > 0 else None,
+		'detect_p50_ms': None if not detect_times else percentile(detect_times, 0.5)*1000,
+		'detect_p99_ms': None if not detect_times else percentile(detect_times, 0.99)*1000,
+		'max_lag_seconds': max_lag,
+		'hvac_decision_changes': replayer.decisions,
+		'hvac_recorded_decisions': replayer.recorded_decisions,
+		'hvac_agreement': replayer.agreements/replayer.recorded_decisions if replayer.recorded_decisions else None,
+	}
+
+"""
+This function prints how the people counted in counts differ from those in
+other_counts, both lists of [time, camera, people] from replays of the same trace
+"""
+def compareCounts(counts, other_counts):
+	if len(counts) != len(other_counts):
+		print("The runs counted a different number of frames (", len(counts), " and ", len(other_counts), "), are they from the same trace?")
+		return
+	if not counts:
+		return
+	people = numpy.array([count[2] for count in counts])
+	other_people = numpy.array([count[2] for count in other_counts])
+	print("Frames counted differently: ", int(numpy.count_nonzero(people != other_people)), " of ", len(people))
+	print("Mean difference in people per frame: ", float(numpy.mean(numpy.abs(people - other_people))))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Play a trace recorded by the controller back through detection and the HVAC decisions")
+	parser.add_argument('trace', help = "the trace file recorded with controller.py --record")
+	parser.add_argument('--speed', type = float, default = 0.0, help = "play back at this many times real time, 0 plays as fast as possible")
+	parser.add_argument('--backend', choices = backends, default = 'torch', help = "the inference backend used to detect people")
+	parser.add_argument('--model', default = "yolov8n.pt", help = "the model to load, a .pt model is exported for the onnx and openvino backends")
+	parser.add_argument('--int8', action = 'store_true', help = "use an INT8 quantized export of the model (onnx and openvino backends)")
+	parser.add_argument('--calibration', metavar = 'IMAGE_DIR', help = "the camera frames an INT8 ONNX export is calibrated on")
+	parser.add_argument('--batch', type = int, default = 8, help = "the most frames detected together when playing as fast as possible")
+	parser.add_argument('--output', help = "write the results and the people counted in every frame to this json file")
+	parser.add_argument('--compare', metavar = 'RESULTS', help = "compare the people counted against a json file written with --output by another run")
+	args = parser.parse_args()
+
+	reader = TraceReader(args.trace)
+	print("Trace records: ", reader.summary())
+	detector = Detector(args.backend, exportModel(args.backend, args.model, args.int8, args.calibration))
+	replayer = Replayer(detector, args.batch if args.speed == 0 else 1)		# batching would hold frames back when playing in time
+	results = replay(reader, replayer, args.speed)
+	for name, value in results.items():
+		print(name, ": ", value)
+
+	if args.output is not None:
+		f = open(args.output, 'w')
+		json.dump({'config': vars(args), 'results': results, 'counts': replayer.counts}, f)
+		f.close()
+		print("Results written to ", args.output)
+	if args.compare is not None:
+		f = open(args.compare, 'r')
+		other = json.load(f)
+		f.close()
+		compareCounts(replayer.counts, other['counts'])
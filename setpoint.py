@@ -0,0 +1,188 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+"""
+Author: Lucas Vanderheijden
+
+This file holds the target temperatures (setpoints) the controller aims for and
+keeps them in memory, so nothing has to read a file when the HVAC commands are
+worked out. The setpoints are reloaded only when the setpoint file changes. On
+linux the change is noticed right away with inotify, watching the directory so a
+file replaced by a rename is seen too. Anywhere else the file's modification time
+and size are checked every poll period instead.
+
+The setpoint file has one setpoint per line. A line with just a temperature is the
+setpoint for every room, and a line with a zone (the name of a temperature sensor)
+followed by a temperature is the setpoint of that room only. Temperatures may
+have decimals. For example:
+
+72.5
+kitchen 68
+
+The file is always written with writeSetpoints, which writes a temporary file and
+renames it over the old one, so the controller can never read a half written file.
+"""
+
+# the inotify events that mean a file in the watched directory may have changed
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+"""
+This function parses the text of a setpoint file and returns its (default setpoint,
+dictionary of zone names and their setpoints). The default is None if the text has none.
+It raises ValueError if a line is not a setpoint.
+"""
+def parseSetpoints(text):
+	default = None
+	zones = {}
+	for line in text.splitlines():
+		fields = line.split()
+		if not fields:		# skip blank lines
+			continue
+		if len(fields) == 1:
+			default = float(fields[0])
+		elif len(fields) == 2:
+			zones[fields[0]] = float(fields[1])
+		else:
+			raise ValueError("not a setpoint: " + line)
+	return default, zones
+
+"""
+This function returns the default setpoint and the dictionary zones of zone names
+and their setpoints as the text of a setpoint file
+"""
+def formatSetpoints(default, zones):
+	lines = []
+	if default is not None:
+		lines.append(str(default))
+	for zone, setpoint in sorted(zones.items()):
+		lines.append(zone + ' ' + str(setpoint))
+	return '\n'.join(lines) + '\n'
+
+"""
+This function writes the default setpoint and the dictionary zones of zone names and
+their setpoints to the file file_name. The file is replaced in one step.
+"""
+def writeSetpoints(file_name, default, zones):
+	temp_file_name = file_name + '.tmp'
+	f = open(temp_file_name, 'w')
+	f.write(formatSetpoints(default, zones))
+	f.flush()
+	os.fsync(f.fileno())		# make sure the contents are on disk before the rename makes them visible
+	f.close()
+	os.replace(temp_file_name, file_name)		# atomic, readers see either the old file or the new one
+
+"""
+This function returns an inotify file descriptor watching directory for files being
+written, renamed in or deleted, or None if inotify is not available
+"""
+def openInotify(directory):
+	library = ctypes.util.find_library('c')
+	if library is None:
+		return None
+	libc = ctypes.CDLL(library, use_errno = True)
+	if not hasattr(libc, 'inotify_init1'):		# not linux
+		return None
+	fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+	if fd < 0:
+		return None
+	if libc.inotify_add_watch(fd, os.fsencode(directory), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE) < 0:
+		os.close(fd)
+		return None
+	return fd
+
+"""
+This class keeps the setpoints from a setpoint file in memory and reloads them when the file changes
+"""
+class SetpointWatcher:
+
+	"""
+	file_name is the setpoint file, on_change is called with the new (default, zones)
+	whenever they change and poll_period is how often (in seconds) the file is
+	checked when inotify is not available.
+	"""
+	def __init__(self, file_name, on_change = None, poll_period = 1.0):
+		self.file_name = file_name
+		self.on_change = on_change
+		self.poll_period = poll_period
+		self.default = None		# the setpoint of rooms without their own
+		self.zones = {}		# the dictionary of zone names and their setpoints
+		self.file_state = None		# the (inode, modification time, size) of the file when it was last read
+		self.inotify_fd = None
+
+	"""
+	This returns the setpoint of zone, or the default setpoint if zone has none
+	"""
+	def target(self, zone = None):
+		return self.zones.get(zone, self.default)
+
+	"""
+	This function reloads the setpoints if the file changed since it was last read.
+	A file that can't be parsed is reported and the last good setpoints are kept.
+	"""
+	def check(self):
+		try:
+			stat = os.stat(self.file_name)
+			file_state = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+		except FileNotFoundError:
+			file_state = None
+		if file_state == self.file_state:
+			return
+		self.file_state = file_state
+		if file_state is None:
+			print("Setpoint file ", self.file_name, " not found, keeping the last setpoints")
+			return
+
+		try:
+			f = open(self.file_name, 'r')
+			default, zones = parseSetpoints(f.read())
+			f.close()
+		except (OSError, ValueError) as error:
+			print("Error while reading the setpoint file: ", error)
+			return
+		if (default, zones) == (self.default, self.zones):
+			return
+		self.default, self.zones = default, zones
+		print("Setpoints changed. Default: ", default, " zones: ", zones)
+		if self.on_change is not None:
+			self.on_change(default, zones)
+
+	"""
+	This function reads the inotify events waiting on the inotify file descriptor
+	and checks the file again
+	"""
+	def onInotify(self):
+		try:
+			while os.read(self.inotify_fd, 4096):		# the events only tell us to look, the file state says if it really changed
+				pass
+		except BlockingIOError:
+			pass
+		self.check()
+
+	"""
+	This coroutine loads the setpoints and then keeps them up to date for as long
+	as it runs, with inotify if it can and by polling otherwise
+	"""
+	async def watch(self):
+		loop = asyncio.get_running_loop()
+		self.check()
+		self.inotify_fd = openInotify(os.path.dirname(os.path.abspath(self.file_name)))
+		if self.inotify_fd is not None:
+			loop.add_reader(self.inotify_fd, self.onInotify)
+			try:
+				await asyncio.Future()		# the reader does the work, wait until cancelled
+			finally:
+				loop.remove_reader(self.inotify_fd)
+				os.close(self.inotify_fd)
+				self.inotify_fd = None
+		else:
+			print("inotify not available, polling the setpoint file every ", self.poll_period, " seconds")
+			while True:
+				await asyncio.sleep(self.poll_period)
+				self.check()
@@ -0,0 +1,96 @@
+import sqlite3
+import threading
+import time
+"""
+Author: Lucas Vanderheijden
+
+This file holds the store the controller keeps its registered devices and their
+latest readings in, so a restarted controller knows every temperature sensor and
+camera straight away and the devices can keep sending updates without having to
+register again.
+
+The store is a SQLite database in WAL mode. Changes are not written as they
+happen: they are collected in memory and written together in one transaction
+every flush period, off the event loop, so a burst of readings costs one small
+write. If the controller dies, at most the last flush period of readings is lost,
+and the device registrations themselves are never more than that behind.
+"""
+
+"""
+This class keeps the registered devices and their latest readings in a SQLite database
+"""
+class StateStore:
+
+	def __init__(self, file_name):
+		self.connection = sqlite3.connect(file_name, check_same_thread = False, isolation_level = None)		# flushes run on executor threads, one at a time
+		self.connection.execute('PRAGMA journal_mode = WAL')		# appends to a log instead of rewriting pages, and readers never block the writer
+		self.connection.execute('PRAGMA synchronous = NORMAL')		# in WAL mode this can only lose the last commits on a power cut, never corrupt the database
+		self.connection.execute('CREATE TABLE IF NOT EXISTS sensors (name BLOB PRIMARY KEY, temp REAL, updated REAL)')
+		self.connection.execute('CREATE TABLE IF NOT EXISTS cameras (name BLOB PRIMARY KEY, sensor BLOB, people INTEGER, updated REAL)')
+		self.lock = threading.Lock()		# guards the changes waiting to be written
+		self.flush_lock = threading.Lock()		# only one flush may use the connection at a time
+		self.sensors = {}		# the dictionary of sensor names and their (temperature, time) waiting to be written
+		self.cameras = {}		# the dictionary of camera names and their (sensor, people, time) waiting to be written
+
+	"""
+	This function is called by the ControllerState when the temperature of the sensor name changes
+	"""
+	def sensorChanged(self, name, temp):
+		with self.lock:
+			self.sensors[name] = (temp, time.time())
+
+	"""
+	This function is called by the ControllerState when the camera name is paired with
+	the sensor sensor or the people it sees change
+	"""
+	def cameraChanged(self, name, sensor, people):
+		with self.lock:
+			self.cameras[name] = (sensor, people, time.time())
+
+	"""
+	This function writes the changes collected so far in one transaction. It blocks,
+	so the controller runs it in an executor. If the write fails the transaction is
+	rolled back and the changes are kept to be written by the next flush.
+	"""
+	def flush(self):
+		with self.lock:		# take the changes and let new ones collect while these are written
+			sensors, self.sensors = self.sensors, {}
+			cameras, self.cameras = self.cameras, {}
+		if not sensors and not cameras:
+			return
+		with self.flush_lock:
+			try:
+				self.connection.execute('BEGIN')
+				self.connection.executemany('INSERT OR REPLACE INTO sensors VALUES (?, ?, ?)', [(name, temp, updated) for name, (temp, updated) in sensors.items()])
+				self.connection.executemany('INSERT OR REPLACE INTO cameras VALUES (?, ?, ?, ?)', [(name, sensor, people, updated) for name, (sensor, people, updated) in cameras.items()])
+				self.connection.execute('COMMIT')
+			except sqlite3.Error:
+				if self.connection.in_transaction:		# otherwise every later flush fails to start its own
+					self.connection.execute('ROLLBACK')
+				with self.lock:		# put the changes back, without overwriting newer ones that came in meanwhile
+					self.sensors = {**sensors, **self.sensors}
+					self.cameras = {**cameras, **self.cameras}
+				raise
+
+	"""
+	This function registers every stored sensor and camera in the ControllerState
+	state with its latest reading, and returns the number of (sensors, cameras) loaded
+	"""
+	def load(self, state):
+		sensors = self.connection.execute('SELECT name, temp FROM sensors').fetchall()
+		cameras = self.connection.execute('SELECT name, sensor, people FROM cameras').fetchall()
+		for name, temp in sensors:
+			state.registerSensor(bytes(name), temp)
+		for name, sensor, people in cameras:
+			state.registerCamera(bytes(name), bytes(sensor))
+			state.setPeople(bytes(name), people)
+		return len(sensors), len(cameras)
+
+	"""
+	This function writes what is left and closes the database
+	"""
+	def close(self):
+		try:
+			self.flush()
+		finally:
+			self.connection.close()
@@ -1,9 +1,13 @@
 import adafruit_dht
+import argparse
+import collections
 import time
 import board
 import socket
 import sys
 import gpiod
+import protocol
+from protocol import openSession, packTempBatch, readMessage, sendMessage
 
 """
 Author: Lucas Vanderheijden
@@ -16,27 +20,50 @@ the information to the central controller.
 This program takes two command line arguments. The first
 is the IP address to connect to, the second is the port number.
 
+After registering, the updates are sent over one session with the controller
+that stays open, with a heartbeat whenever the temperature has not changed
+for a while so the controller knows the sensor is still alive.
+
+The DHT22 jitters by a tenth of a degree or so between readings, so a reading is
+only reported when it moved more than the dead-band (--deadband degrees) away from
+the last reported one. The optional --smoothing argument also averages the readings
+(an exponential moving average giving the newest reading that weight, 1 turns it
+off) before they are compared. Reported readings are collected and sent together
+in one message every --batch-period seconds. If the controller can't be reached
+they are kept (the newest --buffer-size of them) and sent once the session is back,
+so the controller's history has no gaps.
+
 This program requires the adafruit_blinka library
 to run. Information can be found at:
 https://learn.adafruit.com/dht-humidity-sensing-on-raspberry-pi-with-gdocs-logging/python-setup
 """
 
+parser = argparse.ArgumentParser(description = "Send the temperature of the DHT22 sensor to the controller")
+parser.add_argument('address', help = "the IP address of the controller")
+parser.add_argument('port', type = int, help = "the port the controller listens on")
+parser.add_argument('--deadband', type = float, default = 0.3, help = "only report a temperature that moved more than this many degrees from the last reported one")
+parser.add_argument('--smoothing', type = float, default = 1.0, help = "the weight (0 to 1) of the newest reading in the moving average of the readings, 1 turns smoothing off")
+parser.add_argument('--batch-period', type = float, default = protocol.heartbeat_period, help = "how often (in seconds) the reported temperatures are sent together")
+parser.add_argument('--buffer-size', type = int, default = 2000, help = "the most temperatures kept while the controller can't be reached, older ones are dropped")
+args = parser.parse_args()
+if not 0 < args.smoothing <= 1:
+	parser.error("--smoothing must be above 0 and at most 1")
+
 dht_device = adafruit_dht.DHT22(board.D4)	#setup our device. D4 means senor plugged in GPIO pin 4.
 pause_period = 2.0		# how long to wait between reading. The DHT 22 sensor should only be polled every 2 sec.
-previous_temp = 0		# the temp the last time we checked.
-
-
-sock = socket.socket()
-
-if len(sys.argv) < 3:		# the IP addr and port number to connect to must be supplied. Exit if not found
-	print("Usage: <IPAddr> <Port #>")
-	dht_device.exit()
-	sys.exit(0)
 
-address = (sys.argv[1], int(sys.argv[2]))	# store the IPAddr, Port # tuple the socket needs to connect
+address = (args.address, args.port)	# store the IPAddr, Port # tuple the socket needs to connect
 
 print("Registering device")
-sock.connect(address)	# connect to register device
+while True:		# the controller may not be up yet, keep trying
+	sock = socket.socket()
+	try:
+		sock.connect(address)	# connect to register device
+		break
+	except OSError as error:
+		print("Could not reach the controller, trying again: ", error)
+		sock.close()
+		time.sleep(pause_period)
 
 sock.send(b"temp_reg")		# inform controller device wants to register itself
 if sock.recv(1024) != b"ack":		# the controller should respond with acknowledgement
@@ -76,6 +103,13 @@ print("Device successfully registered")
 sock.close()		# close connection
 # we are now done registering the device
 
+session = None		# the session with the controller, opened when first needed
+last_sent = time.monotonic()	# when something was last sent over the session
+last_batch = time.monotonic()	# when the reported temperatures were last sent
+smoothed_temp = temp		# the moving average of the readings
+reported_temp = temp		# the temperature last reported, readings within the dead-band of it are not reported
+unsent = collections.deque(maxlen = args.buffer_size)	# the (monotonic time, temperature) of the reported temperatures the controller has not acknowledged yet
+
 while True:
 	time.sleep(pause_period)	# wait until sensing again
 
@@ -83,25 +117,40 @@ while True:
 		temp = dht_device.temperature		# read the temperature
 		temp = temp * (9 / 5) + 32		# convert from Celsius to Fahrenheit
 		print('Temp={:.1f} F'.format(temp))
+		smoothed_temp = args.smoothing*temp + (1 - args.smoothing)*smoothed_temp
+		if abs(smoothed_temp - reported_temp) > args.deadband:		# a real change, not jitter
+			unsent.append((time.monotonic(), smoothed_temp))
+			reported_temp = smoothed_temp
 
-	except RuntimeError as error:		# catch and ignore exceptions because the sensor can be finnicky
+	except RuntimeError as error:		# catch and ignore exceptions because the sensor can be finnicky, there is no new reading to report
 		print("Sensor error: ", error.args[0])
 
-	if not previous_temp == temp:	# if the temperature has changed, send the new one to central hub
-		print("Attempting to send temperature update")
-		sock = socket.socket()
-		sock.connect(address)		# connect to controller
-
-		sock.send(b"temp_update")	# inform controller this is an update message
-		if sock.recv(1024) == b"ack":
-			sock.send(sensor_name.encode('utf-8'))		# tell controller which device this is
-			if sock.recv(1024) == b"ack":
-				sock.send(str(temp).encode('utf-8'))		# sent the temperature
-				print("Successfully updated temperature to: ", temp)
-			else:
-				print("An error in sending the temperature update has occurred.")
-		else:
-			print("An error in sending the temperature update has occurred.")
-		sock.close()
-
-		previous_temp = temp	# update the previous temperature
\ No newline at end of file
+	try:
+		if session is None:
+			session = openSession(address, sensor_name)
+			print("Opened session with controller")
+			if not unsent:		# the controller may have lost the temperature while the session was down
+				unsent.append((time.monotonic(), reported_temp))
+			last_batch = 0.0		# send what was kept during the outage right away
+
+		now = time.monotonic()
+		if unsent and now - last_batch >= args.batch_period:	# send the reported temperatures to central hub
+			samples = list(unsent)
+			sendMessage(session, protocol.TEMP_BATCH, packTempBatch([(now - taken, sample) for taken, sample in samples]))
+			if readMessage(session)[0] != protocol.ACK:
+				raise ConnectionError("controller did not acknowledge the temperatures")
+			for i in range(len(samples)):		# only forget them once the controller has them
+				unsent.popleft()
+			print("Successfully sent ", len(samples), " temperatures, the newest: ", samples[-1][1])
+			last_batch = last_sent = now
+		elif now - last_sent >= protocol.heartbeat_period:		# nothing to say, let the controller know we are alive
+			sendMessage(session, protocol.HEARTBEAT)
+			if readMessage(session)[0] != protocol.HEARTBEAT:
+				raise ConnectionError("controller did not answer the heartbeat")
+			last_sent = time.monotonic()
+
+	except (OSError, ValueError) as error:		# the controller is unreachable, keep the temperatures and try again next time
+		print("An error in sending the temperature update has occurred: ", error, ", ", len(unsent), " temperatures waiting")
+		if session is not None:
+			session.close()
+			session = None
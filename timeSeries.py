@@ -0,0 +1,207 @@
+import os
+import threading
+import numpy
+"""
+Author: Lucas Vanderheijden
+
+This file holds the history of the readings the controller receives, so the
+temperature and occupancy of every room can be looked at after the fact.
+
+Each series (like the temperature of one sensor or the people seen by one camera)
+is stored in fixed size numpy ring buffers: one column of timestamps and one of
+values. When a buffer is full the oldest samples are overwritten, so memory stays
+the same no matter how long the controller runs. Next to the raw samples every
+series keeps 1 minute and 1 hour means in their own ring buffers, which cover
+much longer stretches of time in the same space.
+
+Queries copy the samples they need out of the buffers while holding the lock and
+do the math afterwards with numpy, so a dashboard asking for a long range does not
+hold up the readings coming in. The whole store can be written to a compressed
+snapshot file and loaded back when the controller starts.
+"""
+
+raw_capacity = 8192		# the number of raw samples kept per series
+minute_capacity = 7*24*60		# a week of 1 minute means
+hour_capacity = 2*365*24		# two years of 1 hour means
+resolutions = {'minute': 60, 'hour': 3600}		# the rollups kept for every series and the length of their buckets in seconds
+
+"""
+This class is a ring buffer of (timestamp, value) samples in time order
+"""
+class RingBuffer:
+
+	def __init__(self, capacity):
+		self.times = numpy.zeros(capacity, dtype = numpy.float64)		# seconds since the epoch
+		self.values = numpy.zeros(capacity, dtype = numpy.float32)
+		self.count = 0		# the number of samples stored, at most the capacity
+		self.next = 0		# the index the next sample is written to
+
+	"""
+	This function adds one sample
+	"""
+	def append(self, timestamp, value):
+		self.times[self.next] = timestamp
+		self.values[self.next] = value
+		self.next = (self.next+1) % len(self.times)
+		self.count = min(self.count+1, len(self.times))
+
+	"""
+	This function adds the samples in the arrays times and values at once
+	"""
+	def extend(self, times, values):
+		capacity = len(self.times)
+		if len(times) > capacity:		# only the newest samples would survive anyway
+			times, values = times[-capacity:], values[-capacity:]
+		indexes = (self.next + numpy.arange(len(times))) % capacity
+		self.times[indexes] = times
+		self.values[indexes] = values
+		self.next = (self.next+len(times)) % capacity
+		self.count = min(self.count+len(times), capacity)
+
+	"""
+	This returns copies of the (times, values) of the samples with start <= time < end, oldest first
+	"""
+	def range(self, start, end):
+		first = (self.next-self.count) % len(self.times)		# the index of the oldest sample
+		order = (first + numpy.arange(self.count)) % len(self.times)
+		times = self.times[order]
+		low, high = numpy.searchsorted(times, [start, end])		# the samples are in time order, so the range is found by binary search
+		return times[low:high], self.values[order[low:high]]
+
+"""
+This class is the history of one reading, the raw samples and the rollups of their means
+"""
+class Series:
+
+	def __init__(self):
+		self.raw = RingBuffer(raw_capacity)
+		self.rollups = {'minute': RingBuffer(minute_capacity), 'hour': RingBuffer(hour_capacity)}
+		self.buckets = {resolution: [None, 0.0, 0] for resolution in resolutions}		# the [start time, sum, count] of the bucket each rollup is filling
+
+	"""
+	This function adds a sample and closes the rollup buckets it moved past
+	"""
+	def append(self, timestamp, value):
+		self.raw.append(timestamp, value)
+		for resolution, length in resolutions.items():
+			bucket = self.buckets[resolution]
+			start = timestamp - timestamp % length
+			if bucket[0] is not None and start != bucket[0]:		# the sample starts a new bucket, store the mean of the old one
+				self.rollups[resolution].append(bucket[0], bucket[1]/bucket[2])
+				bucket[1], bucket[2] = 0.0, 0
+			bucket[0] = start
+			bucket[1] += value
+			bucket[2] += 1
+
+"""
+This class holds the history of every reading the controller receives
+"""
+class TimeSeriesStore:
+
+	def __init__(self):
+		self.lock = threading.Lock()		# readings come in on the event loop while queries and snapshots may run in other threads
+		self.series = {}		# the dictionary of (kind, name) and their Series
+
+	"""
+	This function records value as the reading of kind (like 'temp' or 'people') from
+	the device name at timestamp
+	"""
+	def record(self, kind, name, timestamp, value):
+		with self.lock:
+			series = self.series.get((kind, name))
+			if series is None:
+				series = self.series[(kind, name)] = Series()
+			series.append(timestamp, value)
+
+	"""
+	This function records many readings of kind from the device name at once, times and
+	values being sequences of the same length in time order
+	"""
+	def recordMany(self, kind, name, times, values):
+		with self.lock:
+			series = self.series.get((kind, name))
+			if series is None:
+				series = self.series[(kind, name)] = Series()
+			for timestamp, value in zip(times, values):		# the rollups need every sample in order
+				series.append(timestamp, value)
+
+	"""
+	This returns the (kind, name) of every series in the store
+	"""
+	def names(self):
+		with self.lock:
+			return list(self.series)
+
+	"""
+	This returns the (times, values) arrays of the readings of kind from name with
+	start <= time < end. resolution is 'raw' for the samples as received or one of
+	the rollups ('minute' or 'hour') for their means.
+	"""
+	def query(self, kind, name, start, end, resolution = 'raw'):
+		with self.lock:
+			series = self.series.get((kind, name))
+			if series is None:
+				return numpy.zeros(0, dtype = numpy.float64), numpy.zeros(0, dtype = numpy.float32)
+			buffer = series.raw if resolution == 'raw' else series.rollups[resolution]
+			return buffer.range(start, end)		# copies, so the math below runs without the lock
+
+	"""
+	This returns a dictionary with the count, min, max and mean of the readings of kind from
+	name with start <= time < end, along with their mean over time (each value weighted
+	by how long it held), or None if there are none
+	"""
+	def aggregate(self, kind, name, start, end, resolution = 'raw'):
+		times, values = self.query(kind, name, start, end, resolution)
+		if len(values) == 0:
+			return None
+		values = values.astype(numpy.float64)
+		last = end if numpy.isfinite(end) else times[-1]		# an open ended range gives no time to the last reading
+		held = numpy.diff(numpy.append(times, last))		# each reading holds until the next one, the last one until the end of the range
+		total_time = held.sum()
+		return {'count': len(values), 'min': float(values.min()), 'max': float(values.max()), 'mean': float(values.mean()),
+			'time_mean': float((values*held).sum()/total_time) if total_time > 0 else float(values.mean())}
+
+	"""
+	This returns the raw samples and rollups of every series as a dictionary of arrays
+	that numpy.savez can write. It only copies the buffers, so it is quick to run on the event loop.
+	"""
+	def snapshot(self):
+		arrays = {}
+		kinds = []
+		names = []
+		with self.lock:
+			for index, ((kind, name), series) in enumerate(self.series.items()):
+				kinds.append(kind)
+				names.append(name)
+				for resolution, buffer in [('raw', series.raw)] + list(series.rollups.items()):
+					times, values = buffer.range(-numpy.inf, numpy.inf)
+					arrays[str(index) + '_' + resolution + '_times'] = times
+					arrays[str(index) + '_' + resolution + '_values'] = values
+		arrays['kinds'] = numpy.array(kinds, dtype = str)
+		arrays['names'] = numpy.array(names, dtype = str)
+		return arrays
+
+	"""
+	This function loads the series from the snapshot file file_name written by saveSnapshot
+	"""
+	def load(self, file_name):
+		snapshot = numpy.load(file_name)
+		with self.lock:
+			for index, (kind, name) in enumerate(zip(snapshot['kinds'], snapshot['names'])):
+				series = self.series[(str(kind), str(name))] = Series()
+				series.raw.extend(snapshot[str(index) + '_raw_times'], snapshot[str(index) + '_raw_values'])
+				for resolution, buffer in series.rollups.items():
+					buffer.extend(snapshot[str(index) + '_' + resolution + '_times'], snapshot[str(index) + '_' + resolution + '_values'])
+		snapshot.close()
+
+"""
+This function writes the arrays returned by TimeSeriesStore.snapshot to the file file_name.
+The file is written next to it first and renamed, so a crash never leaves half a snapshot.
+It is slow enough that it should be run in an executor.
+"""
+def saveSnapshot(file_name, arrays):
+	temp_file_name = file_name + '.tmp'
+	f = open(temp_file_name, 'wb')
+	numpy.savez_compressed(f, **arrays)
+	f.close()
+	os.replace(temp_file_name, file_name)
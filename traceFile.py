@@ -0,0 +1,147 @@
+import mmap
+import os
+import struct
+import time
+import numpy
+"""
+Author: Lucas Vanderheijden
+
+This file holds the trace format the controller records what it receives in
+(see the --record argument of controller.py) and that replay.py plays back.
+
+A trace is two files. The data file holds the records one after another, each
+one a small header followed by the device name and the body, like the jpeg of a
+frame or the text of a temperature. The index file holds one fixed size entry for
+every record: its time, where it starts in the data file, its size and its kind.
+Both files are only ever appended to, so recording is cheap and a trace can be
+read while it is still being recorded. The reader memory maps the data file and
+loads the index as a numpy array, so finding the records of one kind or one
+stretch of time does not read any frames, and a frame is only copied out of the
+file when it is used.
+"""
+
+trace_magic = b'TRCE'
+trace_version = 1
+file_header = struct.Struct('<4sH')		# magic and version at the start of the data file
+record_header = struct.Struct('<dBHI')		# time, kind, name length and body length before every record
+index_entry = numpy.dtype([('time', '<f8'), ('offset', '<u8'), ('size', '<u4'), ('kind', 'u1')])		# one entry in the index file per record
+
+# the kinds of records
+FRAME = 1		# a jpeg frame from the camera named in the record
+TEMP = 2		# a temperature from the sensor named in the record, as text
+COUNT = 3		# a json people count from the edge camera named in the record
+HVAC = 4		# the HVAC commands the controller decided on, as text like b'ON OFF'
+PAIR = 5		# the camera named in the record was paired with the temperature sensor in the body
+SETPOINT = 6		# the setpoints changed, the body is the text of the setpoint file (see setpoint.py)
+CROP = 7		# the changed part of a frame from the camera named in the record, the body is that of a CROP message (see protocol.py)
+
+kind_names = {FRAME: 'frame', TEMP: 'temp', COUNT: 'count', HVAC: 'hvac', PAIR: 'pair', SETPOINT: 'setpoint', CROP: 'crop'}
+
+"""
+This returns the name of the index file of the trace data file file_name
+"""
+def indexFileName(file_name):
+	return file_name + '.idx'
+
+"""
+This class appends records to a trace
+"""
+class TraceWriter:
+
+	"""
+	file_name is the data file of the trace. An existing trace is added to.
+	"""
+	def __init__(self, file_name):
+		new = not os.path.exists(file_name) or os.path.getsize(file_name) == 0
+		self.data = open(file_name, 'ab')
+		self.index = open(indexFileName(file_name), 'ab')
+		if new:
+			self.data.write(file_header.pack(trace_magic, trace_version))
+		self.offset = self.data.tell()		# where the next record starts
+		self.records = 0
+
+	"""
+	This function appends a record of kind from the device name (bytes) with the bytes
+	payload. timestamp defaults to now.
+	"""
+	def append(self, kind, name, payload, timestamp = None):
+		if timestamp is None:
+			timestamp = time.time()
+		header = record_header.pack(timestamp, kind, len(name), len(payload))
+		self.data.write(header)
+		self.data.write(name)
+		self.data.write(payload)
+		size = len(header) + len(name) + len(payload)
+		entry = numpy.array([(timestamp, self.offset, size, kind)], dtype = index_entry)
+		self.index.write(entry.tobytes())		# written after the record, so the index never points past the data
+		self.offset += size
+		self.records += 1
+
+	"""
+	This function writes out everything appended so far
+	"""
+	def flush(self):
+		self.data.flush()
+		self.index.flush()
+
+	def close(self):
+		self.data.close()
+		self.index.close()
+
+"""
+This class reads a trace
+"""
+class TraceReader:
+
+	def __init__(self, file_name):
+		f = open(file_name, 'rb')
+		magic, version = file_header.unpack(f.read(file_header.size))
+		if magic != trace_magic or version != trace_version:
+			f.close()
+			raise ValueError(file_name + " is not a trace")
+		self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		f.close()
+		index = numpy.fromfile(indexFileName(file_name), dtype = numpy.uint8)
+		entries = len(index)//index_entry.itemsize		# leave out an entry cut short by a crash
+		self.index = index[:entries*index_entry.itemsize].view(index_entry)
+		self.index = self.index[self.index['offset'] + self.index['size'] <= len(self.data)]		# and records whose data never made it to disk
+
+	def __len__(self):
+		return len(self.index)
+
+	"""
+	This returns the (time, kind, name, body) of record number i. The body is a
+	memoryview into the memory mapped file, so it is only read when it is used.
+	"""
+	def record(self, i):
+		entry = self.index[i]
+		offset = int(entry['offset'])
+		timestamp, kind, name_length, body_length = record_header.unpack_from(self.data, offset)
+		start = offset + record_header.size
+		view = memoryview(self.data)
+		return timestamp, kind, bytes(view[start:start+name_length]), view[start+name_length:start+name_length+body_length]
+
+	def __iter__(self):
+		for i in range(len(self.index)):
+			yield self.record(i)
+
+	"""
+	This returns the numbers of the records of kind, or of every kind if kind is None,
+	with start <= time < end
+	"""
+	def select(self, kind = None, start = -numpy.inf, end = numpy.inf):
+		times = self.index['time']
+		mask = (times >= start) & (times < end)
+		if kind is not None:
+			mask &= self.index['kind'] == kind
+		return numpy.flatnonzero(mask)
+
+	"""
+	This returns a dictionary of the kind names and how many records of each the trace has
+	"""
+	def summary(self):
+		kinds, counts = numpy.unique(self.index['kind'], return_counts = True)
+		return {kind_names.get(int(kind), str(kind)): int(count) for kind, count in zip(kinds, counts)}
+
+	def close(self):
+		self.data.close()
@@ -0,0 +1,141 @@
+import threading
+import cv2
+import numpy
+"""
+Author: Lucas Vanderheijden
+
+This file holds the tracker the controller uses so that full person detection
+only has to run every few frames for each room. Occupancy changes slowly, so
+between detections the people found by the last detection are followed from
+frame to frame with optical flow, which costs a small fraction of a YOLO pass.
+
+Each person found by a detection becomes a track with its own id. A few feature
+points inside the person's box are followed with Lucas-Kanade optical flow and the
+box is moved by how far its points moved. Tracks keep their id across detections
+when the new box overlaps the old one. A full detection is asked for when the
+cadence for the camera is reached, when the frame changed a lot compared to the
+last detection (someone may have come in), or when a track is lost.
+"""
+
+min_track_points = 3		# the fewest points a track may have left before it counts as lost
+match_iou = 0.3		# how much a new box must overlap an old one to keep the old track's id
+
+"""
+This function returns a small grayscale thumbnail of the BGR image used to
+spot large changes cheaply
+"""
+def thumbnail(image):
+	gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+	return cv2.resize(gray, (32, 24), interpolation = cv2.INTER_AREA)
+
+"""
+This function returns the intersection over union of two [x1, y1, x2, y2] boxes
+"""
+def boxIou(a, b):
+	width = min(a[2], b[2]) - max(a[0], b[0])
+	height = min(a[3], b[3]) - max(a[1], b[1])
+	if width <= 0 or height <= 0:
+		return 0.0
+	intersection = width*height
+	return intersection/((a[2]-a[0])*(a[3]-a[1]) + (b[2]-b[0])*(b[3]-b[1]) - intersection)
+
+"""
+This class tracks the people seen by one camera between full detections
+"""
+class RoomTracker:
+
+	"""
+	detect_every is how many frames make up one detection cycle (1 runs detection on
+	every frame) and change_threshold is the mean change in brightness of the
+	thumbnail since the last detection that forces a new detection.
+	"""
+	def __init__(self, detect_every, change_threshold = 20.0):
+		self.detect_every = detect_every
+		self.change_threshold = change_threshold
+		self.lock = threading.Lock()		# frames are tracked on executor threads, so only one may touch the tracks at a time
+		self.tracks = []		# the list of [track id, box, feature points] for each person being followed
+		self.next_id = 0		# the id the next new track gets
+		self.prev_gray = None		# the grayscale version of the last frame that was tracked or detected
+		self.key_thumbnail = None		# the thumbnail of the frame of the last detection
+		self.frames_since_detection = 0
+		self.detection_pending = False		# True while a frame from this camera is waiting for a full detection
+
+	"""
+	This returns True if the BGR image needs a full detection instead of tracking
+	"""
+	def needsDetection(self, image):
+		if self.detect_every <= 1 or self.prev_gray is None or self.detection_pending:
+			return True
+		if self.frames_since_detection+1 >= self.detect_every:		# the cadence for this camera says it is time
+			return True
+		return numpy.mean(cv2.absdiff(thumbnail(image), self.key_thumbnail)) > self.change_threshold
+
+	"""
+	This function follows the tracks into the BGR image. It returns the number of
+	people and their boxes, or None if the image needs a full detection instead.
+	"""
+	def step(self, image):
+		with self.lock:
+			if self.needsDetection(image):
+				return None
+
+			gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+			if self.tracks:
+				old_points = numpy.concatenate([points for track_id, box, points in self.tracks])
+				new_points, status, error = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, old_points, None, winSize = (21, 21), maxLevel = 3)
+
+				moved = []
+				start = 0
+				for track_id, box, points in self.tracks:
+					end = start+len(points)
+					found = status[start:end, 0] == 1
+					if numpy.count_nonzero(found) < min_track_points:		# lost this person, only a detection can tell where they went
+						return None
+					shift = numpy.median(new_points[start:end][found] - old_points[start:end][found], axis = 0)[0]
+					moved.append([track_id, [box[0]+shift[0], box[1]+shift[1], box[2]+shift[0], box[3]+shift[1]], new_points[start:end][found].reshape(-1, 1, 2)])
+					start = end
+				self.tracks = moved
+
+			self.prev_gray = gray
+			self.frames_since_detection += 1
+			return len(self.tracks), [box for track_id, box, points in self.tracks]
+
+	"""
+	This function starts tracking the person boxes found by a full detection on the BGR image.
+	People overlapping a box from before keep their track id.
+	"""
+	def update(self, image, boxes):
+		gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+		with self.lock:
+			unmatched = list(self.tracks)
+			tracks = []
+			for box in boxes:
+				best = max(unmatched, key = lambda track: boxIou(track[1], box), default = None)
+				if best is not None and boxIou(best[1], box) >= match_iou:
+					unmatched.remove(best)
+					track_id = best[0]
+				else:
+					track_id = self.next_id
+					self.next_id += 1
+				tracks.append([track_id, box, self.seedPoints(gray, box)])
+
+			self.tracks = tracks
+			self.prev_gray = gray
+			self.key_thumbnail = cv2.resize(gray, (32, 24), interpolation = cv2.INTER_AREA)
+			self.frames_since_detection = 0
+			self.detection_pending = False
+
+	"""
+	This returns the feature points to follow inside box of the grayscale image gray,
+	in the shape calcOpticalFlowPyrLK expects
+	"""
+	def seedPoints(self, gray, box):
+		x1, y1 = max(int(box[0]), 0), max(int(box[1]), 0)
+		x2, y2 = min(int(box[2]), gray.shape[1]), min(int(box[3]), gray.shape[0])
+		mask = numpy.zeros(gray.shape, dtype = numpy.uint8)
+		mask[y1:y2, x1:x2] = 255
+		points = cv2.goodFeaturesToTrack(gray, maxCorners = 20, qualityLevel = 0.01, minDistance = 5, mask = mask)
+		if points is None or len(points) < min_track_points:		# a flat box has no corners, follow a grid of points instead
+			xs, ys = numpy.meshgrid(numpy.linspace(x1, x2, 5)[1:4], numpy.linspace(y1, y2, 5)[1:4])
+			points = numpy.stack([xs.ravel(), ys.ravel()], axis = 1).reshape(-1, 1, 2)
+		return points.astype(numpy.float32)
@@ -1,18 +1,40 @@
+import os
+from setpoint import parseSetpoints, writeSetpoints
 """
 Author: Lucas Vanderheijden
 
 This file just gives an easier way to update the target temperature
 file controller.py uses to get the target temperature.
 
-It acts as a sort of UI allowing the user to set the target temperature
+It acts as a sort of UI allowing the user to set the target temperature.
+Enter a temperature to set it for every room, or the name of a temperature
+sensor followed by a temperature to set it for that sensor's room only.
+Temperatures may have decimals. The file is replaced in one step so the
+controller never reads a half written file.
 """
 
 target_temp_file = 'temp.txt'		# file storing the target temperature
 
+default = None		# the target temperature of every room without its own
+zones = {}		# the dictionary of temperature sensor names and the target temperature of their room
+if os.path.exists(target_temp_file):		# keep the setpoints that are already set
+	f = open(target_temp_file, 'r')
+	default, zones = parseSetpoints(f.read())
+	f.close()
+
 while True:
-	target_temp = input("Enter the desired temperature (in Fahrenheit). Enter 'quit' to quit: ")		# get the new temperature
+	target_temp = input("Enter the desired temperature (in Fahrenheit), optionally after a sensor name. Enter 'quit' to quit: ")		# get the new temperature
 	if target_temp == 'quit':		# quit if told to
 		break
-	f = open(target_temp_file, 'w')
-	f.write(target_temp)		# update target temperature
-	f.close()
\ No newline at end of file
+	fields = target_temp.split()
+	try:
+		if len(fields) == 1:
+			default = float(fields[0])
+		elif len(fields) == 2:
+			zones[fields[0]] = float(fields[1])
+		else:
+			raise ValueError
+	except ValueError:
+		print("Enter a temperature, or a sensor name and a temperature")
+		continue
+	writeSetpoints(target_temp_file, default, zones)		# update target temperature
\ No newline at end of file